@@ -0,0 +1,238 @@
+"""Benchmark the BotWorker message path with synthetic IRC traffic.
+
+Runs a BotWorker with the memo, coffee and misc processors against the fake
+Redis and fake AMQP broker from the test helpers, feeds it a reproducible mix
+of chatter and commands and reports throughput, latency, Redis commands and
+GC-tracked object growth per message as JSON.
+
+Usage::
+
+    python -m benchmarks.bench_botworker [--messages N] [--output FILE]
+
+The fake Redis normally delays every command by a couple of milliseconds to
+catch code that doesn't wait on deferreds. We set that delay to zero (see
+`--redis-wait`) so the numbers reflect the bot rather than the fake.
+"""
+
+import gc
+import json
+import os
+import random
+import sys
+import time
+from optparse import OptionParser
+
+
+def parse_args(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option(
+        "--messages", type="int", default=2000,
+        help="Number of messages to send after warming up.")
+    parser.add_option(
+        "--warmup", type="int", default=200,
+        help="Number of messages to send before measuring.")
+    parser.add_option(
+        "--seed", type="int", default=42, help="Random seed for traffic.")
+    parser.add_option(
+        "--nicks", type="int", default=50, help="Number of distinct nicks.")
+    parser.add_option(
+        "--channels", type="int", default=5,
+        help="Number of distinct channels.")
+    parser.add_option(
+        "--redis-wait", type="float", default=0.0,
+        help="Fake Redis delay per command in seconds.")
+    parser.add_option(
+        "--concurrent", action="store_true", default=False,
+        help="Run processors concurrently.")
+    parser.add_option(
+        "--output", default=None,
+        help="Write JSON results here instead of stdout.")
+    options, _args = parser.parse_args(argv)
+    return options
+
+
+# Relative weights of each kind of traffic.
+TRAFFIC_MIX = [
+    ('chatter', 70),
+    ('tell', 8),
+    ('coffee', 5),
+    ('mycoffee', 2),
+    ('ping', 5),
+    ('unknown', 10),
+]
+
+
+class TrafficGenerator(object):
+    def __init__(self, seed, nicks, channels):
+        self.random = random.Random(seed)
+        self.nicks = ['nick%d' % (i,) for i in range(nicks)]
+        self.channels = ['#chan%d' % (i,) for i in range(channels)]
+        self.kinds = []
+        for kind, weight in TRAFFIC_MIX:
+            self.kinds.extend([kind] * weight)
+
+    def next_message(self):
+        """Return `(kind, nick, channel, content)` for the next message."""
+        kind = self.random.choice(self.kinds)
+        nick = self.random.choice(self.nicks)
+        channel = self.random.choice(self.channels)
+        target = self.random.choice(self.nicks)
+        content = {
+            'chatter': "just chatting about things, nothing to see here",
+            'tell': "!tell %s don't forget the meeting" % (target,),
+            'coffee': "!coffee %s broke the build" % (target,),
+            'mycoffee': "!mycoffee",
+            'ping': "!ping",
+            'unknown': "!frobnicate the widgets",
+        }[kind]
+        return kind, nick, channel, content
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class RedisCommandCounter(object):
+    """Count commands sent to every FakeRedis instance."""
+
+    def __init__(self):
+        self.count = 0
+
+    def install(self):
+        from vumi.persist.fake_redis import FakeRedis
+        self._fake_redis = FakeRedis
+        self._orig_delay_operation = FakeRedis._delay_operation
+        counter = self
+
+        def counting_delay_operation(fake_redis, func, args, kw):
+            counter.count += 1
+            return counter._orig_delay_operation(fake_redis, func, args, kw)
+
+        FakeRedis._delay_operation = counting_delay_operation
+
+    def uninstall(self):
+        self._fake_redis._delay_operation = self._orig_delay_operation
+
+
+def main(reactor, options):
+    from twisted.internet.defer import inlineCallbacks, returnValue
+
+    from tests.helpers import BotMessageProcessorHelper
+    from vumibot.base import BotWorker
+    from vumibot.memo import MemoMessageProcessor
+
+    @inlineCallbacks
+    def run():
+        helper = BotMessageProcessorHelper(MemoMessageProcessor)
+        helper.setup()
+        counter = RedisCommandCounter()
+        counter.install()
+        try:
+            app = yield helper.get_worker(BotWorker, helper.mk_config({
+                'transport_name': helper.transport_name,
+                'concurrent_processors': options.concurrent,
+                'message_processors': {
+                    'vumibot.memo.MemoMessageProcessor': {},
+                    'vumibot.coffee.CoffeeMessageProcessor': {},
+                    'vumibot.misc.MiscMessageProcessor': {},
+                },
+            }))
+            results = yield run_traffic(helper, app, counter)
+        finally:
+            counter.uninstall()
+            yield helper.cleanup()
+        returnValue(results)
+
+    @inlineCallbacks
+    def send(helper, app, nick, channel, content):
+        msg = helper.make_inbound(content, from_addr=nick, group=channel)
+        start = time.time()
+        yield app.dispatch_user_message(msg)
+        returnValue(time.time() - start)
+
+    @inlineCallbacks
+    def run_traffic(helper, app, counter):
+        traffic = TrafficGenerator(
+            options.seed, options.nicks, options.channels)
+        for _ in range(options.warmup):
+            _kind, nick, channel, content = traffic.next_message()
+            yield send(helper, app, nick, channel, content)
+        helper.clear_all_dispatched()
+
+        latencies = []
+        kinds = {}
+        gc.collect()
+        gc.disable()
+        objects_before = len(gc.get_objects())
+        commands_before = counter.count
+        start = time.time()
+        for _ in range(options.messages):
+            kind, nick, channel, content = traffic.next_message()
+            kinds[kind] = kinds.get(kind, 0) + 1
+            latency = yield send(helper, app, nick, channel, content)
+            latencies.append(latency)
+        elapsed = time.time() - start
+        commands = counter.count - commands_before
+        objects_after = len(gc.get_objects())
+        gc.enable()
+
+        yield helper.kick_delivery()
+        replies = len(helper.get_dispatched_outbound())
+        latencies.sort()
+        messages = options.messages
+        returnValue({
+            'benchmark': 'botworker',
+            'messages': messages,
+            'concurrent_processors': options.concurrent,
+            'traffic': kinds,
+            'elapsed_seconds': elapsed,
+            'messages_per_second': messages / elapsed if elapsed else 0.0,
+            'latency_p50_ms': percentile(latencies, 50) * 1000,
+            'latency_p99_ms': percentile(latencies, 99) * 1000,
+            'latency_max_ms': latencies[-1] * 1000 if latencies else 0.0,
+            'redis_commands_per_message': float(commands) / messages,
+            'gc_objects_per_message': (
+                float(objects_after - objects_before) / messages),
+            'replies': replies,
+            'memo_skipped_lookups': sum(
+                getattr(proc, 'skipped_lookups', 0)
+                for proc in app.message_processors),
+        })
+
+    return run()
+
+
+def run_benchmark(argv):
+    options = parse_args(argv)
+    os.environ['VUMI_FAKE_REDIS_WAIT'] = str(options.redis_wait)
+
+    from twisted.internet import task
+
+    results = {}
+
+    def collect(r):
+        results.update(r)
+
+    def react_main(reactor):
+        return main(reactor, options).addCallback(collect)
+
+    try:
+        task.react(react_main)
+    except SystemExit as e:
+        if e.code:
+            raise
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmark(sys.argv[1:])
@@ -0,0 +1,204 @@
+"""Benchmark command routing with a large command set.
+
+Compares three ways of finding the command in command text and matching its
+parameters against the handler's pattern, as
+`BotMessageProcessor.handle_command` does:
+
+* `split`: `ParsedMessage` splitting the text on its own, followed by a
+  lookup in the command index.
+* `router`: `CommandRouter`, as used by `BotWorker`.
+* `trie_regex`: one regex compiled from a prefix trie of every command name,
+  which finds the command and strips the parameters in a single match.
+
+Results are reported in microseconds per message as JSON.
+
+Usage::
+
+    python -m benchmarks.bench_commands [--commands N] [--output FILE]
+"""
+
+import json
+import random
+import re
+import sys
+import time
+from optparse import OptionParser
+
+from vumibot.base import ParsedMessage
+from vumibot.commands import CommandRouter
+
+
+def parse_args(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option(
+        "--commands", type="int", default=120,
+        help="Number of registered commands.")
+    parser.add_option(
+        "--messages", type="int", default=100000,
+        help="Number of messages to route for each kind of traffic.")
+    parser.add_option(
+        "--repeat", type="int", default=5,
+        help="Number of runs to take the best time from.")
+    parser.add_option(
+        "--seed", type="int", default=42, help="Random seed for traffic.")
+    parser.add_option(
+        "--output", default=None,
+        help="Write JSON results here instead of stdout.")
+    options, _args = parser.parse_args(argv)
+    return options
+
+
+# The commands we actually have, plus the sorts of things bots grow.
+BASE_COMMANDS = [
+    ('tell', r'(?P<target>\S+)\s+(?P<memo_text>.+)$'),
+    ('ask', r'(?P<target>\S+)\s+(?P<memo_text>.+)$'),
+    ('coffee', r'(?P<target>\S+)\s+(?P<violation_text>.+)$'),
+    ('mycoffee', r'$'),
+    ('ping', r''),
+    ('stats', r'(?P<proc_name>\S*)$'),
+    ('profile', r'(?:(?P<seconds>\d+)(?:\s+(?P<kind>\w+))?|(?P<stop>stop))$'),
+    ('migrate', r'$'),
+    ('reload', r'$'),
+    ('mexican', r'$'),
+]
+COMMAND_STEMS = [
+    'deploy', 'status', 'karma', 'weather', 'remind', 'seen', 'quote',
+    'issue', 'build', 'release', 'oncall', 'lunch',
+]
+COMMAND_SUFFIXES = [
+    '', 'add', 'del', 'list', 'show', 'top', 'stop', 'start', 'log', 'help',
+]
+
+
+def make_commands(count):
+    commands = list(BASE_COMMANDS)
+    for suffix in COMMAND_SUFFIXES:
+        for stem in COMMAND_STEMS:
+            commands.append((stem + suffix, r'(?P<args>.*)$'))
+    if count > len(commands):
+        raise ValueError("At most %d commands." % (len(commands),))
+    return [(name, re.compile(pattern)) for name, pattern in commands[:count]]
+
+
+def make_traffic(commands, count, seed):
+    rnd = random.Random(seed)
+    return {
+        'known': [
+            '%s  nick%d some parameters here ' % (
+                rnd.choice(commands)[0], rnd.randint(0, 50))
+            for _ in range(count)],
+        'unknown': ['frobnicate%d the widgets' % (i % 100,)
+                    for i in range(count)],
+        'prefix_only': [''] * count,
+    }
+
+
+def trie_pattern(names):
+    """Return a regex that matches any of `names`, built from a prefix trie
+    so the regex engine follows one branch per character instead of trying
+    every name in turn.
+    """
+    trie = {}
+    for name in names:
+        node = trie
+        for char in name:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return _trie_node_pattern(trie)
+
+
+def _trie_node_pattern(node):
+    branches = [re.escape(char) + _trie_node_pattern(child)
+                for char, child in sorted(node.iteritems()) if char]
+    optional = '' in node
+    if not branches:
+        return ''
+    if len(branches) == 1 and not optional:
+        return branches[0]
+    return '(?:%s)%s' % ('|'.join(branches), '?' if optional else '')
+
+
+class TrieRegexRouter(object):
+    def __init__(self, command_names):
+        self.pattern = re.compile(
+            r'(%s)(?:\s+(.*\S))?\s*$' % (trie_pattern(command_names),),
+            re.UNICODE | re.DOTALL)
+
+    def route(self, content):
+        if not content:
+            return None
+        match = self.pattern.match(content)
+        if match is None:
+            return None
+        return match.groups('')
+
+
+def route_split(command_index, content):
+    parsed = ParsedMessage(True, content)
+    pattern = command_index.get(parsed.command)
+    if pattern is not None:
+        return pattern.match(parsed.params)
+
+
+def route_router(command_index, router, content):
+    routed = router.route(content)
+    if routed is None:
+        ParsedMessage(True, content, '')
+        return None
+    command, params = routed
+    parsed = ParsedMessage(True, content, command, params)
+    return command_index[parsed.command].match(parsed.params)
+
+
+def time_per_message(func, messages, repeat):
+    """Return the best of `repeat` runs, since the others were slowed down
+    by something else.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for content in messages:
+            func(content)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(messages) * 1e6
+
+
+def run_benchmark(argv):
+    options = parse_args(argv)
+    commands = make_commands(options.commands)
+    command_index = dict(commands)
+    routers = {
+        'router': CommandRouter(command_index),
+        'trie_regex': TrieRegexRouter(command_index),
+    }
+    traffic = make_traffic(commands, options.messages, options.seed)
+
+    results = {
+        'benchmark': 'commands',
+        'commands': len(commands),
+        'messages': options.messages,
+    }
+    for kind, messages in sorted(traffic.iteritems()):
+        results[kind] = {
+            'split_us': time_per_message(
+                lambda content: route_split(command_index, content),
+                messages, options.repeat),
+        }
+        for name, router in sorted(routers.iteritems()):
+            results[kind]['%s_us' % (name,)] = time_per_message(
+                lambda content: route_router(command_index, router, content),
+                messages, options.repeat)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmark(sys.argv[1:])
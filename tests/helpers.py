@@ -52,11 +52,12 @@ class BotMessageProcessorHelper(object):
         yield self.persistence_helper.cleanup()
 
     @inlineCallbacks
-    def get_message_processor(self, config):
+    def get_message_processor(self, config, **worker_config):
         """
         Get an instance of a worker class.
 
         :param config: Config dict.
+        :param \**worker_config: Extra config for the worker.
         :param cls: The Application class to instantiate.
                     Defaults to :attr:`application_class`
         :param start: True to start the application (default), False otherwise.
@@ -68,9 +69,8 @@ class BotMessageProcessorHelper(object):
         """
         cls = self.message_processor_class
         cls_name = '.'.join((cls.__module__, cls.__name__))
-        app_config = self.mk_config({
-            'message_processors': {cls_name: self.mk_config(config)},
-        })
+        worker_config['message_processors'] = {cls_name: config}
+        app_config = self.mk_config(worker_config)
         app_config.setdefault('transport_name', self.msg_helper.transport_name)
         app = yield self.get_worker(BotWorker, app_config)
         [proc] = app.message_processors
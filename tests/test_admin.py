@@ -0,0 +1,142 @@
+import os
+
+import yaml
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.application.tests.helpers import ApplicationHelper
+from vumi.tests.helpers import VumiTestCase
+
+from vumibot.base import BotWorker
+
+
+class TestAdminMessageProcessor(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(BotWorker, 'clock', self.clock)
+        self.profile_dir = self.mktemp()
+        self.app_helper = self.add_helper(ApplicationHelper(BotWorker))
+        self.app = yield self.app_helper.get_application({
+            'stats_sample_rate': 0,
+            'profile_dir': self.profile_dir,
+            'message_processors': {
+                'vumibot.admin.AdminMessageProcessor': {
+                    'admins': ['admin'],
+                },
+                'vumibot.memo.MemoMessageProcessor': {},
+            }})
+
+    def send(self, content, from_addr='nick'):
+        return self.app_helper.make_dispatch_inbound(
+            content, from_addr=from_addr, group='#channel')
+
+    def get_replies_content(self):
+        return [m['content']
+                for m in self.app_helper.get_dispatched_outbound()]
+
+    @inlineCallbacks
+    def test_stats(self):
+        yield self.send('!tell bob hi')
+        self.app_helper.clear_all_dispatched()
+        yield self.send('!stats memomessageprocessor', from_addr='admin')
+        replies = self.get_replies_content()
+        self.assertEqual(
+            [(m['to_addr'], m['group'])
+             for m in self.app_helper.get_dispatched_outbound()],
+            [('admin', None)] * 2)
+        # Whether the !stats message itself has reached the memo processor
+        # yet depends on processor order, so only check the command line.
+        self.assertEqual(len(replies), 2)
+        self.assertTrue(replies[0].startswith(
+            'MemoMessageProcessor (message): calls='))
+        self.assertEqual(
+            replies[1],
+            'MemoMessageProcessor tell: calls=1 errors=0 redis=3 latency=[]')
+
+    @inlineCallbacks
+    def test_stats_unknown_processor(self):
+        yield self.send('!stats nope', from_addr='admin')
+        self.assertEqual(self.get_replies_content(), ['No stats yet.'])
+
+    @inlineCallbacks
+    def test_stats_not_admin(self):
+        yield self.send('!stats')
+        self.assertEqual(
+            self.get_replies_content(), ['Sorry, only admins may do that.'])
+
+    @inlineCallbacks
+    def test_profile_not_admin(self):
+        yield self.send('!profile 10')
+        self.assertEqual(
+            self.get_replies_content(), ['Sorry, only admins may do that.'])
+        self.assertFalse(self.app.profiler.running)
+
+    @inlineCallbacks
+    def test_profile(self):
+        yield self.send('!profile 10', from_addr='admin')
+        [reply] = self.get_replies_content()
+        self.assertTrue(reply.startswith('Profiling for 10 seconds to '))
+        self.assertTrue(self.app.profiler.running)
+        filename = self.app.profiler.filename
+
+        self.clock.advance(10)
+        self.assertFalse(self.app.profiler.running)
+        self.assertTrue(os.path.exists(filename))
+
+    @inlineCallbacks
+    def test_profile_stop(self):
+        yield self.send('!profile stop', from_addr='admin')
+        yield self.send('!profile 10 sample', from_addr='admin')
+        filename = self.app.profiler.filename
+        self.assertTrue(filename.endswith('.folded'))
+        yield self.send('!profile stop', from_addr='admin')
+        self.assertEqual(self.get_replies_content(), [
+            'Not profiling.',
+            'Profiling for 10 seconds to %s.' % (filename,),
+            'Profile written to %s.' % (filename,),
+        ])
+        self.assertTrue(os.path.exists(filename))
+
+    @inlineCallbacks
+    def test_profile_bad_kind(self):
+        yield self.send('!profile 10 nope', from_addr='admin')
+        self.assertEqual(self.get_replies_content(), [
+            "Unknown profiler 'nope'. Choose from: cprofile, sample."])
+
+    @inlineCallbacks
+    def test_migrate(self):
+        memo = [proc for proc in self.app.message_processors
+                if hasattr(proc, 'migrate_records')][0]
+        yield memo.redis.rpush('#channel:bob', '["someone", "hi"]')
+        yield self.send('!migrate')
+        yield self.send('!migrate', from_addr='admin')
+        self.assertEqual(self.get_replies_content(), [
+            'Sorry, only admins may do that.',
+            'MemoMessageProcessor: migrated 1 records.',
+        ])
+
+    @inlineCallbacks
+    def test_reload(self):
+        yield self.send('!reload')
+        yield self.send('!reload', from_addr='admin')
+        self.assertEqual(self.get_replies_content(), [
+            'Sorry, only admins may do that.',
+            'Reload failed: No config_file to reload from.',
+        ])
+
+    @inlineCallbacks
+    def test_reload_from_config_file(self):
+        config_file = self.mktemp()
+        with open(config_file, 'w') as f:
+            yaml.safe_dump({'message_processors': {
+                'vumibot.admin.AdminMessageProcessor': {'admins': ['admin']},
+                'vumibot.misc.MiscMessageProcessor': {},
+            }}, f)
+        self.app.config_file = config_file
+        yield self.send('!reload', from_addr='admin')
+        self.assertEqual(self.get_replies_content(), [
+            'Reloaded. started: MiscMessageProcessor; '
+            'stopped: MemoMessageProcessor; unchanged: AdminMessageProcessor',
+        ])
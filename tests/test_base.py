@@ -1,12 +1,22 @@
+import os
 import re
+import signal
 
-from twisted.internet.defer import inlineCallbacks
+import yaml
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, fail, succeed, Deferred, gatherResults)
+from twisted.internet.task import Clock, deferLater
 
 from vumi.application.tests.helpers import ApplicationHelper
-from vumi.config import ConfigText
+from vumi.config import ConfigInt, ConfigText
 from vumi.tests.helpers import VumiTestCase
 
-from vumibot.base import BotWorker, BotMessageProcessor, botcommand
+from vumi.errors import ConfigError
+
+from vumibot.base import (
+    BotWorker, BotMessageProcessor, IRCNormalizer, ParsedMessage,
+    QueuedDeliveryProcessor, botcommand)
 
 
 class ToyMessageProcessorConfig(BotMessageProcessor.CONFIG_CLASS):
@@ -42,6 +52,102 @@ class ToyMessageProcessor2(BotMessageProcessor):
     cmd_re = re.compile(
         "This has a `pattern` attribute, but is not callable.")
 
+    cmd_toy2_alias = cmd_toy2
+
+
+class RecordingMessageProcessor(BotMessageProcessor):
+    def setup_message_processor(self):
+        self.parsed_messages = []
+
+    def handle_command(self, message, parsed):
+        self.parsed_messages.append(parsed)
+
+    @botcommand
+    def cmd_record(self, message, params):
+        pass
+
+
+class SlowMessageProcessorConfig(ToyMessageProcessorConfig):
+    delay = ConfigInt("Seconds to wait before replying.", static=True)
+
+
+class SlowMessageProcessor(BotMessageProcessor):
+    CONFIG_CLASS = SlowMessageProcessorConfig
+    clock = None
+
+    @botcommand
+    def cmd_slow(self, message, params):
+        return deferLater(self.clock, self.config.delay, self.slow_reply)
+
+    def slow_reply(self):
+        if self.config.reply == 'error':
+            raise ValueError('too slow')
+        return self.config.reply
+
+
+class LifecycleMessageProcessor(SlowMessageProcessor):
+    def setup_message_processor(self):
+        self.running = True
+
+    def teardown_message_processor(self):
+        self.running = False
+
+
+class SlowSetupMessageProcessor(BotMessageProcessor):
+    clock = None
+
+    def setup_message_processor(self):
+        return deferLater(self.clock, 1, lambda: None)
+
+
+class ChattyMessageProcessor(BotMessageProcessor):
+    wants_all_messages = True
+
+    @inlineCallbacks
+    def handle_message(self, message):
+        yield self.reply_to_group(message, 'hello')
+
+    @botcommand
+    def cmd_lines(self, message, params):
+        return ['one', 'two', 'three']
+
+
+class ListeningMessageProcessor(BotMessageProcessor):
+    def setup_message_processor(self):
+        self.heard = []
+
+    def handle_message(self, message):
+        self.heard.append(message['content'])
+
+    @botcommand
+    def cmd_listen(self, message, params):
+        return 'listening'
+
+
+class EavesdroppingMessageProcessor(ListeningMessageProcessor):
+    wants_all_messages = True
+
+
+def make_processor_classes(base_cls, count):
+    """Make `count` distinct subclasses of `base_cls` in this module, since
+    a worker only loads each processor class once."""
+    classes = [
+        type('%s%d' % (base_cls.__name__, i), (base_cls,),
+             {'__module__': __name__})
+        for i in range(count)]
+    globals().update((cls.__name__, cls) for cls in classes)
+    return classes
+
+
+RECORDING_PROCESSORS = make_processor_classes(RecordingMessageProcessor, 8)
+SLOW_PROCESSORS = make_processor_classes(SlowMessageProcessor, 3)
+SLOW_SETUP_PROCESSORS = make_processor_classes(SlowSetupMessageProcessor, 2)
+
+
+class NoteMessageProcessor(QueuedDeliveryProcessor):
+    redis_prefix = 'notes'
+    record_fields = 1
+
 
 def cls_string(cls):
     return '.'.join((cls.__module__, cls.__name__))
@@ -58,6 +164,10 @@ class TestBotWorker(VumiTestCase):
                 cls_string(ToyMessageProcessor2): {'reply': 'bar'},
             }})
 
+    def get_proc(self, cls):
+        [proc] = [p for p in self.app.message_processors if type(p) is cls]
+        return proc
+
     def get_replies_content(self):
         return [m['content']
                 for m in self.app_helper.get_dispatched_outbound()]
@@ -91,6 +201,34 @@ class TestBotWorker(VumiTestCase):
         yield self.make_dispatch_inbound('!')
         self.assertEqual([], self.get_replies_content())
 
+    def test_command_table(self):
+        proc1 = self.get_proc(ToyMessageProcessor1)
+        proc2 = self.get_proc(ToyMessageProcessor2)
+        self.assertEqual(sorted(proc1.commands), ['toy', 'toy1'])
+        self.assertEqual(sorted(proc2.commands), ['toy', 'toy2', 'toy2_alias'])
+        self.assertEqual(proc2.commands['toy2'], proc2.cmd_toy2)
+        self.assertEqual(proc2.commands['toy2_alias'], proc2.cmd_toy2)
+        self.assertEqual(proc1.find_command('callable'), None)
+        self.assertEqual(proc2.find_command('re'), None)
+
+    def test_command_index(self):
+        proc1 = self.get_proc(ToyMessageProcessor1)
+        proc2 = self.get_proc(ToyMessageProcessor2)
+        self.assertEqual(
+            sorted(self.app.command_index),
+            ['toy', 'toy1', 'toy2', 'toy2_alias'])
+        self.assertEqual(
+            self.app.command_index['toy'], self.app.message_processors)
+        self.assertEqual(self.app.command_index['toy1'], [proc1])
+        self.assertEqual(self.app.find_command_processors('toy2'), [proc2])
+        self.assertEqual(self.app.find_command_processors('nope'), ())
+        self.assertEqual(self.app.find_command_processors(''), ())
+
+    @inlineCallbacks
+    def test_alias(self):
+        yield self.make_dispatch_inbound('!toy2_alias')
+        self.assertEqual(['bar'], self.get_replies_content())
+
     @inlineCallbacks
     def test_directed_commands(self):
         # Group-directed.
@@ -101,3 +239,890 @@ class TestBotWorker(VumiTestCase):
         self.app_helper.clear_all_dispatched()
         yield self.make_dispatch_inbound('toy1', to_addr='bot', group=None)
         self.assertEqual(['foo'], self.get_replies_content())
+
+
+class TestParsedMessage(VumiTestCase):
+
+    def test_command(self):
+        parsed = ParsedMessage(True, 'tell  foo   bar baz ')
+        self.assertEqual(parsed.is_command, True)
+        self.assertEqual(parsed.content, 'tell  foo   bar baz ')
+        self.assertEqual(parsed.command, 'tell')
+        self.assertEqual(parsed.params, 'foo   bar baz')
+
+    def test_empty(self):
+        parsed = ParsedMessage(True, '')
+        self.assertEqual(parsed.command, '')
+        self.assertEqual(parsed.params, '')
+
+    def test_slots(self):
+        parsed = ParsedMessage(False, 'chatter')
+        self.assertFalse(hasattr(parsed, '__dict__'))
+
+
+class TestIRCNormalizer(VumiTestCase):
+
+    def test_rfc1459(self):
+        normalizer = IRCNormalizer()
+        self.assertEqual(normalizer.normalize(u'Bob[Away]\\~'), u'bob{away}|^')
+        self.assertEqual(normalizer.normalize('#Vumi'), '#vumi')
+        self.assertEqual(normalizer.normalize(None), None)
+
+    def test_strict_rfc1459(self):
+        normalizer = IRCNormalizer('strict-rfc1459')
+        self.assertEqual(normalizer.normalize(u'Bob[]\\~'), u'bob{}|~')
+
+    def test_ascii(self):
+        normalizer = IRCNormalizer('ascii')
+        self.assertEqual(normalizer.normalize(u'Bob[]'), u'bob[]')
+
+    def test_only_ascii_letters_folded(self):
+        normalizer = IRCNormalizer()
+        self.assertEqual(normalizer.normalize(u'\xc9MILE'), u'\xc9mile')
+
+    def test_unknown_casemapping(self):
+        self.assertRaises(ConfigError, IRCNormalizer, 'klingon')
+
+    def test_lru_cache(self):
+        normalizer = IRCNormalizer(cache_size=2)
+        normalizer.normalize(u'A')
+        normalizer.normalize(u'B')
+        normalizer.normalize(u'A')
+        normalizer.normalize(u'C')
+        self.assertEqual(normalizer._cache.keys(), [u'A', u'C'])
+
+    @inlineCallbacks
+    def test_worker_casemapping(self):
+        app_helper = self.add_helper(ApplicationHelper(BotWorker))
+        app = yield app_helper.get_application({
+            'casemapping': 'ascii',
+            'message_processors': {cls_string(ToyMessageProcessor1): {}},
+        })
+        [proc] = app.message_processors
+        self.assertEqual(proc.normalize(u'Bob[]'), u'bob[]')
+
+
+class TestParseOnce(VumiTestCase):
+
+    def setUp(self):
+        self.app_helper = self.add_helper(ApplicationHelper(BotWorker))
+
+    @inlineCallbacks
+    def get_app(self, proc_classes):
+        app = yield self.app_helper.get_application({
+            'message_processors': dict(
+                (cls_string(cls), {}) for cls in proc_classes)})
+        parse_user_message = app.parse_user_message
+        app.parse_count = 0
+
+        def counting_parse(message):
+            app.parse_count += 1
+            return parse_user_message(message)
+
+        app.parse_user_message = counting_parse
+        returnValue(app)
+
+    @inlineCallbacks
+    def assert_parsed_once(self, proc_classes, messages=10):
+        app = yield self.get_app(proc_classes)
+        for i in range(messages):
+            yield self.app_helper.make_dispatch_inbound(
+                '!record %s' % (i,), from_addr='nick', group='#channel')
+
+        self.assertEqual(app.parse_count, messages)
+        [first_proc] = app.message_processors[:1]
+        self.assertEqual(len(first_proc.parsed_messages), messages)
+        for proc in app.message_processors:
+            # ParsedMessage has no __eq__, so this compares identity.
+            self.assertEqual(
+                proc.parsed_messages, first_proc.parsed_messages)
+
+    def test_one_processor(self):
+        return self.assert_parsed_once(RECORDING_PROCESSORS[:1])
+
+    def test_many_processors(self):
+        return self.assert_parsed_once(RECORDING_PROCESSORS)
+
+
+class TestChatterRouting(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.app_helper = self.add_helper(ApplicationHelper(BotWorker))
+        self.app = yield self.app_helper.get_application({
+            'message_processors': {
+                cls_string(ListeningMessageProcessor): {},
+                cls_string(EavesdroppingMessageProcessor): {},
+                cls_string(ToyMessageProcessor1): {'reply': 'foo'},
+            }})
+
+    def get_proc(self, cls):
+        [proc] = [p for p in self.app.message_processors if type(p) is cls]
+        return proc
+
+    def send(self, content):
+        return self.app_helper.make_dispatch_inbound(
+            content, from_addr='nick', group='#channel', to_addr=None)
+
+    def test_chatter_processors(self):
+        self.assertEqual(
+            self.app.chatter_processors,
+            [self.get_proc(EavesdroppingMessageProcessor)])
+
+    @inlineCallbacks
+    def test_chatter_only_seen_by_processors_that_want_it(self):
+        yield self.send('just chatting')
+        yield self.send('!toy')
+        self.assertEqual(
+            self.get_proc(EavesdroppingMessageProcessor).heard,
+            ['just chatting', '!toy'])
+        self.assertEqual(self.get_proc(ListeningMessageProcessor).heard, [])
+        self.assertEqual(
+            self.app.stats.format_lines('ListeningMessageProcessor'), [])
+
+    @inlineCallbacks
+    def test_commands_still_handled(self):
+        yield self.send('!listen')
+        self.assertEqual(
+            [m['content'] for m in self.app_helper.get_dispatched_outbound()],
+            ['listening', 'listening'])
+        self.assertEqual(self.get_proc(ListeningMessageProcessor).heard, [])
+
+    @inlineCallbacks
+    def test_reload_updates_chatter_processors(self):
+        yield self.app.reload_processors({
+            cls_string(ListeningMessageProcessor): {},
+        })
+        self.assertEqual(self.app.chatter_processors, [])
+        yield self.send('just chatting')
+        self.assertEqual(self.app_helper.get_dispatched_outbound(), [])
+
+
+class TestConcurrentProcessors(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SlowMessageProcessor, 'clock', self.clock)
+        self.app_helper = self.add_helper(ApplicationHelper(BotWorker))
+
+    def get_app(self, concurrent, replies=('one', 'two', 'three')):
+        return self.app_helper.get_application({
+            'concurrent_processors': concurrent,
+            'message_processors': dict(
+                (cls_string(cls), {'reply': reply, 'delay': delay})
+                for cls, reply, delay in zip(
+                    SLOW_PROCESSORS, replies, [3, 2, 1])),
+        })
+
+    @inlineCallbacks
+    def consume_slow(self, app):
+        msg = self.app_helper.make_inbound(
+            '!slow', from_addr='nick', group='#channel')
+        d = app.consume_user_message(msg)
+        elapsed = 0
+        while not d.called:
+            self.clock.advance(1)
+            elapsed += 1
+        yield d
+        yield self.app_helper.kick_delivery()
+        returnValue(elapsed)
+
+    def get_replies_content(self):
+        return [m['content']
+                for m in self.app_helper.get_dispatched_outbound()]
+
+    def expected_replies(self, app):
+        return [proc.config.reply for proc in app.message_processors]
+
+    @inlineCallbacks
+    def test_sequential(self):
+        app = yield self.get_app(concurrent=False)
+        elapsed = yield self.consume_slow(app)
+        self.assertEqual(elapsed, 6)
+        self.assertEqual(
+            self.expected_replies(app), self.get_replies_content())
+
+    @inlineCallbacks
+    def test_concurrent(self):
+        app = yield self.get_app(concurrent=True)
+        elapsed = yield self.consume_slow(app)
+        self.assertEqual(elapsed, 3)
+        self.assertEqual(
+            self.expected_replies(app), self.get_replies_content())
+
+    @inlineCallbacks
+    def test_concurrent_error(self):
+        app = yield self.get_app(
+            concurrent=True, replies=('one', 'error', 'three'))
+        elapsed = yield self.consume_slow(app)
+        self.assertEqual(elapsed, 3)
+        [err] = self.flushLoggedErrors(ValueError)
+        expected = [
+            'eep! ValueError: too slow.' if reply == 'error' else reply
+            for reply in self.expected_replies(app)]
+        self.assertEqual(expected, self.get_replies_content())
+
+
+class TestInFlightLimit(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SlowMessageProcessor, 'clock', self.clock)
+        self.app_helper = self.add_helper(ApplicationHelper(BotWorker))
+
+    def get_app(self, max_in_flight):
+        return self.app_helper.get_application({
+            'max_in_flight': max_in_flight,
+            'message_processors': {
+                cls_string(SLOW_PROCESSORS[0]): {'reply': 'ok', 'delay': 1},
+            },
+        })
+
+    def dispatch_slow(self, app):
+        return app.dispatch_user_message(self.app_helper.make_inbound(
+            '!slow', from_addr='nick', group='#channel'))
+
+    def consume_slow(self, app, count):
+        """Dispatch `count` messages the way the transport consumer does,
+        each once the previous one has been dispatched. Returns a list that
+        each message is added to as it is dispatched.
+        """
+        dispatched = []
+        d = succeed(None)
+        for i in range(count):
+            d.addCallback(lambda _: self.dispatch_slow(app))
+            d.addCallback(lambda _, i=i: dispatched.append(i))
+        return dispatched
+
+    @inlineCallbacks
+    def test_unlimited(self):
+        app = yield self.get_app(0)
+        d = self.dispatch_slow(app)
+        self.assertFalse(d.called)
+        self.assertEqual(app.in_flight_count, 0)
+        self.assertFalse(app.paused)
+        self.clock.advance(1)
+        yield d
+
+    @inlineCallbacks
+    def test_limit(self):
+        app = yield self.get_app(2)
+        dispatched = self.consume_slow(app, 4)
+        # The third message waits for a slot, and the fourth isn't read.
+        self.assertEqual(dispatched, [0, 1])
+        self.assertEqual(app.in_flight_count, 2)
+        self.assertTrue(app.paused)
+
+        self.clock.advance(1)
+        self.assertEqual(dispatched, [0, 1, 2, 3])
+        self.assertEqual(app.in_flight_count, 2)
+        self.assertFalse(app.paused)
+
+        self.clock.advance(1)
+        self.assertEqual(app.in_flight_count, 0)
+        yield self.app_helper.kick_delivery()
+        self.assertEqual(
+            ['ok'] * 4, [m['content']
+                         for m in self.app_helper.get_dispatched_outbound()])
+
+    @inlineCallbacks
+    def test_teardown_waits_for_in_flight(self):
+        app = yield self.get_app(2)
+        self.dispatch_slow(app)
+        d = app.teardown_application()
+        self.assertFalse(d.called)
+        self.assertEqual(len(app.message_processors), 1)
+        self.clock.advance(1)
+        yield d
+        self.assertEqual(app.message_processors, [])
+
+
+class TestOutboundBatching(VumiTestCase):
+
+    def setUp(self):
+        self.app_helper = self.add_helper(ApplicationHelper(BotWorker))
+
+    def get_app(self, **config):
+        config['message_processors'] = {
+            cls_string(ChattyMessageProcessor): {},
+        }
+        return self.app_helper.get_application(config)
+
+    def get_replies(self):
+        return [(m['to_addr'], m['content'])
+                for m in self.app_helper.get_dispatched_outbound()]
+
+    @inlineCallbacks
+    def test_batched_replies(self):
+        app = yield self.get_app()
+        published = []
+        publish_message = app._publish_message
+
+        def recording_publish(msg, endpoint_name=None):
+            published.append(msg['content'])
+            return publish_message(msg, endpoint_name=endpoint_name)
+
+        self.patch(app, '_publish_message', recording_publish)
+        msg = self.app_helper.make_inbound(
+            '!lines', from_addr='nick', group='#channel')
+        yield app.consume_user_message(msg)
+        self.assertEqual(published, ['hello', 'one', 'two', 'three'])
+        self.assertEqual(app._outbound_batches, {})
+
+        yield self.app_helper.kick_delivery()
+        self.assertEqual(self.get_replies(), [
+            (None, 'hello'),
+            ('nick', 'one'),
+            ('nick', 'two'),
+            ('nick', 'three'),
+        ])
+
+    @inlineCallbacks
+    def test_merged_replies(self):
+        yield self.get_app(merge_replies_max_bytes=12)
+        yield self.app_helper.make_dispatch_inbound(
+            '!lines', from_addr='nick', group='#channel')
+        self.assertEqual(self.get_replies(), [
+            (None, 'hello'),
+            ('nick', 'one | two'),
+            ('nick', 'three'),
+        ])
+
+    @inlineCallbacks
+    def test_merged_replies_separator(self):
+        yield self.get_app(
+            merge_replies_max_bytes=100, merge_replies_separator=u' / ')
+        yield self.app_helper.make_dispatch_inbound(
+            '!lines', from_addr='nick', group='#channel')
+        self.assertEqual(self.get_replies(), [
+            (None, 'hello'),
+            ('nick', 'one / two / three'),
+        ])
+
+
+class TestSharedRedis(VumiTestCase):
+
+    def setUp(self):
+        self.app_helper = self.add_helper(ApplicationHelper(BotWorker))
+
+    @inlineCallbacks
+    def test_no_redis_processors(self):
+        app = yield self.app_helper.get_application({
+            'message_processors': {
+                cls_string(ToyMessageProcessor1): {'reply': 'foo'},
+            }})
+        self.assertEqual(app.redis, None)
+
+    @inlineCallbacks
+    def test_shared_connection(self):
+        app = yield self.app_helper.get_application({
+            'message_processors': {
+                'vumibot.memo.MemoMessageProcessor': {},
+                'vumibot.coffee.CoffeeMessageProcessor': {},
+            }})
+        memo, coffee = sorted(
+            app.message_processors, key=lambda p: type(p).__name__,
+            reverse=True)
+        self.assertEqual(memo.redis._key_prefix, 'vumitest:ircbot:memo')
+        self.assertEqual(coffee.redis._key_prefix, 'vumitest:ircbot:coffee')
+        self.assertIdentical(memo.redis._client, app.redis._client)
+        self.assertIdentical(coffee.redis._client, app.redis._client)
+
+        yield app.teardown_application()
+        self.assertEqual(app.redis, None)
+
+
+class TestReloadProcessors(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SlowMessageProcessor, 'clock', self.clock)
+        self.app_helper = self.add_helper(ApplicationHelper(BotWorker))
+
+    def processors_config(self, slow_reply, **extra):
+        config = {
+            cls_string(LifecycleMessageProcessor): {
+                'reply': slow_reply, 'delay': 1},
+            cls_string(ToyMessageProcessor1): {'reply': 'foo'},
+        }
+        config.update(extra)
+        return config
+
+    def get_app(self, **config):
+        config.setdefault('message_processors', self.processors_config('old'))
+        return self.app_helper.get_application(config)
+
+    def get_proc(self, app, cls):
+        [proc] = [p for p in app.message_processors if isinstance(p, cls)]
+        return proc
+
+    def dispatch(self, app, content):
+        msg = self.app_helper.make_inbound(
+            content, from_addr='nick', group='#channel')
+        return app.dispatch_user_message(msg)
+
+    @inlineCallbacks
+    def get_replies(self):
+        yield self.app_helper.kick_delivery()
+        returnValue([
+            msg['content']
+            for msg in self.app_helper.get_dispatched_outbound()])
+
+    @inlineCallbacks
+    def test_reload(self):
+        app = yield self.get_app()
+        old_slow = self.get_proc(app, LifecycleMessageProcessor)
+        toy1 = self.get_proc(app, ToyMessageProcessor1)
+        in_flight = self.dispatch(app, '!slow')
+
+        result = yield app.reload_processors(self.processors_config(
+            'new', **{cls_string(ToyMessageProcessor2): {'reply': 'bar'}}))
+        self.assertEqual(result, {
+            'started': sorted([
+                cls_string(LifecycleMessageProcessor),
+                cls_string(ToyMessageProcessor2)]),
+            'stopped': [cls_string(LifecycleMessageProcessor)],
+            'unchanged': [cls_string(ToyMessageProcessor1)],
+        })
+        new_slow = self.get_proc(app, LifecycleMessageProcessor)
+        toy2 = self.get_proc(app, ToyMessageProcessor2)
+        self.assertNotIdentical(new_slow, old_slow)
+        self.assertIdentical(self.get_proc(app, ToyMessageProcessor1), toy1)
+        self.assertEqual(app.find_command_processors('toy2'), [toy2])
+        self.assertEqual(app.find_command_processors('slow'), [new_slow])
+
+        # The message in flight finishes with the old processor, which is
+        # only torn down afterwards.
+        self.assertTrue(old_slow.running)
+        self.clock.advance(1)
+        yield in_flight
+        self.assertFalse(old_slow.running)
+        self.assertTrue(new_slow.running)
+        self.assertEqual((yield self.get_replies()), ['old'])
+
+        d = self.dispatch(app, '!slow')
+        self.clock.advance(1)
+        yield d
+        self.assertEqual((yield self.get_replies()), ['old', 'new'])
+
+    @inlineCallbacks
+    def test_reload_queued_processor(self):
+        self.patch(BotWorker, 'clock', self.clock)
+        note = cls_string(NoteMessageProcessor)
+        app = yield self.get_app(message_processors=self.processors_config(
+            'old', **{note: {'write_behind_interval': 30}}))
+        old_note = self.get_proc(app, NoteMessageProcessor)
+        yield old_note.store_record('#chan', 'bob', ['buffered'])
+        in_flight = self.dispatch(app, '!slow')
+
+        yield app.reload_processors(self.processors_config(
+            'old', **{note: {'write_behind_interval': 20}}))
+        new_note = self.get_proc(app, NoteMessageProcessor)
+        self.assertNotIdentical(new_note, old_note)
+        self.assertTrue(new_note.has_pending('#chan', 'bob'))
+
+        # A message still in flight stores a record with the old processor,
+        # while a new one stores one with its replacement.
+        yield old_note.store_record('#chan', 'alice', ['late'])
+        yield new_note.store_record('#chan', 'carol', ['new'])
+        self.clock.advance(1)
+        yield in_flight
+        yield gatherResults(list(app._retiring))
+        self.assertTrue(new_note.has_pending('#chan', 'alice'))
+        records = yield new_note.retrieve_records('#chan', 'alice')
+        self.assertEqual(records, [['late']])
+        self.assertTrue(new_note.has_pending('#chan', 'carol'))
+        records = yield new_note.retrieve_records('#chan', 'carol')
+        self.assertEqual(records, [['new']])
+
+    @inlineCallbacks
+    def test_reload_removes_processor(self):
+        app = yield self.get_app()
+        toy1 = self.get_proc(app, ToyMessageProcessor1)
+        result = yield app.reload_processors({
+            cls_string(ToyMessageProcessor1): {'reply': 'foo'},
+        })
+        self.assertEqual(result['stopped'], [
+            cls_string(LifecycleMessageProcessor)])
+        self.assertEqual(app.message_processors, [toy1])
+        self.assertEqual(app.find_command_processors('slow'), ())
+
+    @inlineCallbacks
+    def test_reload_failure(self):
+        app = yield self.get_app()
+        procs = list(app.message_processors)
+        config = self.processors_config(
+            'new', **{'tests.test_base.NoSuchProcessor': {}})
+        yield self.assertFailure(app.reload_processors(config), Exception)
+        self.assertEqual(app.message_processors, procs)
+        self.assertTrue(all(
+            getattr(proc, 'running', True) for proc in procs))
+
+    @inlineCallbacks
+    def test_reload_from_config_file(self):
+        config_file = self.mktemp()
+        with open(config_file, 'w') as f:
+            yaml.safe_dump({
+                'message_processors': self.processors_config('new'),
+            }, f)
+        app = yield self.get_app(config_file=config_file)
+        self.assertEqual(signal.getsignal(signal.SIGHUP), app._sighup)
+
+        result = yield app.reload_processors()
+        self.assertEqual(
+            result['stopped'], [cls_string(LifecycleMessageProcessor)])
+        self.assertEqual(
+            self.get_proc(app, LifecycleMessageProcessor).config.reply, 'new')
+
+    @inlineCallbacks
+    def test_reload_without_config_file(self):
+        app = yield self.get_app()
+        yield self.assertFailure(app.reload_processors(), ConfigError)
+
+
+class TestProcessorSetup(VumiTestCase):
+
+    def setUp(self):
+        self.app_helper = self.add_helper(ApplicationHelper(BotWorker))
+
+    @inlineCallbacks
+    def test_concurrent_setup(self):
+        clock = Clock()
+        self.patch(SlowSetupMessageProcessor, 'clock', clock)
+        names = [cls_string(cls) for cls in SLOW_SETUP_PROCESSORS]
+        d = self.app_helper.get_application({
+            'message_processors': dict((name, {}) for name in names),
+        })
+        clock.advance(1)
+        app = yield d
+        self.assertEqual(len(app.message_processors), 2)
+        self.assertEqual(sorted(app.setup_times), sorted(names))
+
+    @inlineCallbacks
+    def test_lazy_processor(self):
+        app = yield self.app_helper.get_application({
+            'message_processors': {
+                cls_string(ToyMessageProcessor1): {'reply': 'foo'},
+                cls_string(ToyMessageProcessor2): {'reply': 'bar'},
+            },
+            'lazy_processors': {
+                cls_string(ToyMessageProcessor2): ['toy2', 'toy2_alias'],
+            }})
+        [toy1] = app.message_processors
+        self.assertEqual(app.lazy_commands, {
+            'toy2': cls_string(ToyMessageProcessor2),
+            'toy2_alias': cls_string(ToyMessageProcessor2),
+        })
+
+        yield self.app_helper.make_dispatch_inbound('!toy', from_addr='nick')
+        self.assertEqual([toy1], app.message_processors)
+
+        yield self.app_helper.make_dispatch_inbound(
+            '!toy2', from_addr='nick')
+        [_, toy2] = app.message_processors
+        self.assertTrue(isinstance(toy2, ToyMessageProcessor2))
+        self.assertEqual(app.lazy_commands, {})
+        self.assertEqual(app.find_command_processors('toy'), [toy1, toy2])
+        self.assertEqual(
+            [msg['content']
+             for msg in self.app_helper.get_dispatched_outbound()],
+            ['foo', 'bar'])
+
+    @inlineCallbacks
+    def test_reload_keeps_lazy_processor(self):
+        processors = {
+            cls_string(ToyMessageProcessor1): {'reply': 'foo'},
+            cls_string(ToyMessageProcessor2): {'reply': 'bar'},
+        }
+        app = yield self.app_helper.get_application({
+            'message_processors': processors,
+            'lazy_processors': {cls_string(ToyMessageProcessor2): ['toy2']},
+        })
+        processors[cls_string(ToyMessageProcessor2)] = {'reply': 'baz'}
+        result = yield app.reload_processors(processors)
+        self.assertEqual(result, {
+            'started': [],
+            'stopped': [],
+            'unchanged': [cls_string(ToyMessageProcessor1)],
+        })
+        self.assertEqual(len(app.message_processors), 1)
+        self.assertEqual(
+            app.lazy_processors,
+            {cls_string(ToyMessageProcessor2): {'reply': 'baz'}})
+
+    @inlineCallbacks
+    def test_unknown_lazy_processor(self):
+        yield self.assertFailure(self.app_helper.get_application({
+            'message_processors': {},
+            'lazy_processors': {cls_string(ToyMessageProcessor2): ['toy2']},
+        }), ConfigError)
+
+
+class TestQueuedDeliveryProcessor(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.patch(BotWorker, 'clock', self.clock)
+        self.app_helper = self.add_helper(ApplicationHelper(BotWorker))
+        app = yield self.app_helper.get_application({
+            'message_processors': {
+                cls_string(NoteMessageProcessor): {'max_queued': 2},
+            }})
+        [self.proc] = app.message_processors
+
+    @inlineCallbacks
+    def test_store_and_retrieve(self):
+        yield self.proc.store_record('#Chan', 'Bob', ['one'])
+        yield self.proc.store_record('#chan', 'bob', ['two'])
+        yield self.proc.store_record('#chan', 'bob', ['three'])
+        self.assertTrue(self.proc.has_pending('#chan', 'BOB'))
+        self.assertEqual(self.proc.get_pending_channels('bob'), ['#chan'])
+
+        records = yield self.proc.retrieve_records('#chan', 'bob')
+        self.assertEqual(records, [['two'], ['three']])
+        [value, _] = yield self.proc.redis.lrange('#chan:bob', 0, -1)
+        self.assertEqual(self.proc.codec.decode(value), ['two', '1000'])
+
+        records = yield self.proc.retrieve_records(
+            '#chan', 'bob', delete=True)
+        self.assertEqual(records, [['two'], ['three']])
+        self.assertFalse(self.proc.has_pending('#chan', 'bob'))
+        records = yield self.proc.retrieve_records('#chan', 'bob')
+        self.assertEqual(records, [])
+
+    @inlineCallbacks
+    def test_deliver_records(self):
+        self.proc.config = self.proc.CONFIG_CLASS({
+            'max_queued': 0, 'delivery_chunk_size': 2, 'max_delivered': 3})
+        for i in range(5):
+            yield self.proc.store_record('#chan', 'bob', [str(i)])
+        delivered = []
+
+        remaining = yield self.proc.deliver_records(
+            '#chan', 'bob', delivered.append)
+        self.assertEqual(remaining, 2)
+        self.assertEqual(delivered, [['0'], ['1'], ['2']])
+        self.assertTrue(self.proc.has_pending('#chan', 'bob'))
+
+        remaining = yield self.proc.deliver_records(
+            '#chan', 'bob', delivered.append)
+        self.assertEqual(remaining, 0)
+        self.assertEqual(delivered, [['0'], ['1'], ['2'], ['3'], ['4']])
+        self.assertFalse(self.proc.has_pending('#chan', 'bob'))
+
+    @inlineCallbacks
+    def test_store_during_delivery(self):
+        yield self.proc.store_record('#chan', 'bob', ['first'])
+        delivering = Deferred()
+        delivered = []
+
+        def deliver(record):
+            delivered.append(record)
+            return delivering
+
+        d = self.proc.deliver_records('#chan', 'bob', deliver)
+        yield self.proc.store_record('#chan', 'bob', ['second'])
+        delivering.callback(None)
+        remaining = yield d
+        self.assertEqual(remaining, 1)
+        self.assertEqual(delivered, [['first']])
+        self.assertTrue(self.proc.has_pending('#chan', 'bob'))
+        pending = yield self.proc.redis.smembers('pending')
+        self.assertEqual(pending, set(['["#chan", "bob"]']))
+        records = yield self.proc.retrieve_records('#chan', 'bob')
+        self.assertEqual(records, [['second']])
+
+    @inlineCallbacks
+    def test_zero_delivery_chunk_size(self):
+        yield self.assertFailure(self.app_helper.get_application({
+            'message_processors': {
+                cls_string(NoteMessageProcessor): {'delivery_chunk_size': 0},
+            }}), ConfigError)
+
+    @inlineCallbacks
+    def test_expiry(self):
+        yield self.proc.store_record('#chan', 'bob', ['old'])
+        self.clock.advance(self.proc.config.queue_ttl)
+        yield self.proc.store_record('#chan', 'bob', ['new'])
+        self.clock.advance(1)
+        removed = yield self.proc.sweep_expired()
+        self.assertEqual(removed, 1)
+        records = yield self.proc.retrieve_records('#chan', 'bob')
+        self.assertEqual(records, [['new']])
+
+
+class TestWriteBehind(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.patch(BotWorker, 'clock', self.clock)
+        self.app_helper = self.add_helper(ApplicationHelper(BotWorker))
+        self.spill_file = self.mktemp()
+        self.proc = yield self.get_proc(spill_file=self.spill_file)
+
+    @inlineCallbacks
+    def get_proc(self, **config):
+        config.setdefault('write_behind_interval', 0.01)
+        config.setdefault('write_behind_max_records', 3)
+        app = yield self.app_helper.get_application({
+            'message_processors': {cls_string(NoteMessageProcessor): config},
+        })
+        [proc] = app.message_processors
+        returnValue(proc)
+
+    def break_redis(self, proc):
+        """Make writes to Redis fail until the returned function is called.
+        """
+        rpush = proc.redis.rpush
+        broken = [True]
+
+        def broken_rpush(*args):
+            if broken:
+                return fail(Exception("Redis is down."))
+            return rpush(*args)
+
+        self.patch(proc.redis, 'rpush', broken_rpush)
+        return broken.pop
+
+    def get_values(self, key='#chan:bob', proc=None):
+        proc = proc or self.proc
+        d = proc.redis.lrange(key, 0, -1)
+        return d.addCallback(
+            lambda values: [proc.codec.decode(v)[0] for v in values])
+
+    @inlineCallbacks
+    def test_buffered_until_interval(self):
+        yield self.proc.store_record('#chan', 'bob', ['one'])
+        yield self.proc.store_record('#chan', 'bob', ['two'])
+        self.assertTrue(self.proc.has_pending('#chan', 'bob'))
+        values = yield self.get_values()
+        self.assertEqual(values, [])
+
+        self.clock.advance(0.01)
+        yield self.proc.flush_writes()
+        values = yield self.get_values()
+        self.assertEqual(values, ['one', 'two'])
+        pending = yield self.proc.redis.smembers('pending')
+        self.assertEqual(pending, set(['["#chan", "bob"]']))
+
+    @inlineCallbacks
+    def test_written_when_buffer_full(self):
+        for i in range(3):
+            yield self.proc.store_record('#chan', 'bob', [str(i)])
+        self.assertEqual(self.proc._flush_call, None)
+        yield self.proc.flush_writes()
+        values = yield self.get_values()
+        self.assertEqual(values, ['0', '1', '2'])
+
+    @inlineCallbacks
+    def test_reads_see_buffered_records(self):
+        yield self.proc.store_record('#chan', 'bob', ['one'])
+        records = yield self.proc.retrieve_records('#chan', 'bob')
+        self.assertEqual(records, [['one']])
+
+        yield self.proc.store_record('#chan', 'bob', ['two'])
+        delivered = []
+        yield self.proc.deliver_records('#chan', 'bob', delivered.append)
+        self.assertEqual(delivered, [['one'], ['two']])
+
+    @inlineCallbacks
+    def test_buffered_store_during_delivery(self):
+        yield self.proc.store_record('#chan', 'bob', ['first'])
+        delivering = Deferred()
+        d = self.proc.deliver_records('#chan', 'bob', lambda r: delivering)
+        yield self.proc.store_record('#chan', 'bob', ['second'])
+        delivering.callback(None)
+        remaining = yield d
+        self.assertEqual(remaining, 1)
+        self.assertTrue(self.proc.has_pending('#chan', 'bob'))
+        values = yield self.get_values()
+        self.assertEqual(values, ['second'])
+
+    @inlineCallbacks
+    def test_teardown_writes_buffer(self):
+        yield self.proc.store_record('#chan', 'bob', ['one'])
+        yield self.proc.teardown_message_processor()
+        values = yield self.get_values()
+        self.assertEqual(values, ['one'])
+
+    @inlineCallbacks
+    def test_spill_and_replay(self):
+        fix_redis = self.break_redis(self.proc)
+        yield self.proc.store_record('#chan', 'bob', ['one'])
+        yield self.proc.store_record('#chan', 'alice', ['two'])
+        yield self.proc.flush_writes()
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+        with open(self.spill_file) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        self.assertEqual(self.proc._write_buffer, [])
+
+        fix_redis()
+        yield self.proc.store_record('#chan', 'bob', ['three'])
+        yield self.proc.flush_writes()
+        self.assertFalse(os.path.exists(self.spill_file))
+        values = yield self.get_values()
+        self.assertEqual(values, ['one', 'three'])
+        values = yield self.get_values('#chan:alice')
+        self.assertEqual(values, ['two'])
+
+    @inlineCallbacks
+    def test_reads_replay_spill_file(self):
+        fix_redis = self.break_redis(self.proc)
+        yield self.proc.store_record('#chan', 'bob', ['one'])
+        yield self.proc.flush_writes()
+        self.flushLoggedErrors()
+
+        fix_redis()
+        delivered = []
+        remaining = yield self.proc.deliver_records(
+            '#chan', 'bob', delivered.append)
+        self.assertEqual(delivered, [['one']])
+        self.assertEqual(remaining, 0)
+        self.assertFalse(os.path.exists(self.spill_file))
+
+    @inlineCallbacks
+    def test_replay_indexes_spilled_records(self):
+        fix_redis = self.break_redis(self.proc)
+        yield self.proc.store_record('#chan', 'bob', ['one'])
+        yield self.proc.flush_writes()
+        self.flushLoggedErrors()
+        # As if a delivery found the queue empty in the meantime.
+        self.proc._unindex_pending('#chan', 'bob')
+
+        fix_redis()
+        yield self.proc.flush_writes()
+        self.assertTrue(self.proc.has_pending('#chan', 'bob'))
+
+    @inlineCallbacks
+    def test_replay_on_startup(self):
+        self.break_redis(self.proc)
+        yield self.proc.store_record('#chan', 'bob', ['one'])
+        yield self.proc.flush_writes()
+        self.flushLoggedErrors()
+
+        proc = yield self.get_proc(spill_file=self.spill_file)
+        self.assertFalse(os.path.exists(self.spill_file))
+        self.assertTrue(proc.has_pending('#chan', 'bob'))
+        values = yield self.get_values(proc=proc)
+        self.assertEqual(values, ['one'])
+
+    @inlineCallbacks
+    def test_retry_without_spill_file(self):
+        proc = yield self.get_proc()
+        fix_redis = self.break_redis(proc)
+        yield proc.store_record('#chan', 'bob', ['one'])
+        yield proc.flush_writes()
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+        self.assertEqual(len(proc._write_buffer), 1)
+        self.assertTrue(proc._flush_call.active())
+
+        fix_redis()
+        self.clock.advance(0.01)
+        yield proc.flush_writes()
+        self.assertEqual(proc._write_buffer, [])
+        values = yield self.get_values(proc=proc)
+        self.assertEqual(values, ['one'])
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Tests for vumibot.codec."""
+
+from twisted.internet.defer import fail, inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from vumi.errors import ConfigError
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vumibot.base import migrate_list, migrate_lists
+from vumibot.codec import CompactCodec, JSONCodec, decode_record, get_codec
+from vumibot.storage import RedisStore
+
+
+class TestCodecs(TestCase):
+
+    def test_compact_round_trip(self):
+        codec = CompactCodec()
+        data = codec.encode([u'sender', u'caf\xe9 ☃'])
+        self.assertEqual(data[0], '\x01')
+        self.assertEqual(codec.decode(data), [u'sender', u'caf\xe9 ☃'])
+
+    def test_compact_long_field(self):
+        codec = CompactCodec()
+        text = u'x' * 1000
+        self.assertEqual(codec.decode(codec.encode(['a', text, ''])),
+                         [u'a', text, u''])
+
+    def test_compact_is_smaller(self):
+        fields = [u'sender', u'some "quoted" text ☃']
+        self.assertTrue(
+            len(CompactCodec().encode(fields)) <
+            len(JSONCodec().encode(fields)))
+
+    def test_reads_json(self):
+        for codec in [CompactCodec(), JSONCodec()]:
+            self.assertEqual(
+                codec.decode('["sender", "text"]'), [u'sender', u'text'])
+
+    def test_decode_record(self):
+        self.assertEqual(
+            decode_record(CompactCodec().encode(['a', 'b'])), [u'a', u'b'])
+        self.assertEqual(
+            decode_record(JSONCodec().encode(['a', 'b'])), [u'a', u'b'])
+
+    def test_get_codec(self):
+        self.assertTrue(isinstance(get_codec('compact'), CompactCodec))
+        self.assertTrue(isinstance(get_codec('json'), JSONCodec))
+        self.assertRaises(ConfigError, get_codec, 'xml')
+
+
+class TestMigrateLists(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(
+            PersistenceHelper(use_riak=False))
+        redis = yield self.persistence_helper.get_redis_manager()
+        self.redis = yield RedisStore.from_config({
+            'FAKE_REDIS': redis, 'key_prefix': redis._key_prefix})
+
+    @inlineCallbacks
+    def test_migrate(self):
+        codec = CompactCodec()
+        yield self.redis.rpush('a', '["one", "1"]')
+        yield self.redis.rpush('a', codec.encode(['two', '2']))
+        yield self.redis.rpush('a', '["three", "3"]')
+        yield self.redis.rpush('b', codec.encode(['four', '4']))
+        yield self.redis.set('c', 'not a list')
+
+        migrated = yield migrate_lists(self.redis, codec)
+        self.assertEqual(migrated, {'a': 2})
+        values = yield self.redis.lrange('a', 0, -1)
+        self.assertTrue(all(codec.is_current(value) for value in values))
+        self.assertEqual(
+            [codec.decode(value) for value in values],
+            [['one', '1'], ['two', '2'], ['three', '3']])
+
+        migrated = yield migrate_lists(self.redis, codec)
+        self.assertEqual(migrated, {})
+
+    @inlineCallbacks
+    def test_migrate_restores_records_on_failure(self):
+        codec = CompactCodec()
+        old_values = ['["one", "1"]', codec.encode(['two', '2'])]
+        for value in old_values:
+            yield self.redis.rpush('a', value)
+        prepend_list = self.redis.prepend_list
+        failures = [Exception("Redis is down.")]
+
+        def flaky_prepend_list(key, values):
+            if failures:
+                return fail(failures.pop())
+            return prepend_list(key, values)
+
+        self.patch(self.redis, 'prepend_list', flaky_prepend_list)
+        yield self.assertFailure(migrate_list(self.redis, 'a', codec),
+                                 Exception)
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+        values = yield self.redis.lrange('a', 0, -1)
+        self.assertEqual(values, old_values)
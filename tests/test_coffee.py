@@ -62,6 +62,16 @@ class TestCoffeeWorker(VumiTestCase):
         violations = yield self.proc.retrieve_violations('#test', 'memoed')
         self.assertEquals(violations, [['testnick', 'boooo']])
 
+    @inlineCallbacks
+    def test_send_violations_mixed_case(self):
+        yield self.send('!coffee testmemo boooo', channel='#test')
+        self.proc_helper.clear_all_dispatched()
+        yield self.send('!mycoffee', channel='#Test', from_addr='TestMemo')
+        replies = yield self.recv(1)
+        self.assertEqual(replies, [
+            ('reply', 'TestMemo, testnick says you butchered this: boooo'),
+            ])
+
     @inlineCallbacks
     def test_send_violations(self):
         yield self.send('!coffee testmemo this is violation1', channel='#test')
@@ -82,3 +92,29 @@ class TestCoffeeWorker(VumiTestCase):
             ('reply', 'testmemo, testnick says you butchered this:'
              ' this is violation2'),
             ])
+
+    @inlineCallbacks
+    def test_send_violations_paginated(self):
+        self.proc.config = self.proc.CONFIG_CLASS({'max_delivered': 2})
+        for i in range(3):
+            yield self.send('!coffee testmemo violation%d' % (i,),
+                            channel='#test')
+        self.proc_helper.clear_all_dispatched()
+
+        yield self.send('!mycoffee', channel='#test', from_addr='testmemo')
+        replies = yield self.recv(3)
+        self.assertEqual(replies, [
+            ('reply', 'testmemo, testnick says you butchered this:'
+             ' violation0'),
+            ('reply', 'testmemo, testnick says you butchered this:'
+             ' violation1'),
+            ('reply', '1 more pending, say !mycoffee again.'),
+            ])
+        self.proc_helper.clear_all_dispatched()
+
+        yield self.send('!mycoffee', channel='#test', from_addr='testmemo')
+        replies = yield self.recv(1)
+        self.assertEqual(replies, [
+            ('reply', 'testmemo, testnick says you butchered this:'
+             ' violation2'),
+            ])
@@ -0,0 +1,42 @@
+"""Tests for vumibot.commands."""
+
+from vumi.tests.helpers import VumiTestCase
+
+from vumibot.commands import CommandRouter
+
+
+class TestCommandRouter(VumiTestCase):
+
+    def setUp(self):
+        self.router = CommandRouter(['toy', 'toy1', 'tell'])
+
+    def test_route(self):
+        self.assertEqual(
+            self.router.route('tell  foo   bar baz '),
+            ('tell', 'foo   bar baz'))
+
+    def test_no_params(self):
+        self.assertEqual(self.router.route('toy'), ('toy', ''))
+        self.assertEqual(self.router.route('toy1  '), ('toy1', ''))
+
+    def test_prefix_of_other_command(self):
+        self.assertEqual(self.router.route('toy 1'), ('toy', '1'))
+
+    def test_unknown(self):
+        self.assertEqual(self.router.route('toy12'), None)
+        self.assertEqual(self.router.route('frobnicate'), None)
+
+    def test_leading_whitespace(self):
+        self.assertEqual(self.router.route(' toy  x'), ('toy', 'x'))
+
+    def test_empty(self):
+        self.assertEqual(self.router.route(''), None)
+        self.assertEqual(self.router.route('  '), None)
+
+    def test_unicode(self):
+        self.assertEqual(
+            self.router.route(u'tell\xa0bob caf\xe9\xa0'),
+            (u'tell', u'bob caf\xe9'))
+
+    def test_no_commands(self):
+        self.assertEqual(CommandRouter([]).route('toy'), None)
@@ -0,0 +1,186 @@
+"""Tests for vumibot.dispatch."""
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.dispatchers.base import BaseDispatchWorker
+from vumi.errors import ConfigError
+from vumi.tests.helpers import (
+    VumiTestCase, MessageHelper, PersistenceHelper, WorkerHelper)
+
+from vumibot.base import BotWorker, IRCNormalizer, shard_for
+
+
+SHARDS = 3
+SHARD_NAMES = ['bot%d' % (i,) for i in range(SHARDS)]
+
+
+def shard_of(name):
+    return shard_for(IRCNormalizer().normalize(name), SHARDS)
+
+
+class TestChannelHashRouter(VumiTestCase):
+    """Runs a router and several memo shards on one broker and one Redis."""
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.msg_helper = self.add_helper(MessageHelper(transport_name='irc'))
+        self.worker_helper = self.add_helper(WorkerHelper('irc'))
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.dispatcher = yield self.worker_helper.get_worker(
+            BaseDispatchWorker, {
+                'transport_names': ['irc'],
+                'exposed_names': SHARD_NAMES,
+                'router_class': 'vumibot.dispatch.ChannelHashRouter',
+                'route_mappings': {'irc': SHARD_NAMES},
+            })
+        self.shards = []
+        for i in range(SHARDS):
+            shard = yield self.get_shard(i)
+            self.shards.append(shard)
+
+    def get_shard(self, shard_index, **config):
+        config.setdefault('message_processors', {
+            'vumibot.memo.MemoMessageProcessor': {},
+        })
+        config.update({
+            'transport_name': SHARD_NAMES[shard_index],
+            'shard_index': shard_index,
+            'shard_count': SHARDS,
+            'redis_manager': {
+                'FAKE_REDIS': self.redis,
+                'key_prefix': self.redis._key_prefix,
+            },
+        })
+        return self.worker_helper.get_worker(BotWorker, config)
+
+    def channels_for_each_shard(self):
+        channels = {}
+        for n in range(100):
+            channels.setdefault(shard_of('#chan%d' % (n,)), '#chan%d' % (n,))
+        self.assertEqual(sorted(channels), range(SHARDS))
+        return [channels[i] for i in range(SHARDS)]
+
+    def send(self, content, from_addr='testnick', channel=None):
+        transport_metadata = {}
+        if channel is not None:
+            transport_metadata['irc_channel'] = channel
+        msg = self.msg_helper.make_inbound(
+            content, from_addr=from_addr, to_addr=None, group=channel,
+            transport_metadata=transport_metadata)
+        return self.worker_helper.dispatch_inbound(msg, 'irc')
+
+    def get_routed(self):
+        """Return the message contents each shard received."""
+        return [[msg['content'] for msg in
+                 self.worker_helper.get_dispatched_inbound(name)]
+                for name in SHARD_NAMES]
+
+    @inlineCallbacks
+    def recv(self):
+        yield self.worker_helper.kick_delivery()
+        msgs = self.worker_helper.get_dispatched_outbound('irc')
+        returnValue([msg['content'] for msg in msgs])
+
+    @inlineCallbacks
+    def test_channel_always_goes_to_same_shard(self):
+        channels = self.channels_for_each_shard()
+        for channel in channels:
+            yield self.send('hello %s' % (channel,), channel=channel)
+            yield self.send('again %s' % (channel,), channel=channel.upper())
+        self.assertEqual(self.get_routed(), [
+            ['hello %s' % (channel,), 'again %s' % (channel,)]
+            for channel in channels])
+
+    @inlineCallbacks
+    def test_private_messages_go_to_shard_for_nick(self):
+        nicks = dict((shard_of('nick%d' % (n,)), 'nick%d' % (n,))
+                     for n in range(100))
+        for i in range(SHARDS):
+            yield self.send('psst', from_addr=nicks[i])
+        self.assertEqual(self.get_routed(), [['psst']] * SHARDS)
+
+    @inlineCallbacks
+    def test_channel_order_preserved(self):
+        [channel, _, _] = self.channels_for_each_shard()
+        for n in range(10):
+            yield self.send('msg %d' % (n,), channel=channel)
+        self.assertEqual(self.get_routed(), [
+            ['msg %d' % (n,) for n in range(10)], [], []])
+
+    @inlineCallbacks
+    def test_memos_across_shards(self):
+        channels = self.channels_for_each_shard()
+        for channel in channels:
+            yield self.send('!tell memoed hi in %s' % (channel,),
+                            channel=channel.upper())
+        replies = yield self.recv()
+        self.assertEqual(replies, ['Sure thing, boss.'] * SHARDS)
+        self.worker_helper.clear_all_dispatched()
+
+        for channel in channels:
+            yield self.send('hello', from_addr='Memoed', channel=channel)
+        replies = yield self.recv()
+        self.assertEqual(replies, [
+            'Memoed, testnick asked me tell you: hi in %s' % (channel,)
+            for channel in channels])
+
+    @inlineCallbacks
+    def test_private_memos_across_shards(self):
+        nicks = dict((shard_of('nick%d' % (n,)), 'nick%d' % (n,))
+                     for n in range(100))
+        sender, recipient = nicks[0], nicks[1]
+        yield self.send('!tell %s psst' % (recipient,), from_addr=sender)
+        replies = yield self.recv()
+        self.assertEqual(replies, ['Sure thing, boss.'])
+        self.worker_helper.clear_all_dispatched()
+        # The sender's shard stored it, but it isn't theirs to deliver.
+        [proc] = self.shards[0].message_processors
+        self.assertEqual(proc.pending_channels, {})
+
+        yield self.send('hello', from_addr=recipient)
+        replies = yield self.recv()
+        self.assertEqual(replies, [
+            '%s, %s asked me tell you: psst' % (recipient, sender)])
+        [proc] = self.shards[1].message_processors
+        self.assertEqual(proc.pending_channels, {})
+
+    @inlineCallbacks
+    def test_shard_only_indexes_own_channels(self):
+        channels = self.channels_for_each_shard()
+        for channel in channels:
+            yield self.send('!tell memoed hi', channel=channel)
+        # A restarted shard rebuilds its index from Redis.
+        shard = yield self.get_shard(1)
+        [proc] = shard.message_processors
+        self.assertEqual(
+            proc.pending_recipients, {channels[1]: set(['memoed'])})
+
+    @inlineCallbacks
+    def test_shard_drops_messages_it_does_not_own(self):
+        [channel, _, _] = self.channels_for_each_shard()
+        msg = self.msg_helper.make_inbound(
+            '!tell memoed hi', from_addr='testnick', to_addr=None,
+            group=channel, transport_metadata={'irc_channel': channel})
+        yield self.worker_helper.dispatch_inbound(msg, 'bot1')
+        replies = yield self.recv()
+        self.assertEqual(replies, [])
+        [proc] = self.shards[0].message_processors
+        memos = yield proc.retrieve_memos(channel, 'memoed')
+        self.assertEqual(memos, [])
+
+    @inlineCallbacks
+    def test_shard_index_out_of_range(self):
+        yield self.assertFailure(self.worker_helper.get_worker(BotWorker, {
+            'transport_name': 'bot3',
+            'message_processors': {},
+            'shard_index': 3,
+            'shard_count': SHARDS,
+        }), ConfigError)
+
+    @inlineCallbacks
+    def test_deliver_all_channels_not_sharded(self):
+        yield self.assertFailure(self.get_shard(0, message_processors={
+            'vumibot.memo.MemoMessageProcessor': {
+                'deliver_all_channels': True},
+        }), ConfigError)
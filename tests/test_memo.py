@@ -1,11 +1,13 @@
 """Tests for vumibot.memo."""
 
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
 
 from vumi.message import TransportUserMessage
 from vumi.tests.helpers import VumiTestCase
 
 from tests.helpers import BotMessageProcessorHelper
+from vumibot.base import BotWorker
 from vumibot.memo import MemoMessageProcessor
 
 
@@ -94,3 +96,331 @@ class TestMemoWorker(VumiTestCase):
             ('reply', 'testmemo, testnick asked me tell you:'
              ' this is a different channel'),
             ])
+
+    @inlineCallbacks
+    def test_send_memos_mixed_case(self):
+        yield self.send('!tell bob[away] hello', channel='#Test')
+        self.proc_helper.clear_all_dispatched()
+        yield self.send('ping', channel='#test', from_addr='Bob{Away}')
+        replies = yield self.recv(1)
+        self.assertEqual(replies, [
+            ('reply', 'Bob{Away}, testnick asked me tell you: hello'),
+            ])
+        self.assertFalse(self.proc.has_pending_memos('#test', 'bob{away}'))
+
+    @inlineCallbacks
+    def test_send_memos_in_mixed_case_channel(self):
+        yield self.send('!tell bob hello', channel='#Test')
+        self.proc_helper.clear_all_dispatched()
+        yield self.send('ping', channel='#Test', from_addr='bob')
+        replies = yield self.recv(1)
+        self.assertEqual(replies, [
+            ('reply', 'bob, testnick asked me tell you: hello'),
+            ])
+        self.assertFalse(self.proc.has_pending_memos('#test', 'bob'))
+
+    @inlineCallbacks
+    def test_send_memos_paginated(self):
+        self.proc.config = self.proc.CONFIG_CLASS({'max_delivered': 1})
+        yield self.send('!tell testmemo one', channel='#test')
+        yield self.send('!tell testmemo two', channel='#test')
+        self.proc_helper.clear_all_dispatched()
+
+        yield self.send('ping', channel='#test', from_addr='testmemo')
+        replies = yield self.recv(2)
+        self.assertEqual(replies, [
+            ('reply', 'testmemo, testnick asked me tell you: one'),
+            ('reply', '1 more memos waiting. Say something again to get '
+             'them.'),
+            ])
+        self.proc_helper.clear_all_dispatched()
+
+        yield self.send('ping', channel='#test', from_addr='testmemo')
+        replies = yield self.recv(1)
+        self.assertEqual(replies, [
+            ('reply', 'testmemo, testnick asked me tell you: two'),
+            ])
+
+    @inlineCallbacks
+    def test_chatter_skips_redis(self):
+        yield self.send('chatter', channel='#test', from_addr='nobody')
+        yield self.send('more chatter', channel='#test', from_addr='nobody')
+        self.assertEqual(self.proc.skipped_lookups, 2)
+        self.assertEqual(self.proc.pending_recipients, {})
+
+    @inlineCallbacks
+    def test_pending_index(self):
+        yield self.send('!tell testmemo hello', channel='#test')
+        self.assertTrue(self.proc.has_pending_memos('#test', 'testmemo'))
+        self.assertFalse(self.proc.has_pending_memos('#another', 'testmemo'))
+        pending = yield self.proc.redis.smembers('pending')
+        self.assertEqual(pending, set(['["#test", "testmemo"]']))
+
+        yield self.send('ping', channel='#test', from_addr='testmemo')
+        self.assertFalse(self.proc.has_pending_memos('#test', 'testmemo'))
+        pending = yield self.proc.redis.smembers('pending')
+        self.assertEqual(pending, set())
+
+    @inlineCallbacks
+    def test_pending_channels_index(self):
+        yield self.send('!tell testmemo hello', channel='#test')
+        yield self.send('!tell testmemo hello', channel='#another')
+        self.assertEqual(
+            self.proc.get_pending_channels('testmemo'), ['#another', '#test'])
+
+        yield self.send('ping', channel='#test', from_addr='testmemo')
+        self.assertEqual(
+            self.proc.get_pending_channels('testmemo'), ['#another'])
+        self.assertEqual(self.proc.get_pending_channels('nobody'), [])
+
+    @inlineCallbacks
+    def test_other_channels_not_delivered_by_default(self):
+        yield self.send('!tell testmemo hello', channel='#another')
+        self.proc_helper.clear_all_dispatched()
+        yield self.send('ping', channel='#test', from_addr='testmemo')
+        replies = yield self.recv()
+        self.assertEqual(replies, [])
+
+    @inlineCallbacks
+    def test_pending_index_rebuilt_from_redis(self):
+        yield self.proc.redis.rpush('#test:testmemo', '["someone", "hi"]')
+        yield self.proc.redis.sadd('pending', '["#test", "testmemo"]')
+        self.assertFalse(self.proc.has_pending_memos('#test', 'testmemo'))
+
+        yield self.proc.load_pending_index()
+        self.assertTrue(self.proc.has_pending_memos('#test', 'testmemo'))
+
+        yield self.send('ping', channel='#test', from_addr='testmemo')
+        replies = yield self.recv(1)
+        self.assertEqual(replies, [
+            ('reply', 'testmemo, someone asked me tell you: hi'),
+            ])
+
+    @inlineCallbacks
+    def test_pending_index_seeded_from_legacy_lists(self):
+        # Memos stored before there was a pending set.
+        yield self.proc.redis.delete('migrations')
+        yield self.proc.redis.rpush('#test:testmemo', '["someone", "hi"]')
+        yield self.proc.redis.rpush('None:privmemo', '["someone", "psst"]')
+        yield self.proc.load_pending_index()
+        self.assertTrue(self.proc.has_pending_memos('#test', 'testmemo'))
+        self.assertTrue(self.proc.has_pending_memos(None, 'privmemo'))
+        pending = yield self.proc.redis.smembers('pending')
+        self.assertEqual(pending, set([
+            '["#test", "testmemo"]', '[null, "privmemo"]']))
+
+        yield self.send('ping', channel='#test', from_addr='testmemo')
+        replies = yield self.recv(1)
+        self.assertEqual(replies, [
+            ('reply', 'testmemo, someone asked me tell you: hi'),
+            ])
+
+    @inlineCallbacks
+    def test_legacy_mixed_case_lists_moved(self):
+        # Memos stored before channel names were normalized.
+        yield self.proc.redis.delete('migrations')
+        yield self.proc.redis.rpush('#Test:bob', '["someone", "old"]')
+        yield self.proc.redis.rpush('#test:bob', '["someone", "new"]')
+        yield self.proc.load_pending_index()
+        self.assertTrue(self.proc.has_pending_memos('#test', 'bob'))
+        old_values = yield self.proc.redis.lrange('#Test:bob', 0, -1)
+        self.assertEqual(old_values, [])
+        pending = yield self.proc.redis.smembers('pending')
+        self.assertEqual(pending, set(['["#test", "bob"]']))
+
+        yield self.send('ping', channel='#Test', from_addr='bob')
+        replies = yield self.recv(2)
+        self.assertEqual(replies, [
+            ('reply', 'bob, someone asked me tell you: old'),
+            ('reply', 'bob, someone asked me tell you: new'),
+            ])
+
+    @inlineCallbacks
+    def test_pending_index_seeded_once(self):
+        migrations = yield self.proc.redis.smembers('migrations')
+        self.assertEqual(migrations, set(['pending_set']))
+        # Once everything is delivered, Redis deletes the pending set.
+        yield self.proc.redis.rpush('#test:testmemo', '["someone", "hi"]')
+        yield self.proc.load_pending_index()
+        self.assertFalse(self.proc.has_pending_memos('#test', 'testmemo'))
+
+    @inlineCallbacks
+    def test_memos_stored_compactly(self):
+        yield self.send('!tell testmemo hello', channel='#test')
+        [value] = yield self.proc.redis.lrange('#test:testmemo', 0, -1)
+        self.assertEqual(value[:16], '\x01\x08testnick\x05hello')
+        self.assertEqual(
+            self.proc.codec.decode(value)[:2], ['testnick', 'hello'])
+
+    @inlineCallbacks
+    def test_migrate_records(self):
+        yield self.proc.redis.rpush('#test:testmemo', '["someone", "hi"]')
+        yield self.send('!tell testmemo hello', channel='#test')
+        count = yield self.proc.migrate_records()
+        self.assertEqual(count, 1)
+        values = yield self.proc.redis.lrange('#test:testmemo', 0, -1)
+        self.assertEqual(
+            [self.proc.codec.decode(value)[:2] for value in values],
+            [['someone', 'hi'], ['testnick', 'hello']])
+        self.assertTrue(
+            all(self.proc.codec.is_current(value) for value in values))
+
+        yield self.send('ping', channel='#test', from_addr='testmemo')
+        replies = yield self.recv(2)
+        self.assertEqual(replies[1:], [
+            ('reply', 'testmemo, someone asked me tell you: hi'),
+            ('reply', 'testmemo, testnick asked me tell you: hello'),
+            ])
+
+    @inlineCallbacks
+    def test_migrate_records_moves_mixed_case_lists(self):
+        yield self.proc.redis.rpush('#Test:bob', '["someone", "hi"]')
+        count = yield self.proc.migrate_records()
+        self.assertEqual(count, 1)
+        self.assertTrue(self.proc.has_pending_memos('#test', 'bob'))
+        values = yield self.proc.redis.lrange('#test:bob', 0, -1)
+        self.assertEqual(
+            [self.proc.codec.decode(value)[:2] for value in values],
+            [['someone', 'hi']])
+
+
+class TestMemoExpiry(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.patch(BotWorker, 'clock', self.clock)
+        self.proc_helper = self.add_helper(
+            BotMessageProcessorHelper(MemoMessageProcessor))
+        self.proc = yield self.proc_helper.get_message_processor({
+            'max_queued': 3,
+            'queue_ttl': 100,
+            'sweep_interval': 10,
+            'sweep_batch_size': 1,
+        })
+
+    def tell(self, target, text, channel='#test'):
+        return self.proc_helper.make_dispatch_inbound(
+            '!tell %s %s' % (target, text), from_addr='testnick',
+            group=channel)
+
+    @inlineCallbacks
+    def test_max_memos(self):
+        for i in range(5):
+            yield self.tell('spammed', 'memo %d' % (i,))
+        memos = yield self.proc.retrieve_memos('#test', 'spammed')
+        self.assertEqual(memos, [
+            ['testnick', 'memo 2'],
+            ['testnick', 'memo 3'],
+            ['testnick', 'memo 4'],
+            ])
+
+    @inlineCallbacks
+    def test_sweep_expired(self):
+        yield self.tell('bob', 'old')
+        yield self.tell('alice', 'old')
+        self.clock.advance(60)
+        yield self.tell('bob', 'new')
+        self.clock.advance(50)
+
+        removed = 0
+        for _ in range(5):
+            count = yield self.proc.sweep_expired()
+            removed += count
+        self.assertEqual(removed, 2)
+        memos = yield self.proc.retrieve_memos('#test', 'bob')
+        self.assertEqual(memos, [['testnick', 'new']])
+        self.assertFalse(self.proc.has_pending_memos('#test', 'alice'))
+        pending = yield self.proc.redis.smembers('pending')
+        self.assertEqual(pending, set(['["#test", "bob"]']))
+
+    @inlineCallbacks
+    def test_legacy_memos_not_expired(self):
+        yield self.proc.redis.rpush('#test:bob', '["someone", "hi"]')
+        self.clock.advance(1000)
+        removed = yield self.proc.sweep_expired()
+        self.assertEqual(removed, 0)
+        memos = yield self.proc.retrieve_memos('#test', 'bob')
+        self.assertEqual(memos, [['someone', 'hi']])
+
+    def test_sweeper_running(self):
+        self.assertTrue(self.proc.sweeper.running)
+        self.assertEqual(self.proc.sweeper.interval, 10)
+
+
+class TestMemoWriteBehind(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(BotWorker, 'clock', self.clock)
+        self.proc_helper = self.add_helper(
+            BotMessageProcessorHelper(MemoMessageProcessor))
+        self.proc = yield self.proc_helper.get_message_processor({
+            'write_behind_interval': 0.01,
+        })
+
+    @inlineCallbacks
+    def test_reply_before_write(self):
+        yield self.proc_helper.make_dispatch_inbound(
+            '!tell memoed hey there', from_addr='testnick', group='#test')
+        [reply] = yield self.proc_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(reply['content'], 'Sure thing, boss.')
+        stored = yield self.proc.redis.llen('#test:memoed')
+        self.assertEqual(stored, 0)
+
+        self.clock.advance(0.01)
+        yield self.proc.flush_writes()
+        memos = yield self.proc.retrieve_memos('#test', 'memoed')
+        self.assertEqual(memos, [['testnick', 'hey there']])
+
+
+class TestMemoCrossChannel(VumiTestCase):
+    def setUp(self):
+        self.proc_helper = self.add_helper(
+            BotMessageProcessorHelper(MemoMessageProcessor))
+
+    @inlineCallbacks
+    def get_proc(self, **config):
+        self.proc = yield self.proc_helper.get_message_processor(config)
+
+    def send(self, content, from_addr='testnick', channel=None):
+        return self.proc_helper.make_dispatch_inbound(
+            content, from_addr=from_addr, group=channel,
+            transport_metadata={'irc_channel': channel})
+
+    @inlineCallbacks
+    def leave_memos(self):
+        yield self.send('!tell testmemo one', channel='#test')
+        yield self.send('!tell testmemo two', channel='#another')
+        self.proc_helper.clear_all_dispatched()
+
+    def get_replies(self):
+        return [
+            (msg['group'], msg['transport_metadata'].get('irc_channel'),
+             msg['content'])
+            for msg in self.proc_helper.get_dispatched_outbound()]
+
+    @inlineCallbacks
+    def test_deliver_all_channels(self):
+        yield self.get_proc(deliver_all_channels=True)
+        yield self.leave_memos()
+        yield self.send('ping', channel='#test', from_addr='testmemo')
+        self.assertEqual(self.get_replies(), [
+            (None, None,
+             'testmemo, testnick asked me tell you (in #another): two'),
+            ('#test', '#test', 'testmemo, testnick asked me tell you: one'),
+            ])
+        self.assertEqual(self.proc.get_pending_channels('testmemo'), [])
+        self.assertEqual(self.proc.pending_recipients, {})
+
+    @inlineCallbacks
+    def test_deliver_all_channels_privately(self):
+        yield self.get_proc(deliver_all_channels=True, private_delivery=True)
+        yield self.leave_memos()
+        yield self.send('ping', from_addr='testmemo')
+        self.assertEqual(self.get_replies(), [
+            (None, None,
+             'testmemo, testnick asked me tell you (in #another): two'),
+            (None, None,
+             'testmemo, testnick asked me tell you (in #test): one'),
+            ])
@@ -0,0 +1,67 @@
+"""Tests for vumibot.profiler."""
+
+import os
+import pstats
+import signal
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumibot.profiler import WorkerProfiler, ProfilerError
+
+
+def busy_work():
+    return sum(i * i for i in xrange(20000))
+
+
+class TestWorkerProfiler(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.output_dir = self.mktemp()
+        self.profiler = WorkerProfiler(
+            self.clock, self.output_dir, 60, name='bot')
+        self.addCleanup(self.profiler.stop)
+
+    def test_cprofile(self):
+        filename = self.profiler.start(10)
+        self.assertTrue(filename.startswith(
+            os.path.join(self.output_dir, 'bot-')))
+        self.assertTrue(filename.endswith('.pstats'))
+        busy_work()
+        self.clock.advance(10)
+        self.assertFalse(self.profiler.running)
+        stats = pstats.Stats(filename)
+        self.assertTrue(any(
+            func_name == 'busy_work' for _, _, func_name in stats.stats))
+
+    def test_sample(self):
+        filename = self.profiler.start(10, 'sample')
+        self.assertTrue(filename.endswith('.folded'))
+        self.profiler.profiler._sample(None, None)
+        self.assertEqual(self.profiler.stop(), filename)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        with open(filename) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(' 1'))
+
+    def test_sample_restarts_system_calls(self):
+        calls = []
+        self.patch(signal, 'siginterrupt', lambda *args: calls.append(args))
+        self.profiler.start(10, 'sample')
+        self.profiler.stop()
+        self.assertEqual(calls, [(signal.SIGPROF, False)])
+
+    def test_stop_when_not_running(self):
+        self.assertEqual(self.profiler.stop(), None)
+
+    def test_already_running(self):
+        self.profiler.start(10)
+        self.assertRaises(ProfilerError, self.profiler.start, 10)
+
+    def test_bad_arguments(self):
+        self.assertRaises(ProfilerError, self.profiler.start, 10, 'nope')
+        self.assertRaises(ProfilerError, self.profiler.start, 0)
+        self.assertRaises(ProfilerError, self.profiler.start, 61)
+        self.assertFalse(self.profiler.running)
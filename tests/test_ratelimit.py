@@ -0,0 +1,245 @@
+"""Tests for vumibot.ratelimit."""
+
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumi.application.tests.helpers import ApplicationHelper
+from vumi.tests.helpers import VumiTestCase
+
+from vumibot.base import BotWorker
+from vumibot.ratelimit import TokenBucket, OutboundScheduler
+from tests.test_base import ChattyMessageProcessor, cls_string
+
+
+class TestTokenBucket(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_burst(self):
+        bucket = TokenBucket(1, 3, self.clock)
+        for _ in range(3):
+            self.assertEqual(bucket.wait_time(), 0)
+            bucket.consume()
+        self.assertEqual(bucket.wait_time(), 1)
+
+    def test_refill(self):
+        bucket = TokenBucket(2, 2, self.clock)
+        bucket.consume()
+        bucket.consume()
+        self.assertEqual(bucket.wait_time(), 0.5)
+        self.clock.advance(0.5)
+        self.assertEqual(bucket.wait_time(), 0)
+        self.clock.advance(10)
+        bucket.refill()
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_unlimited(self):
+        bucket = TokenBucket(0, 1, self.clock)
+        for _ in range(10):
+            self.assertEqual(bucket.wait_time(), 0)
+            bucket.consume()
+
+    def test_is_full(self):
+        bucket = TokenBucket(1, 2, self.clock)
+        self.assertTrue(bucket.is_full())
+        bucket.consume()
+        self.assertFalse(bucket.is_full())
+        self.clock.advance(1)
+        self.assertTrue(bucket.is_full())
+
+
+class TestOutboundScheduler(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.sent = []
+
+    def publish(self, reply, endpoint_name):
+        self.sent.append((self.clock.seconds(), reply['content']))
+        return succeed(None)
+
+    def merge(self, prev_reply, reply):
+        if prev_reply['to_addr'] != reply['to_addr']:
+            return False
+        prev_reply['content'] += ' | ' + reply['content']
+        return True
+
+    def mk_reply(self, content, to_addr='nick'):
+        return {'content': content, 'to_addr': to_addr}
+
+    def test_global_rate(self):
+        scheduler = OutboundScheduler(
+            self.publish, self.clock, rate=2, burst=2)
+        ds = [scheduler.send('#chan%d' % (i % 2), self.mk_reply(str(i)), None)
+              for i in range(6)]
+        self.assertEqual(self.sent, [(0, '0'), (0, '1')])
+        self.assertEqual(scheduler.queue_length(), 4)
+
+        self.clock.pump([0.5] * 4)
+        self.assertEqual(self.sent, [
+            (0, '0'), (0, '1'), (0.5, '2'), (1.0, '3'), (1.5, '4'),
+            (2.0, '5')])
+        self.assertTrue(all(d.called for d in ds))
+        self.assertEqual(scheduler.queue_length(), 0)
+
+    def test_channel_rate(self):
+        scheduler = OutboundScheduler(
+            self.publish, self.clock, channel_rate=1, channel_burst=1)
+        for content in ['a1', 'a2', 'a3']:
+            scheduler.send('#a', self.mk_reply(content), None)
+        scheduler.send('#b', self.mk_reply('b1'), None)
+        self.assertEqual(self.sent, [(0, 'a1'), (0, 'b1')])
+
+        self.clock.pump([1, 1])
+        self.assertEqual(self.sent, [
+            (0, 'a1'), (0, 'b1'), (1, 'a2'), (2, 'a3')])
+
+    def test_idle_channel_buckets_dropped(self):
+        scheduler = OutboundScheduler(
+            self.publish, self.clock, channel_rate=1, channel_burst=2)
+        for i in range(3):
+            scheduler.send('#chan', self.mk_reply(str(i)), None)
+        scheduler.send('#other', self.mk_reply('x'), None)
+        self.assertEqual(
+            sorted(scheduler.channel_buckets), ['#chan', '#other'])
+
+        # '#chan' still has a reply queued.
+        self.clock.advance(0.5)
+        scheduler.send('#third', self.mk_reply('y'), None)
+        self.assertEqual(
+            sorted(scheduler.channel_buckets), ['#chan', '#other', '#third'])
+
+        self.clock.advance(1)
+        self.assertEqual(scheduler.queue_length(), 0)
+        self.clock.advance(2)
+        scheduler.send('#third', self.mk_reply('z'), None)
+        self.assertEqual(sorted(scheduler.channel_buckets), ['#third'])
+        self.assertEqual(len(self.sent), 6)
+
+    def test_round_robin(self):
+        scheduler = OutboundScheduler(
+            self.publish, self.clock, rate=1, burst=1)
+        for content in ['a1', 'a2', 'a3']:
+            scheduler.send('#a', self.mk_reply(content), None)
+        for content in ['b1', 'b2']:
+            scheduler.send('#b', self.mk_reply(content), None)
+        self.clock.pump([1] * 4)
+        # a1 is sent before anything else is queued.
+        self.assertEqual(
+            [content for _, content in self.sent],
+            ['a1', 'a2', 'b1', 'a3', 'b2'])
+
+    def test_merge_queued(self):
+        scheduler = OutboundScheduler(
+            self.publish, self.clock, rate=1, burst=1, merge=self.merge)
+        d1 = scheduler.send('#a', self.mk_reply('one'), None)
+        d2 = scheduler.send('#a', self.mk_reply('two'), None)
+        d3 = scheduler.send('#a', self.mk_reply('three'), None)
+        d4 = scheduler.send('#a', self.mk_reply('other', 'bob'), None)
+        self.assertEqual(self.sent, [(0, 'one')])
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called)
+
+        self.clock.pump([1, 1])
+        self.assertEqual(self.sent, [
+            (0, 'one'), (1, 'two | three'), (2, 'other')])
+        self.assertTrue(all(d.called for d in [d2, d3, d4]))
+        self.assertEqual(scheduler.merged, 1)
+
+    def test_metrics(self):
+        scheduler = OutboundScheduler(
+            self.publish, self.clock, rate=1, burst=1)
+        for content in ['a', 'b', 'c']:
+            scheduler.send('#a', self.mk_reply(content), None)
+        self.assertEqual(scheduler.get_metrics(), {
+            'queued': 2,
+            'published': 1,
+            'merged': 0,
+            'avg_latency': 0.0,
+            'max_latency': 0.0,
+        })
+        self.clock.pump([1, 1])
+        self.assertEqual(scheduler.get_metrics(), {
+            'queued': 0,
+            'published': 3,
+            'merged': 0,
+            'avg_latency': 1.0,
+            'max_latency': 2.0,
+        })
+
+    @inlineCallbacks
+    def test_stop(self):
+        scheduler = OutboundScheduler(
+            self.publish, self.clock, rate=1, burst=1)
+        ds = [scheduler.send('#a', self.mk_reply(content), None)
+              for content in ['a', 'b', 'c']]
+        yield scheduler.stop()
+        self.assertEqual(self.sent, [(0, 'a'), (0, 'b'), (0, 'c')])
+        self.assertTrue(all(d.called for d in ds))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class TestBotWorkerRateLimit(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(BotWorker, 'clock', self.clock)
+        self.app_helper = self.add_helper(ApplicationHelper(BotWorker))
+
+    def get_app(self, **config):
+        config['message_processors'] = {
+            cls_string(ChattyMessageProcessor): {},
+        }
+        return self.app_helper.get_application(config)
+
+    def get_replies_content(self):
+        return [m['content']
+                for m in self.app_helper.get_dispatched_outbound()]
+
+    @inlineCallbacks
+    def test_channel_rate_limit(self):
+        app = yield self.get_app(
+            channel_outbound_rate=1, channel_outbound_burst=2)
+        yield self.app_helper.make_dispatch_inbound(
+            '!lines', from_addr='nick', group='#channel')
+        self.assertEqual(self.get_replies_content(), ['hello', 'one'])
+        self.assertEqual(app.outbound_scheduler.queue_length(), 2)
+
+        self.clock.advance(1)
+        yield self.app_helper.kick_delivery()
+        self.assertEqual(
+            self.get_replies_content(), ['hello', 'one', 'two'])
+
+        self.clock.advance(1)
+        yield self.app_helper.kick_delivery()
+        self.assertEqual(
+            self.get_replies_content(), ['hello', 'one', 'two', 'three'])
+
+    @inlineCallbacks
+    def test_rate_limit_merges_queued_replies(self):
+        app = yield self.get_app(
+            outbound_rate=1, outbound_burst=1, merge_replies_max_bytes=5)
+        msg = self.app_helper.make_inbound(
+            'hi', from_addr='nick', group='#channel')
+        ds = [app.reply_to(msg, content) for content in 'abcd']
+        yield self.app_helper.kick_delivery()
+        self.assertEqual(self.get_replies_content(), ['a'])
+
+        self.clock.pump([1, 1])
+        yield self.app_helper.kick_delivery()
+        self.assertEqual(self.get_replies_content(), ['a', 'b | c', 'd'])
+        self.assertTrue(all(d.called for d in ds))
+        self.assertEqual(app.outbound_scheduler.get_metrics()['merged'], 1)
+
+    @inlineCallbacks
+    def test_teardown_flushes_queue(self):
+        app = yield self.get_app(outbound_rate=1, outbound_burst=1)
+        yield self.app_helper.make_dispatch_inbound(
+            '!lines', from_addr='nick', group='#channel')
+        self.assertEqual(app.outbound_scheduler.queue_length(), 3)
+        yield app.teardown_application()
+        yield self.app_helper.kick_delivery()
+        self.assertEqual(
+            self.get_replies_content(), ['hello', 'one', 'two', 'three'])
@@ -0,0 +1,95 @@
+"""Tests for vumibot.stats."""
+
+from twisted.trial.unittest import TestCase
+
+from vumibot.stats import ProcessorStats, CountingClientProxy
+
+
+class FakeClientProxy(object):
+    client = 'client'
+
+
+class FakeManager(object):
+    def __init__(self):
+        self._client_proxy = FakeClientProxy()
+
+    @property
+    def _client(self):
+        return self._client_proxy.client
+
+
+class TestProcessorStats(TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.samples = []
+
+    def clock(self):
+        return self.now
+
+    def random(self):
+        return self.samples.pop(0) if self.samples else 0.0
+
+    def mk_stats(self, sample_rate=1.0):
+        return ProcessorStats(
+            sample_rate, clock=self.clock, random=self.random)
+
+    def test_calls_and_errors(self):
+        stats = self.mk_stats()
+        stats.finish(stats.start('Proc', 'cmd'))
+        stats.finish(stats.start('Proc', 'cmd'), error=True)
+        stats.finish(stats.start('Proc', 'other'))
+        cmd = stats.commands[('Proc', 'cmd')]
+        self.assertEqual((cmd.calls, cmd.errors), (2, 1))
+        other = stats.commands[('Proc', 'other')]
+        self.assertEqual((other.calls, other.errors), (1, 0))
+
+    def test_latency_histogram(self):
+        stats = self.mk_stats()
+        for latency in [0.0005, 0.003, 0.003, 0.2, 10]:
+            timer = stats.start('Proc', 'cmd')
+            self.now += latency
+            stats.finish(timer)
+        self.assertEqual(
+            stats.commands[('Proc', 'cmd')].histogram,
+            [1, 2, 0, 0, 0, 1, 0, 1])
+
+    def test_sampling(self):
+        stats = self.mk_stats(sample_rate=0.5)
+        self.samples = [0.1, 0.9, 0.2, 0.7]
+        for _ in range(4):
+            timer = stats.start('Proc', 'cmd')
+            self.now += 0.002
+            stats.finish(timer)
+        cmd = stats.commands[('Proc', 'cmd')]
+        self.assertEqual(cmd.calls, 4)
+        self.assertEqual(sum(cmd.histogram), 2)
+
+    def test_redis_commands(self):
+        stats = self.mk_stats()
+        manager = FakeManager()
+        stats.instrument_redis('Proc', manager)
+        self.assertTrue(isinstance(manager._client_proxy, CountingClientProxy))
+
+        manager._client
+        timer = stats.start('Proc', 'cmd')
+        manager._client
+        manager._client
+        stats.finish(timer)
+        self.assertEqual(stats.commands[('Proc', 'cmd')].redis_commands, 2)
+        self.assertEqual(stats.redis_count('Proc'), 3)
+        self.assertEqual(stats.redis_count('Other'), 0)
+
+    def test_format_lines(self):
+        stats = self.mk_stats()
+        timer = stats.start('Proc', 'cmd')
+        self.now += 0.002
+        stats.finish(timer)
+        stats.finish(stats.start('Other', 'cmd'), error=True)
+        self.assertEqual(stats.format_lines(), [
+            'Other cmd: calls=1 errors=1 redis=0 latency=[<1ms:1]',
+            'Proc cmd: calls=1 errors=0 redis=0 latency=[<5ms:1]',
+        ])
+        self.assertEqual(stats.format_lines('proc'), [
+            'Proc cmd: calls=1 errors=0 redis=0 latency=[<5ms:1]',
+        ])
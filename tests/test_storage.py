@@ -0,0 +1,373 @@
+"""Tests for vumibot.storage."""
+
+import os
+
+from twisted.internet.defer import gatherResults, inlineCallbacks, succeed
+
+from vumi.errors import ConfigError
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from tests import test_memo
+from tests.helpers import BotMessageProcessorHelper
+from vumibot.memo import MemoMessageProcessor
+from vumibot.storage import (
+    EmbeddedDatabase, EmbeddedStore, FakeRedisStore, RedisStore)
+
+
+class StubRedisClient(object):
+    """Records the commands sent to it. EXEC returns `exec_reply`."""
+
+    def __init__(self, exec_reply):
+        self.exec_reply = exec_reply
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.commands.append((name,) + args)
+            if name == 'execute':
+                return succeed(self.exec_reply)
+            return succeed('QUEUED')
+        return command
+
+
+class TestRedisStore(VumiTestCase):
+
+    def get_store(self, exec_reply):
+        client = StubRedisClient(exec_reply)
+        return client, RedisStore(client, {}, 'bot')
+
+    @inlineCallbacks
+    def test_drain_list(self):
+        client, store = self.get_store([['a', 'b'], 1])
+        items = yield store.drain_list('queue')
+        self.assertEqual(items, ['a', 'b'])
+        self.assertEqual(client.commands, [
+            ('multi',),
+            ('lrange', 'bot:queue', 0, -1),
+            ('delete', 'bot:queue'),
+            ('execute',),
+        ])
+
+    @inlineCallbacks
+    def test_pop_list(self):
+        client, store = self.get_store([['a', 'b'], True, 3])
+        result = yield store.pop_list('queue', 2)
+        self.assertEqual(result, [['a', 'b'], 3])
+        self.assertEqual(client.commands, [
+            ('multi',),
+            ('lrange', 'bot:queue', 0, 1),
+            ('ltrim', 'bot:queue', 2, -1),
+            ('llen', 'bot:queue'),
+            ('execute',),
+        ])
+
+    @inlineCallbacks
+    def test_prepend_list(self):
+        client, store = self.get_store(None)
+        yield store.prepend_list('queue', ['a', 'b', 'c'])
+        self.assertEqual(client.commands, [
+            ('lpush', 'bot:queue', 'c', 'b', 'a'),
+        ])
+
+    @inlineCallbacks
+    def test_fake_redis(self):
+        store = yield RedisStore.from_config({'FAKE_REDIS': 'yes'})
+        self.assertTrue(isinstance(store, FakeRedisStore))
+        self.assertTrue(isinstance(store.sub_manager('sub'), FakeRedisStore))
+        yield store.close_manager()
+
+
+class TestFakeRedisStore(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        redis = yield self.persistence_helper.get_redis_manager()
+        self.redis = yield RedisStore.from_config({
+            'FAKE_REDIS': redis,
+            'key_prefix': redis._key_prefix,
+        })
+
+    @inlineCallbacks
+    def test_drain_empty(self):
+        items = yield self.redis.drain_list('queue')
+        self.assertEqual(items, [])
+
+    @inlineCallbacks
+    def test_drain(self):
+        yield self.redis.rpush('queue', 'a')
+        yield self.redis.rpush('queue', 'b')
+        items = yield self.redis.drain_list('queue')
+        self.assertEqual(items, ['a', 'b'])
+        self.assertEqual((yield self.redis.exists('queue')), False)
+
+    @inlineCallbacks
+    def test_concurrent_push_and_drain(self):
+        pushes = []
+        drains = []
+        for i in range(50):
+            pushes.append(self.redis.rpush('queue', str(i)))
+            if i % 7 == 0:
+                drains.append(self.redis.drain_list('queue'))
+        yield gatherResults(pushes)
+        drained = yield gatherResults(drains)
+        drained.append((yield self.redis.drain_list('queue')))
+
+        items = [item for batch in drained for item in batch]
+        self.assertEqual(sorted(items, key=int), [str(i) for i in range(50)])
+
+    @inlineCallbacks
+    def test_pop_empty(self):
+        result = yield self.redis.pop_list('queue', 2)
+        self.assertEqual(result, [[], 0])
+
+    @inlineCallbacks
+    def test_pop(self):
+        for item in 'abc':
+            yield self.redis.rpush('queue', item)
+        result = yield self.redis.pop_list('queue', 2)
+        self.assertEqual(result, [['a', 'b'], 1])
+        result = yield self.redis.pop_list('queue', 2)
+        self.assertEqual(result, [['c'], 0])
+
+    @inlineCallbacks
+    def test_prepend(self):
+        yield self.redis.rpush('queue', 'c')
+        yield self.redis.prepend_list('queue', ['a', 'b'])
+        items = yield self.redis.lrange('queue', 0, -1)
+        self.assertEqual(items, ['a', 'b', 'c'])
+
+
+class TestEmbeddedDatabase(VumiTestCase):
+
+    def setUp(self):
+        self.db = EmbeddedDatabase()
+
+    def test_lists(self):
+        for value in ['a', 'b', 'c', 'd']:
+            self.db.execute('rpush', 'l', value)
+        self.assertEqual(self.db.execute('lpush', 'l', 'z'), 5)
+        self.assertEqual(self.db.execute('lrange', 'l', 0, -1),
+                         ['z', 'a', 'b', 'c', 'd'])
+        self.assertEqual(self.db.execute('lrange', 'l', 1, 2), ['a', 'b'])
+        self.assertEqual(self.db.execute('lrange', 'l', -2, -1), ['c', 'd'])
+        self.db.execute('ltrim', 'l', -3, -1)
+        self.assertEqual(self.db.execute('lrange', 'l', 0, -1),
+                         ['b', 'c', 'd'])
+        self.assertEqual(self.db.execute('llen', 'l'), 3)
+        self.assertEqual(self.db.execute('type', 'l'), 'list')
+
+    def test_lrem(self):
+        for value in ['a', 'b', 'a', 'c', 'a']:
+            self.db.execute('rpush', 'l', value)
+        self.assertEqual(self.db.execute('lrem', 'l', 'a', 1), 1)
+        self.assertEqual(self.db.execute('lrange', 'l', 0, -1),
+                         ['b', 'a', 'c', 'a'])
+        self.assertEqual(self.db.execute('lrem', 'l', 'a', -1), 1)
+        self.assertEqual(self.db.execute('lrange', 'l', 0, -1),
+                         ['b', 'a', 'c'])
+        self.db.execute('rpush', 'l', 'a')
+        self.assertEqual(self.db.execute('lrem', 'l', 'a'), 2)
+        self.assertEqual(self.db.execute('lrange', 'l', 0, -1), ['b', 'c'])
+
+    def test_sets(self):
+        self.assertEqual(self.db.execute('sadd', 's', 'a', 'b'), 2)
+        self.assertEqual(self.db.execute('sadd', 's', 'b', 'c'), 1)
+        self.assertEqual(self.db.execute('srem', 's', 'a', 'x'), 1)
+        self.assertEqual(self.db.execute('smembers', 's'), set(['b', 'c']))
+        self.assertTrue(self.db.execute('sismember', 's', 'b'))
+        self.assertFalse(self.db.execute('sismember', 's', 'a'))
+        self.assertEqual(self.db.execute('type', 's'), 'set')
+
+    def test_empty_keys_disappear(self):
+        self.db.execute('rpush', 'l', 'a')
+        self.db.execute('ltrim', 'l', 1, -1)
+        self.db.execute('sadd', 's', 'a')
+        self.db.execute('srem', 's', 'a')
+        self.assertEqual(self.db.data, {})
+        self.assertEqual(self.db.execute('type', 'l'), 'none')
+        self.assertEqual(self.db.execute('delete', 'l'), 0)
+
+    def test_unicode_stored_as_bytes(self):
+        self.db.execute('rpush', u'caf\xe9', u'\u2603')
+        self.assertEqual(self.db.execute('lrange', 'caf\xc3\xa9', 0, -1),
+                         ['\xe2\x98\x83'])
+
+    def test_log_replayed(self):
+        path = self.mktemp()
+        db = EmbeddedDatabase(path)
+        db.execute('rpush', 'l', 'a')
+        db.execute('rpush', 'l', '\x00\xff\n')
+        db.execute('sadd', 's', 'x', 'y')
+        db.execute('srem', 's', 'x')
+        db.execute('ltrim', 'l', 1, -1)
+        db.execute('lrange', 'l', 0, -1)
+        # No close, as if the worker crashed.
+
+        db = EmbeddedDatabase(path)
+        self.assertEqual(db.data, {'l': ['\x00\xff\n'], 's': set(['y'])})
+        db.close()
+
+    def test_torn_last_line_skipped(self):
+        path = self.mktemp()
+        db = EmbeddedDatabase(path)
+        db.execute('rpush', 'k', 'a')
+        db.execute('rpush', 'k', 'b')
+        db.close()
+        with open(path, 'a') as f:
+            f.write('["rpush", "k", "c')
+
+        db = EmbeddedDatabase(path)
+        self.assertEqual(db.data, {'k': ['a', 'b']})
+        db.execute('rpush', 'k', 'd')
+        db.close()
+        db = EmbeddedDatabase(path)
+        self.assertEqual(db.data, {'k': ['a', 'b', 'd']})
+        db.close()
+
+    def test_corrupt_line_in_middle(self):
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            f.write('["rpush", "k", "a"]\n["rpu\n["rpush", "k", "b"]\n')
+        self.assertRaises(ValueError, EmbeddedDatabase, path)
+
+    def test_scan(self):
+        for key in ['b:2', 'a:1', 'b:1', 'c:1', 'b:3']:
+            self.db.execute('sadd', key, 'x')
+        self.assertEqual(self.db.scan(None, 'b:', 2), ('b:2', ['b:1', 'b:2']))
+        self.assertEqual(self.db.scan('b:2', 'b:', 2), (None, ['b:3']))
+        self.assertEqual(self.db.scan(None, '', 10), (None, [
+            'a:1', 'b:1', 'b:2', 'b:3', 'c:1']))
+
+    def test_log_compacted(self):
+        path = self.mktemp()
+        db = EmbeddedDatabase(path)
+        for i in range(10):
+            db.execute('rpush', 'l', str(i))
+        db.execute('ltrim', 'l', -2, -1)
+        db.close()
+
+        db = EmbeddedDatabase(path)
+        db.close()
+        with open(path) as f:
+            self.assertEqual(
+                f.read(), '["rpush", "l", "8"]\n["rpush", "l", "9"]\n')
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+
+class TestEmbeddedStore(VumiTestCase):
+
+    def setUp(self):
+        self.db = EmbeddedDatabase()
+        self.store = EmbeddedStore(self.db, 'bot')
+
+    @inlineCallbacks
+    def test_sub_manager_prefixes_keys(self):
+        sub = self.store.sub_manager('memo')
+        yield sub.rpush('#test:nick', 'hi')
+        self.assertEqual(self.db.data, {'bot:memo:#test:nick': ['hi']})
+        memos = yield sub.lrange('#test:nick', 0, -1)
+        self.assertEqual(memos, ['hi'])
+
+    @inlineCallbacks
+    def test_scan(self):
+        sub = self.store.sub_manager('memo')
+        for i in range(5):
+            yield sub.sadd('key%d' % (i,), 'x')
+        yield self.store.sadd('other', 'x')
+        keys = []
+        cursor = None
+        while True:
+            cursor, found = yield sub.scan(cursor, match='key*', count=2)
+            keys.extend(found)
+            if cursor is None:
+                break
+        self.assertEqual(keys, ['key%d' % (i,) for i in range(5)])
+
+    @inlineCallbacks
+    def test_scan_with_deletes(self):
+        sub = self.store.sub_manager('memo')
+        for i in range(6):
+            yield sub.rpush('key%d' % (i,), 'x')
+        cursor, keys = yield sub.scan(None, match='key*', count=2)
+        self.assertEqual(keys, ['key0', 'key1'])
+        # Drained lists disappear between steps.
+        yield sub.drain_list('key0')
+        yield sub.drain_list('key2')
+        cursor, keys = yield sub.scan(cursor, match='key*', count=2)
+        self.assertEqual(keys, ['key3', 'key4'])
+        cursor, keys = yield sub.scan(cursor, match='key*', count=2)
+        self.assertEqual((cursor, keys), (None, ['key5']))
+
+    @inlineCallbacks
+    def test_drain_and_pop_list(self):
+        for value in ['a', 'b', 'c']:
+            yield self.store.rpush('l', value)
+        popped = yield self.store.pop_list('l', 2)
+        self.assertEqual(popped, [['a', 'b'], 1])
+        drained = yield self.store.drain_list('l')
+        self.assertEqual(drained, ['c'])
+        self.assertEqual(self.db.data, {})
+
+    @inlineCallbacks
+    def test_prepend_list(self):
+        yield self.store.rpush('l', 'c')
+        yield self.store.prepend_list('l', ['a', 'b'])
+        items = yield self.store.lrange('l', 0, -1)
+        self.assertEqual(items, ['a', 'b', 'c'])
+
+    @inlineCallbacks
+    def test_from_config(self):
+        path = self.mktemp()
+        store = EmbeddedStore.from_config({'path': path, 'key_prefix': 'b'})
+        yield store.rpush('l', 'a')
+        yield store.close_manager()
+
+        store = EmbeddedStore.from_config({'path': path, 'key_prefix': 'b'})
+        items = yield store.lrange('l', 0, -1)
+        self.assertEqual(items, ['a'])
+        yield store.close_manager()
+
+
+class TestMemoWorkerEmbedded(test_memo.TestMemoWorker):
+    """Runs the memo tests against the embedded store."""
+
+    @inlineCallbacks
+    def setUp(self):
+        self.proc_helper = self.add_helper(
+            BotMessageProcessorHelper(MemoMessageProcessor))
+        self.proc = yield self.proc_helper.get_message_processor(
+            {}, storage='embedded')
+
+    def test_uses_embedded_store(self):
+        self.assertTrue(isinstance(self.proc.redis, EmbeddedStore))
+
+
+class TestEmbeddedStorageWorker(VumiTestCase):
+
+    def setUp(self):
+        self.proc_helper = self.add_helper(
+            BotMessageProcessorHelper(MemoMessageProcessor))
+
+    def get_proc(self, path):
+        return self.proc_helper.get_message_processor(
+            {}, storage='embedded', embedded_storage={'path': path})
+
+    @inlineCallbacks
+    def test_memos_survive_restart(self):
+        path = self.mktemp()
+        proc = yield self.get_proc(path)
+        yield self.proc_helper.make_dispatch_inbound(
+            '!tell memoed hey there', from_addr='testnick', group='#test')
+        yield self.proc_helper.cleanup_worker(proc._app_worker)
+
+        proc = yield self.get_proc(path)
+        self.assertEqual(proc.pending_recipients, {'#test': set(['memoed'])})
+        memos = yield proc.retrieve_memos('#test', 'memoed')
+        self.assertEqual(memos, [['testnick', 'hey there']])
+
+    @inlineCallbacks
+    def test_unknown_storage(self):
+        yield self.assertFailure(
+            self.proc_helper.get_message_processor({}, storage='sqlite'),
+            ConfigError)
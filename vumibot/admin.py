@@ -0,0 +1,86 @@
+# -*- test-case-name: tests.test_admin -*-
+
+"""
+Commands for looking after the bot itself.
+"""
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from vumi.config import ConfigList
+
+from vumibot.base import BotMessageProcessor, botcommand
+from vumibot.profiler import ProfilerError
+
+
+class AdminMessageProcessorConfig(BotMessageProcessor.CONFIG_CLASS):
+    admins = ConfigList(
+        "Nicks allowed to use admin-only commands.", default=[], static=True)
+
+
+class AdminMessageProcessor(BotMessageProcessor):
+    CONFIG_CLASS = AdminMessageProcessorConfig
+
+    def is_admin(self, message):
+        return message['from_addr'] in self.config.admins
+
+    @botcommand(r'(?P<proc_name>\S*)$')
+    @inlineCallbacks
+    def cmd_stats(self, message, params, proc_name):
+        "Usage: !stats [processor]"
+        if not self.is_admin(message):
+            returnValue("Sorry, only admins may do that.")
+        worker = self._app_worker
+        lines = worker.stats.format_lines(proc_name or None)
+        if worker.outbound_scheduler is not None and not proc_name:
+            metrics = worker.outbound_scheduler.get_metrics()
+            lines.append('outbound: %s' % (' '.join(
+                '%s=%s' % item for item in sorted(metrics.iteritems())),))
+        # There's a line per command, so keep them out of the channel.
+        for line in lines or ["No stats yet."]:
+            yield self.reply_to_user(message, line)
+
+    @botcommand(r'(?:(?P<seconds>\d+)(?:\s+(?P<kind>\w+))?|(?P<stop>stop))$')
+    def cmd_profile(self, message, params, seconds, kind, stop):
+        "Usage: !profile <seconds> [cprofile|sample] | !profile stop"
+        if not self.is_admin(message):
+            return "Sorry, only admins may do that."
+        profiler = self._app_worker.profiler
+        if stop:
+            filename = profiler.stop()
+            if filename is None:
+                return "Not profiling."
+            return "Profile written to %s." % (filename,)
+        try:
+            filename = profiler.start(int(seconds), kind or 'cprofile')
+        except ProfilerError as e:
+            return str(e)
+        return "Profiling for %s seconds to %s." % (seconds, filename)
+
+    @botcommand(r'$')
+    @inlineCallbacks
+    def cmd_migrate(self, message, params):
+        "Usage: !migrate"
+        if not self.is_admin(message):
+            returnValue("Sorry, only admins may do that.")
+        lines = []
+        for proc in self._app_worker.message_processors:
+            if not hasattr(proc, 'migrate_records'):
+                continue
+            count = yield proc.migrate_records()
+            lines.append("%s: migrated %s records." % (
+                type(proc).__name__, count))
+        returnValue(lines or "Nothing to migrate.")
+
+    @botcommand(r'$')
+    @inlineCallbacks
+    def cmd_reload(self, message, params):
+        "Usage: !reload"
+        if not self.is_admin(message):
+            returnValue("Sorry, only admins may do that.")
+        try:
+            result = yield self._app_worker.reload_processors()
+        except Exception as e:
+            returnValue("Reload failed: %s" % (e,))
+        returnValue("Reloaded. %s" % ('; '.join(
+            '%s: %s' % (action, ', '.join(
+                name.rsplit('.', 1)[-1] for name in result[action]) or '-')
+            for action in ['started', 'stopped', 'unchanged']),))
@@ -1,14 +1,36 @@
 # -*- test-case-name: tests.test_base -*-
 
+import json
+import os
 import re
+import signal
+import string
+import time
+import zlib
+from collections import OrderedDict
 
-from twisted.internet.defer import inlineCallbacks
+import yaml
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, maybeDeferred, succeed,
+    Deferred, DeferredLock, DeferredSemaphore, FirstError)
+from twisted.internet.task import LoopingCall
 from twisted.python import log
+from twisted.python.failure import Failure
 
 from vumi.application import ApplicationWorker
-from vumi.config import Config, ConfigDict, ConfigText
+from vumi.config import (
+    Config, ConfigBool, ConfigDict, ConfigFloat, ConfigInt, ConfigText)
+from vumi.errors import ConfigError
 from vumi.utils import load_class_by_string
 
+from vumibot.codec import decode_record, get_codec
+from vumibot.commands import CommandRouter
+from vumibot.profiler import WorkerProfiler
+from vumibot.ratelimit import OutboundScheduler
+from vumibot.stats import ProcessorStats, MESSAGE_COMMAND
+from vumibot.storage import EmbeddedStore, RedisStore
+
 
 class CommandFormatException(Exception):
     pass
@@ -31,12 +53,221 @@ def botcommand(func_or_pattern):
         return match
 
 
+@inlineCallbacks
+def scan_keys(redis, match='*', count=100):
+    """Return all keys matching `match`, using SCAN so we don't block Redis
+    the way KEYS would.
+    """
+    keys = set()
+    cursor = None
+    while True:
+        cursor, batch = yield redis.scan(cursor, match=match, count=count)
+        keys.update(batch)
+        if cursor is None:
+            break
+    returnValue(sorted(keys))
+
+
+@inlineCallbacks
+def migrate_list(redis, key, codec):
+    """Re-encode every record in the list at `key` with `codec`.
+
+    The list is drained atomically and the records pushed back onto the
+    front in one command, so anything appended in the meantime stays after
+    them. If that fails, the original records are pushed back instead.
+    Returns the number of records re-encoded.
+    """
+    values = yield redis.lrange(key, 0, -1)
+    if all(codec.is_current(value) for value in values):
+        returnValue(0)
+    values = yield redis.drain_list(key)
+    new_values = [
+        value if codec.is_current(value)
+        else codec.encode(decode_record(value))
+        for value in values]
+    yield _prepend_or_restore(redis, key, new_values, key, values)
+    returnValue(sum(1 for value in values if not codec.is_current(value)))
+
+
+@inlineCallbacks
+def move_list(redis, key, new_key):
+    """Move the records in the list at `key` to the front of the list at
+    `new_key`, ahead of anything already there.
+
+    If they can't be written to `new_key`, they are pushed back onto `key`.
+    Returns the number of records moved.
+    """
+    values = yield redis.drain_list(key)
+    if values:
+        yield _prepend_or_restore(redis, new_key, values, key, values)
+    returnValue(len(values))
+
+
+@inlineCallbacks
+def _prepend_or_restore(redis, key, values, old_key, old_values):
+    # `old_values` have just been drained from `old_key`, so if we can't
+    # write `values` to `key` they go back where they came from.
+    try:
+        yield redis.prepend_list(key, values)
+    except Exception:
+        failure = Failure()
+        log.err(failure, "Failed to store records in %r" % (key,))
+        try:
+            yield redis.prepend_list(old_key, old_values)
+        except Exception:
+            # Log them, so they can at least be put back by hand.
+            log.err(None, "Lost %d records from %r: %r" % (
+                len(old_values), old_key, old_values))
+        failure.raiseException()
+
+
+@inlineCallbacks
+def migrate_lists(redis, codec, match='*', key_filter=None):
+    """Re-encode the records in every list matching `match` with `codec`.
+
+    If `key_filter` is given, only keys it returns true for are touched.
+    Returns a dict mapping each key that had records re-encoded to the
+    number of records.
+    """
+    migrated = {}
+    keys = yield scan_keys(redis, match)
+    for key in keys:
+        if key_filter is not None and not key_filter(key):
+            continue
+        key_type = yield redis.type(key)
+        if key_type != 'list':
+            continue
+        count = yield migrate_list(redis, key, codec)
+        if count:
+            migrated[key] = count
+    returnValue(migrated)
+
+
+# Characters each IRC casemapping folds together, beyond ASCII letters.
+CASEMAPPINGS = {
+    'ascii': u'',
+    'strict-rfc1459': u'[]\\',
+    'rfc1459': u'[]\\~',
+}
+CASEMAPPING_LOWER = u'{}|^'
+
+
+class IRCNormalizer(object):
+    """Case-fold nicknames and channel names for use in Redis keys.
+
+    IRC only folds ASCII letters, plus `[]\\~` to `{}|^` under `rfc1459`
+    casemapping. Results are kept in an LRU cache of `cache_size` entries,
+    since the same few nicks and channels come up over and over.
+    """
+
+    def __init__(self, casemapping='rfc1459', cache_size=1024):
+        if casemapping not in CASEMAPPINGS:
+            raise ConfigError("Unknown casemapping %r. Choose from: %s." % (
+                casemapping, ', '.join(sorted(CASEMAPPINGS))))
+        extra = CASEMAPPINGS[casemapping]
+        upper = unicode(string.ascii_uppercase) + extra
+        lower = (unicode(string.ascii_lowercase) +
+                 CASEMAPPING_LOWER[:len(extra)])
+        self._unicode_table = dict(
+            (ord(u), l) for u, l in zip(upper, lower))
+        self._str_table = string.maketrans(str(upper), str(lower))
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def normalize(self, name):
+        if name is None:
+            return None
+        cache = self._cache
+        normalized = cache.pop(name, None)
+        if normalized is None:
+            if isinstance(name, unicode):
+                normalized = name.translate(self._unicode_table)
+            else:
+                normalized = name.translate(self._str_table)
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+        cache[name] = normalized
+        return normalized
+
+
+def shard_for(name, shard_count):
+    """Return the shard that owns the normalized channel or nickname `name`.
+
+    This uses CRC32 rather than `hash()`, so every process agrees on it.
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return (zlib.crc32(name) & 0xffffffff) % shard_count
+
+
+class ParsedMessage(object):
+    """The bot's view of an inbound message, parsed once per message.
+
+    `content` has the command prefix stripped, `is_command` is set for
+    prefixed or directed messages, and `command` and `params` are the first
+    word of the content and the (stripped) remainder. If `command` is given,
+    the content has already been split.
+    """
+
+    __slots__ = ['is_command', 'content', 'command', 'params']
+
+    def __init__(self, is_command, content, command=None, params=''):
+        self.is_command = is_command
+        self.content = content
+        if command is None:
+            command, params = (content.split(None, 1) + ['', ''])[:2]
+            params = params.strip()
+        self.command = command
+        self.params = params
+
+
 class BotMessageProcessor(object):
     CONFIG_CLASS = Config
 
+    # Processors that set this see every message through `handle_message`.
+    # The rest only see the commands they handle, through `handle_command`.
+    wants_all_messages = False
+
     def __init__(self, app_worker, config):
         self._app_worker = app_worker
         self.config = self.CONFIG_CLASS(config)
+        self.commands = dict(
+            (command_name, getattr(self, attr))
+            for command_name, attr in self.get_command_attrs().iteritems())
+
+    @classmethod
+    def get_command_attrs(cls):
+        """Return a mapping from command name to handler attribute name.
+
+        This is built once per class, so aliases like `cmd_ask = cmd_tell`
+        end up as separate commands pointing at the same handler.
+        """
+        if '_command_attrs' not in cls.__dict__:
+            command_attrs = {}
+            for attr in dir(cls):
+                if not attr.startswith('cmd_'):
+                    continue
+                handler = getattr(cls, attr)
+                if hasattr(handler, 'pattern') and callable(handler):
+                    command_attrs[attr[len('cmd_'):]] = attr
+            cls._command_attrs = command_attrs
+        return cls._command_attrs
+
+    def normalize(self, name):
+        """Case-fold a nickname or channel name for use in a Redis key."""
+        return self._app_worker.normalizer.normalize(name)
+
+    def owns(self, channel, nickname):
+        """Return `True` if this worker's shard owns `channel`, or the
+        private conversation with `nickname` if `channel` is `None`.
+        """
+        return self._app_worker.owns(channel, nickname)
+
+    def get_redis(self, sub_prefix):
+        """Return a deferred that fires with a Redis manager for this
+        processor, sharing the worker's connection under `sub_prefix`.
+        """
+        return self._app_worker.get_redis(sub_prefix, self)
 
     def setup_message_processor(self):
         pass
@@ -44,25 +275,35 @@ class BotMessageProcessor(object):
     def teardown_message_processor(self):
         pass
 
+    def prepare_for_replacement(self):
+        """Called when a reload is about to replace this processor, before
+        its replacement is set up. It keeps running until messages already
+        being processed have finished.
+        """
+        pass
+
+    def take_over_from(self, old_proc):
+        """Called after `old_proc`, the processor this one replaced in a
+        reload, has been torn down.
+        """
+        pass
+
     def handle_message(self, message):
         pass
 
-    def handle_command(self, message, content):
-        command, params = (content.split(None, 1) + ['', ''])[:2]
-        handler = self.find_command(command)
+    def handle_command(self, message, parsed):
+        handler = self.find_command(parsed.command)
         if not handler:
             return
 
-        match = handler.pattern.match(params.strip())
+        match = handler.pattern.match(parsed.params)
         if not match:
             return "that does not compute. %s" % (handler.__doc__,)
         return handler(
             message, match.groups(), **match.groupdict())
 
     def find_command(self, command_name):
-        handler = getattr(self, 'cmd_%s' % (command_name,), None)
-        if hasattr(handler, 'pattern') and callable(handler):
-            return handler
+        return self.commands.get(command_name)
 
     def reply_to(self, original_message, content, *args, **kw):
         return self._app_worker.reply_to(
@@ -72,44 +313,1088 @@ class BotMessageProcessor(object):
         return self._app_worker.reply_to_group(
             original_message, content, *args, **kw)
 
+    def reply_to_user(self, original_message, content, *args, **kw):
+        return self._app_worker.reply_to_user(
+            original_message, content, *args, **kw)
+
+
+class QueuedDeliveryProcessorConfig(BotMessageProcessor.CONFIG_CLASS):
+    record_codec = ConfigText(
+        "Codec for stored records: `compact` or `json`. Records stored with "
+        "either codec can always be read.", default="compact", static=True)
+    max_queued = ConfigInt(
+        "Maximum number of records kept for each recipient in a channel. The "
+        "oldest are dropped first. Zero means no limit.",
+        default=50, static=True)
+    queue_ttl = ConfigInt(
+        "Seconds to keep an undelivered record. Zero keeps them forever. "
+        "Records stored before records had timestamps are never expired.",
+        default=30 * 24 * 60 * 60, static=True)
+    delivery_chunk_size = ConfigInt(
+        "Number of records read from Redis at a time when delivering.",
+        default=10, static=True)
+    max_delivered = ConfigInt(
+        "Maximum number of records delivered at once. The rest are left for "
+        "the next delivery. Zero means no limit.", default=20, static=True)
+    sweep_interval = ConfigFloat(
+        "Seconds between sweeps for expired records.", default=60,
+        static=True)
+    sweep_batch_size = ConfigInt(
+        "Number of keys to look at in each sweep. A full pass takes as many "
+        "sweeps as it needs.", default=100, static=True)
+    write_behind_interval = ConfigFloat(
+        "If set, stored records are buffered and written to Redis together "
+        "at most this many seconds later, so the user is answered without "
+        "waiting for Redis. Zero writes each record before answering.",
+        default=0, static=True)
+    write_behind_max_records = ConfigInt(
+        "Number of buffered records that triggers a write straight away.",
+        default=100, static=True)
+    spill_file = ConfigText(
+        "File buffered records are appended to if they can't be written to "
+        "Redis. They are written to Redis from it at startup and before the "
+        "next write, so each worker needs its own. Without one, failed "
+        "writes are kept in memory and retried.", default=None, static=True)
+
+
+class QueuedDeliveryProcessor(BotMessageProcessor):
+    """Base class for processors that queue records for a recipient in a
+    channel until they can be delivered.
+
+    Records are lists of `record_fields` text fields, stored in a Redis list
+    per channel and recipient under `redis_prefix`. This takes care of
+    encoding, capping and expiring the lists, draining them atomically and
+    keeping an in-memory index of who has records waiting.
+    """
+
+    CONFIG_CLASS = QueuedDeliveryProcessorConfig
+
+    redis_prefix = None
+    record_fields = 2
+
+    @inlineCallbacks
+    def setup_message_processor(self):
+        self.codec = get_codec(self.config.record_codec)
+        self.clock = self._app_worker.clock
+        self.redis = yield self.get_redis(self.redis_prefix)
+        self._write_buffer = []
+        self._write_lock = DeferredLock()
+        self._flush_call = None
+        self._spilled = False
+        self._sweep_cursor = None
+        self.pending_recipients = {}
+        self.pending_channels = {}
+        self.sweeper = None
+        if self.config.delivery_chunk_size < 1:
+            raise ConfigError("delivery_chunk_size must be at least 1.")
+        yield self.flush_writes()
+        yield self.load_pending_index()
+        if self.config.queue_ttl > 0 and self.config.sweep_interval > 0:
+            self.sweeper = LoopingCall(self.sweep)
+            self.sweeper.clock = self.clock
+            self.sweeper.start(self.config.sweep_interval, now=False)
+
+    @inlineCallbacks
+    def teardown_message_processor(self):
+        if self.sweeper is not None and self.sweeper.running:
+            self.sweeper.stop()
+        yield self.flush_writes()
+        if self._flush_call is not None and self._flush_call.active():
+            # The write failed and there's no spill file to keep them in.
+            self._flush_call.cancel()
+            log.msg("Dropped %d records that couldn't be written." % (
+                len(self._write_buffer),))
+
+    def prepare_for_replacement(self):
+        # So our replacement finds them when it loads the pending index.
+        return self.flush_writes()
+
+    @inlineCallbacks
+    def take_over_from(self, old_proc):
+        # Pick up anything `old_proc` stored after we loaded the index. Our
+        # own buffered records have to be in Redis first, or rebuilding the
+        # index would lose them.
+        yield self._flushed()
+        yield self.load_pending_index()
+
+    def rkey_queue(self, channel, recipient):
+        return "%s:%s" % (self.normalize(channel), self.normalize(recipient))
+
+    def rkey_pending(self):
+        return "pending"
+
+    def rkey_migrations(self):
+        return "migrations"
+
+    def split_queue_key(self, queue_key):
+        channel, recipient = queue_key.rsplit(':', 1)
+        # Private messages have no channel, and no channel is called "None".
+        if channel == 'None':
+            channel = None
+        return channel, recipient
+
+    def owns_queue_key(self, queue_key):
+        return self.owns(*self.split_queue_key(queue_key))
+
+    @inlineCallbacks
+    def load_pending_index(self):
+        """Rebuild the in-memory indexes of recipients with pending records.
+
+        `pending_recipients` maps each channel to the set of recipients we
+        hold records for, so that chatter from everyone else can skip Redis
+        entirely. `pending_channels` maps each recipient to the channels
+        they have records in, so we can find all of them at once.
+
+        When sharded, only the channels our shard owns are indexed. If the
+        pending set has never been seeded from the queues, that is done
+        first.
+        """
+        self.pending_recipients = {}
+        self.pending_channels = {}
+        seeded = yield self.redis.sismember(
+            self.rkey_migrations(), 'pending_set')
+        if not seeded:
+            yield self.seed_pending_set()
+        members = yield self.redis.smembers(self.rkey_pending())
+        for member in members:
+            channel, recipient = json.loads(member)
+            if self.owns(channel, recipient):
+                self._index_pending(channel, recipient)
+
+    @inlineCallbacks
+    def seed_pending_set(self):
+        """Add every queue in Redis to the pending set.
+
+        Records stored before we kept a pending set have no entry in it, so
+        they would never be delivered. This scans for them, and then notes
+        in the `migrations` set that it has, so it only happens once. The
+        pending set itself can't tell us, since Redis deletes it whenever
+        it empties. Returns the number of queues added.
+        """
+        queue_keys = yield self.normalize_queue_keys()
+        members = [
+            self.pending_member(*self.split_queue_key(queue_key))
+            for queue_key in queue_keys]
+        if members:
+            yield self.redis.sadd(self.rkey_pending(), *members)
+            log.msg("Added %d queues to the pending set." % (len(members),))
+        yield self.redis.sadd(self.rkey_migrations(), 'pending_set')
+        returnValue(len(members))
+
+    @inlineCallbacks
+    def normalize_queue_keys(self, key_filter=None):
+        """Move any queue stored under a key that `rkey_queue` wouldn't
+        give it to the key it would.
+
+        Queues stored before channel names were normalized can have keys
+        like `#Chan:bob`, which would otherwise never be read. Their
+        records are older than any at the new key, so they go in front.
+        If `key_filter` is given, only keys it returns true for are
+        touched. Returns the sorted keys of all matching queues.
+        """
+        queue_keys = set()
+        keys = yield scan_keys(self.redis, '*:*')
+        for key in keys:
+            if key_filter is not None and not key_filter(key):
+                continue
+            key_type = yield self.redis.type(key)
+            if key_type != 'list':
+                continue
+            queue_key = self.rkey_queue(*self.split_queue_key(key))
+            if queue_key != key:
+                count = yield move_list(self.redis, key, queue_key)
+                log.msg("Moved %d records from %r to %r." % (
+                    count, key, queue_key))
+            queue_keys.add(queue_key)
+        returnValue(sorted(queue_keys))
+
+    def _index_pending(self, channel, recipient):
+        channel, recipient = self.normalize(channel), self.normalize(recipient)
+        self.pending_recipients.setdefault(channel, set()).add(recipient)
+        self.pending_channels.setdefault(recipient, set()).add(channel)
+
+    def _unindex_pending(self, channel, recipient):
+        channel, recipient = self.normalize(channel), self.normalize(recipient)
+        for index, key, value in [
+                (self.pending_recipients, channel, recipient),
+                (self.pending_channels, recipient, channel)]:
+            values = index.get(key, set())
+            values.discard(value)
+            if not values:
+                index.pop(key, None)
+
+    def has_pending(self, channel, recipient):
+        recipients = self.pending_recipients.get(self.normalize(channel), ())
+        return self.normalize(recipient) in recipients
+
+    def check_pending(self, channel, recipient):
+        """Return a deferred that fires with `True` if `recipient` has
+        pending records in `channel`.
+
+        A private record is stored by the shard that owns the sender's
+        conversation, not the recipient's, so when sharded we ask Redis
+        about private records our index doesn't know about.
+        """
+        if self.has_pending(channel, recipient):
+            return succeed(True)
+        if channel is not None or self._app_worker.shard_count == 1:
+            return succeed(False)
+        d = self.redis.sismember(
+            self.rkey_pending(), self.pending_member(channel, recipient))
+        d.addCallback(self._index_if_pending, channel, recipient)
+        return d
+
+    def _index_if_pending(self, pending, channel, recipient):
+        if pending:
+            self._index_pending(channel, recipient)
+        return pending
+
+    def get_pending_channels(self, recipient):
+        """Return the channels `recipient` has pending records in."""
+        return sorted(
+            self.pending_channels.get(self.normalize(recipient), ()))
+
+    def pending_member(self, channel, recipient):
+        return json.dumps(
+            [self.normalize(channel), self.normalize(recipient)])
+
+    def add_pending(self, channel, recipient):
+        self._index_pending(channel, recipient)
+        return self.redis.sadd(
+            self.rkey_pending(), self.pending_member(channel, recipient))
+
+    def remove_pending(self, channel, recipient):
+        self._unindex_pending(channel, recipient)
+        return self.redis.srem(
+            self.rkey_pending(), self.pending_member(channel, recipient))
+
+    @inlineCallbacks
+    def remove_pending_if_empty(self, channel, recipient):
+        """Remove `recipient` in `channel` from the pending set and index,
+        unless a record has been stored for them in the meantime.
+
+        Returns the number of records queued for them.
+        """
+        yield self.remove_pending(channel, recipient)
+        # Put it back if a record arrived while we were removing it. Any
+        # record stored after this point indexes itself again.
+        yield self._flushed()
+        remaining = yield self.redis.llen(self.rkey_queue(channel, recipient))
+        if remaining:
+            yield self.add_pending(channel, recipient)
+        returnValue(remaining)
+
+    def store_record(self, channel, recipient, fields):
+        """Queue a record for `recipient` in `channel`.
+
+        With `write_behind_interval` set, the record is buffered and this
+        returns straight away. Otherwise it is written now.
+        """
+        fields = list(fields) + [u'%d' % (self.clock.seconds(),)]
+        if self.owns(channel, recipient):
+            # Otherwise it's another shard's to deliver, so it stays out of
+            # our index and that shard finds it with `check_pending`.
+            self._index_pending(channel, recipient)
+        record = (channel, recipient, fields)
+        if self.config.write_behind_interval <= 0:
+            return self.write_records([record])
+        self._write_buffer.append(record)
+        if len(self._write_buffer) >= self.config.write_behind_max_records:
+            self._flush_from_timer()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(
+                self.config.write_behind_interval, self._flush_from_timer)
+        return succeed(None)
+
+    def write_records(self, records):
+        """Write `(channel, recipient, fields)` records to Redis.
+
+        Every command is sent without waiting for the others, so they all
+        share a round trip. Each list is trimmed and each recipient added
+        to the pending set once, however many records they have.
+        """
+        ds = []
+        keys = OrderedDict()
+        for channel, recipient, fields in records:
+            queue_key = self.rkey_queue(channel, recipient)
+            ds.append(self.redis.rpush(queue_key, self.codec.encode(fields)))
+            keys[queue_key] = self.pending_member(channel, recipient)
+        for queue_key, member in keys.iteritems():
+            if self.config.max_queued > 0:
+                ds.append(self.redis.ltrim(
+                    queue_key, -self.config.max_queued, -1))
+            ds.append(self.redis.sadd(self.rkey_pending(), member))
+        return gatherResults(ds, consumeErrors=True)
+
+    def _flush_from_timer(self):
+        d = self.flush_writes()
+        d.addErrback(log.err)
+
+    def flush_writes(self):
+        """Write any spilled and buffered records to Redis.
+
+        If that fails, the buffered records are appended to `spill_file`,
+        or kept in the buffer to try again later if there isn't one. A
+        failed write may have stored some of its records, so a record can
+        occasionally be stored twice, but it won't be lost.
+        """
+        return self._write_lock.run(self._flush_writes)
+
+    @inlineCallbacks
+    def _flush_writes(self):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        records, self._write_buffer = self._write_buffer, []
+        try:
+            yield self.replay_spill_file()
+            if records:
+                yield self.write_records(records)
+        except Exception:
+            log.err(None, "Failed to write %d records to Redis" % (
+                len(records),))
+            if self.config.spill_file is not None:
+                self.spill_records(records)
+            else:
+                self._write_buffer[:0] = records
+                if self._flush_call is None:
+                    self._flush_call = self.clock.callLater(
+                        self.config.write_behind_interval,
+                        self._flush_from_timer)
+
+    def spill_records(self, records):
+        """Append `records` to `spill_file` and sync it to disk."""
+        if not records:
+            return
+        with open(self.config.spill_file, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._spilled = True
+
+    @inlineCallbacks
+    def replay_spill_file(self):
+        """Write the records in `spill_file` to Redis and remove it.
+
+        The records are indexed again too, since a delivery may have found
+        their queues empty and dropped them from the index while they were
+        waiting in the file.
+        """
+        spill_file = self.config.spill_file
+        if spill_file is None or not os.path.exists(spill_file):
+            return
+        with open(spill_file) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        yield self.write_records(records)
+        os.remove(spill_file)
+        self._spilled = False
+        for channel, recipient, _ in records:
+            if self.owns(channel, recipient):
+                self._index_pending(channel, recipient)
+        log.msg("Wrote %d spilled records from %s to Redis." % (
+            len(records), spill_file))
+
+    def _flushed(self):
+        """Make sure buffered and spilled records are in Redis before we
+        read them.
+        """
+        if self._write_buffer or self._spilled or self._write_lock.locked:
+            return self.flush_writes()
+        return succeed(None)
+
+    @inlineCallbacks
+    def retrieve_records(self, channel, recipient, delete=False):
+        """Return the records queued for `recipient` in `channel`, removing
+        them if `delete` is set.
+        """
+        yield self._flushed()
+        queue_key = self.rkey_queue(channel, recipient)
+        if delete:
+            results = yield gatherResults([
+                self.redis.drain_list(queue_key),
+                self.remove_pending(channel, recipient),
+            ], consumeErrors=True)
+            values = results[0]
+        else:
+            values = yield self.redis.lrange(queue_key, 0, -1)
+        returnValue(self._decode_records(values))
+
+    @inlineCallbacks
+    def deliver_records(self, channel, recipient, deliver):
+        """Remove the records queued for `recipient` in `channel` a chunk at
+        a time, calling `deliver(record)` for each, until there are none left
+        or `max_delivered` have been delivered.
+
+        Only one chunk is held in memory at once. Returns the number of
+        records still queued.
+        """
+        yield self._flushed()
+        queue_key = self.rkey_queue(channel, recipient)
+        chunk_size = self.config.delivery_chunk_size
+        max_delivered = self.config.max_delivered
+        delivered = 0
+        while True:
+            count = chunk_size
+            if max_delivered > 0:
+                count = min(count, max_delivered - delivered)
+            values, remaining = yield self.redis.pop_list(queue_key, count)
+            for record in self._decode_records(values):
+                yield deliver(record)
+            delivered += len(values)
+            if not remaining:
+                # A record may have been stored while we were delivering.
+                remaining = yield self.remove_pending_if_empty(
+                    channel, recipient)
+                break
+            if max_delivered > 0 and delivered >= max_delivered:
+                break
+        returnValue(remaining)
+
+    def _decode_records(self, values):
+        # Drop the timestamp, which older records don't have anyway.
+        n = self.record_fields
+        return [self.codec.decode(value)[:n] for value in values]
+
+    def is_expired(self, record, cutoff):
+        n = self.record_fields
+        return len(record) > n and int(record[n]) < cutoff
+
+    def sweep(self):
+        d = self.sweep_expired()
+        d.addErrback(log.err)
+        return d
+
+    @inlineCallbacks
+    def sweep_expired(self):
+        """Remove expired records from the next batch of keys.
+
+        Each call does a single SCAN step, so a full pass over a large
+        database is spread over many sweeps. Keys for channels owned by
+        other shards are left to them. Returns the number of records
+        removed.
+        """
+        cursor, keys = yield self.redis.scan(
+            self._sweep_cursor, match='*:*',
+            count=self.config.sweep_batch_size)
+        self._sweep_cursor = cursor
+        cutoff = self.clock.seconds() - self.config.queue_ttl
+        removed = 0
+        for queue_key in keys:
+            if not self.owns_queue_key(queue_key):
+                continue
+            count = yield self.remove_expired(queue_key, cutoff)
+            removed += count
+        returnValue(removed)
+
+    @inlineCallbacks
+    def remove_expired(self, queue_key, cutoff):
+        values = yield self.redis.lrange(queue_key, 0, -1)
+        expired = [value for value in values
+                   if self.is_expired(self.codec.decode(value), cutoff)]
+        # LREM removes records by value, so a record delivered in the
+        # meantime is simply not found.
+        for value in expired:
+            yield self.redis.lrem(queue_key, value, 1)
+        if expired:
+            remaining = yield self.redis.llen(queue_key)
+            if not remaining:
+                yield self.remove_pending_if_empty(
+                    *self.split_queue_key(queue_key))
+        returnValue(len(expired))
+
+    @inlineCallbacks
+    def migrate_records(self):
+        """Re-encode stored records owned by our shard with the configured
+        codec.
+
+        Queues under keys from before channel names were normalized are
+        moved to their proper keys first.
+        """
+        queue_keys = yield self.normalize_queue_keys(
+            key_filter=self.owns_queue_key)
+        for queue_key in queue_keys:
+            yield self.add_pending(*self.split_queue_key(queue_key))
+        migrated = yield migrate_lists(
+            self.redis, self.codec, '*:*', key_filter=self.owns_queue_key)
+        for queue_key in migrated:
+            # A delivery may have drained the list while it was being
+            # migrated, so make sure it's still in the index.
+            channel, recipient = self.split_queue_key(queue_key)
+            yield self.add_pending(channel, recipient)
+        returnValue(sum(migrated.values()))
+
 
 class BotWorkerConfig(ApplicationWorker.CONFIG_CLASS):
     command_prefix = ConfigText(
         "Prefix for bot commands.", default="!", static=True)
     message_processors = ConfigDict(
         "Mapping from class name to config dict.", static=True)
+    redis_manager = ConfigDict(
+        "Redis manager config shared by all message processors.",
+        static=True, default={})
+    storage = ConfigText(
+        "Where message processors keep their data: `redis`, using "
+        "`redis_manager`, or `embedded`, in this process using "
+        "`embedded_storage`.", default="redis", static=True)
+    embedded_storage = ConfigDict(
+        "Config for `embedded` storage. `path` is the file changes are "
+        "logged to, so they survive a restart. Without it, nothing is kept. "
+        "Each worker needs its own file.", default={}, static=True)
+    concurrent_processors = ConfigBool(
+        "Run all message processors for a message concurrently instead of "
+        "one after another. Replies are still sent in processor order.",
+        default=False, static=True)
+    max_in_flight = ConfigInt(
+        "Maximum number of inbound messages to process at once. If set, "
+        "messages are processed concurrently up to this limit and we stop "
+        "reading from the transport while the limit is reached. Messages are "
+        "acked once processing starts. Zero (the default) processes one "
+        "message at a time.", default=0, static=True)
+    merge_replies_max_bytes = ConfigInt(
+        "If set, consecutive replies to the same destination are joined into "
+        "a single message of at most this many bytes.", default=0, static=True)
+    merge_replies_separator = ConfigText(
+        "Separator used when joining merged replies.", default=u" | ",
+        static=True)
+    outbound_rate = ConfigFloat(
+        "Maximum outbound messages per second across all channels. If this "
+        "or `channel_outbound_rate` is set, replies are queued until they "
+        "may be sent and queued replies to the same destination are merged "
+        "as for `merge_replies_max_bytes`. Zero means no limit.",
+        default=0, static=True)
+    outbound_burst = ConfigInt(
+        "Number of outbound messages that may be sent at once before "
+        "`outbound_rate` applies.", default=5, static=True)
+    channel_outbound_rate = ConfigFloat(
+        "Maximum outbound messages per second to a single channel or nick. "
+        "Zero means no limit.", default=0, static=True)
+    channel_outbound_burst = ConfigInt(
+        "Number of outbound messages that may be sent to a single channel or "
+        "nick at once before `channel_outbound_rate` applies.",
+        default=3, static=True)
+    stats_sample_rate = ConfigFloat(
+        "Fraction of processor calls to time for latency statistics. Call, "
+        "error and Redis command counts are always kept.",
+        default=0.1, static=True)
+    casemapping = ConfigText(
+        "IRC casemapping used to normalize nicknames and channel names in "
+        "stored keys: `rfc1459`, `strict-rfc1459` or `ascii`.",
+        default="rfc1459", static=True)
+    profile_dir = ConfigText(
+        "Directory profiles are written to.", default="tmp", static=True)
+    profile_max_seconds = ConfigInt(
+        "Longest profile that may be requested.", default=300, static=True)
+    profile_on_startup = ConfigInt(
+        "If set, profile this many seconds of processing from startup.",
+        default=0, static=True)
+    profiler = ConfigText(
+        "Profiler to use for `profile_on_startup`: `cprofile` writes pstats "
+        "data and `sample` writes collapsed stacks for flame graphs.",
+        default="cprofile", static=True)
+    lazy_processors = ConfigDict(
+        "Mapping from the class names of processors in `message_processors` "
+        "that should only be loaded when first needed to the commands that "
+        "load them. Until then they see no messages, and once loaded they "
+        "come after all the other processors.", default={}, static=True)
+    config_file = ConfigText(
+        "Path to the YAML file this worker's config was loaded from. If set, "
+        "`message_processors` is re-read from it and changed processors are "
+        "restarted on SIGHUP or the `!reload` admin command.",
+        default=None, static=True)
+    shard_count = ConfigInt(
+        "Number of workers sharing the bot's channels. Each channel (or "
+        "nick, for private messages) is owned by one of them, as chosen by "
+        "`vumibot.dispatch.ChannelHashRouter`.", default=1, static=True)
+    shard_index = ConfigInt(
+        "Which of the `shard_count` shards this worker is, counting from "
+        "zero. Messages for channels owned by other shards are dropped.",
+        default=0, static=True)
 
 
 class BotWorker(ApplicationWorker):
     CONFIG_CLASS = BotWorkerConfig
 
+    clock = reactor
+
     @inlineCallbacks
     def setup_application(self):
         config = self.get_static_config()
         self.command_prefix = config.command_prefix
+        self.redis = None
+        self._redis_lock = DeferredLock()
+        self.stats = ProcessorStats(config.stats_sample_rate)
+        self.normalizer = IRCNormalizer(config.casemapping)
+        self.shard_count = config.shard_count
+        self.shard_index = config.shard_index
+        self.profiler = WorkerProfiler(
+            self.clock, config.profile_dir, config.profile_max_seconds,
+            name=config.transport_name)
+        self.concurrent_processors = config.concurrent_processors
+        self.merge_replies_max_bytes = config.merge_replies_max_bytes
+        self.merge_replies_separator = config.merge_replies_separator
+        self._outbound_batches = {}
+        self.outbound_scheduler = None
+        if config.outbound_rate > 0 or config.channel_outbound_rate > 0:
+            merge = None
+            if self.merge_replies_max_bytes > 0:
+                merge = self.merge_reply
+            self.outbound_scheduler = OutboundScheduler(
+                self._publish_message, self.clock,
+                rate=config.outbound_rate, burst=config.outbound_burst,
+                channel_rate=config.channel_outbound_rate,
+                channel_burst=config.channel_outbound_burst, merge=merge)
+        self.in_flight = None
+        self._in_flight_ds = set()
+        if config.max_in_flight > 0:
+            self.in_flight = DeferredSemaphore(config.max_in_flight)
+        self.config_file = config.config_file
+        self._old_sighup = None
+        self._processing = set()
+        self._retiring = set()
+        self._reload_lock = DeferredLock()
         self.message_processors = []
-        for proc_cls, proc_config in config.message_processors.iteritems():
-            cls = load_class_by_string(proc_cls)
-            proc = cls(self, proc_config)
+        self.chatter_processors = []
+        self.command_index = {}
+        self.processors_by_name = {}
+        self.setup_times = {}
+        self.lazy_processor_commands = config.lazy_processors
+        for proc_name in self.lazy_processor_commands:
+            if proc_name not in config.message_processors:
+                raise ConfigError(
+                    "Lazy processor %s is not in message_processors." % (
+                        proc_name,))
+        if config.storage not in ('redis', 'embedded'):
+            raise ConfigError(
+                "Unknown storage %r. Choose from: embedded, redis." % (
+                    config.storage,))
+        if not 0 <= self.shard_index < self.shard_count:
+            raise ConfigError("shard_index must be from 0 to %d." % (
+                self.shard_count - 1,))
+        lazy_processors = {}
+        setup_started = time.time()
+        ds = []
+        for proc_name, proc_config in config.message_processors.iteritems():
+            if proc_name in self.lazy_processor_commands:
+                lazy_processors[proc_name] = proc_config
+                continue
+            started = time.time()
+            proc = self.load_processor(proc_name, proc_config)
             self.message_processors.append(proc)
-            yield proc.setup_message_processor()
+            self.processors_by_name[proc_name] = (proc, proc_config)
+            self.index_commands(self.command_index, proc)
+            ds.append(self.setup_processor(proc_name, proc, started))
+        self.set_lazy_processors(lazy_processors)
+        self.set_command_index(self.command_index)
+        self.set_message_processors(self.message_processors)
+        try:
+            yield gatherResults(ds, consumeErrors=True)
+        except FirstError as e:
+            # Fail with the processor's own error rather than the wrapper.
+            e.subFailure.raiseException()
+        log.msg("Set up %d message processors in %.3fs (%d lazy)." % (
+            len(self.message_processors), time.time() - setup_started,
+            len(lazy_processors)))
+        if self.config_file is not None:
+            self._old_sighup = signal.signal(signal.SIGHUP, self._sighup)
+        if config.profile_on_startup > 0:
+            self.profiler.start(config.profile_on_startup, config.profiler)
+
+    def owns(self, channel, nickname):
+        """Return `True` if our shard owns `channel`, or the private
+        conversation with `nickname` if `channel` is `None`.
+        """
+        if self.shard_count == 1:
+            return True
+        name = channel if channel is not None else nickname
+        return shard_for(
+            self.normalizer.normalize(name) or '',
+            self.shard_count) == self.shard_index
+
+    def load_processor(self, proc_name, proc_config):
+        cls = load_class_by_string(proc_name)
+        if (not cls.wants_all_messages and
+                cls.handle_message != BotMessageProcessor.handle_message):
+            log.msg("Warning: %s overrides handle_message but doesn't set "
+                    "wants_all_messages, so it will only see its own "
+                    "commands." % (proc_name,))
+        return cls(self, proc_config)
+
+    @inlineCallbacks
+    def setup_processor(self, proc_name, proc, started):
+        """Set up `proc` and log how long it took since `started`, which
+        should be before its class was loaded.
+        """
+        yield proc.setup_message_processor()
+        elapsed = time.time() - started
+        self.setup_times[proc_name] = elapsed
+        log.msg("Set up %s in %.3fs." % (proc_name, elapsed))
+        returnValue(proc)
+
+    def set_lazy_processors(self, lazy_processors):
+        """Set the processors that haven't been loaded yet, as a mapping
+        from name to config, and the commands that will load them.
+        """
+        self.lazy_processors = lazy_processors
+        self.lazy_commands = {}
+        for proc_name in lazy_processors:
+            for command in self.lazy_processor_commands[proc_name]:
+                self.lazy_commands[command] = proc_name
+
+    def load_lazy_processor(self, proc_name):
+        """Load and set up a lazy processor, adding it to the end of the
+        processor list.
+        """
+        return self._reload_lock.run(self._load_lazy_processor, proc_name)
+
+    @inlineCallbacks
+    def _load_lazy_processor(self, proc_name):
+        if proc_name not in self.lazy_processors:
+            # Someone else got here first.
+            return
+        proc_config = self.lazy_processors[proc_name]
+        started = time.time()
+        proc = self.load_processor(proc_name, proc_config)
+        yield self.setup_processor(proc_name, proc, started)
+
+        lazy_processors = dict(self.lazy_processors)
+        del lazy_processors[proc_name]
+        processors_by_name = dict(self.processors_by_name)
+        processors_by_name[proc_name] = (proc, proc_config)
+        procs = self.message_processors + [proc]
+
+        self.set_lazy_processors(lazy_processors)
+        self.processors_by_name = processors_by_name
+        self.set_message_processors(procs)
+        self.set_command_index(self.build_command_index(procs))
+
+    def set_message_processors(self, procs):
+        """Set the processors to run, in order, and pick out the ones that
+        want to see every message.
+        """
+        self.message_processors = procs
+        self.chatter_processors = [
+            proc for proc in procs if proc.wants_all_messages]
+
+    def set_command_index(self, command_index):
+        """Set the mapping from command name to processors, and compile a
+        router for those commands and the ones that load lazy processors.
+        This should come after `set_lazy_processors`.
+        """
+        self.command_index = command_index
+        self.command_router = CommandRouter(
+            list(command_index) + list(self.lazy_commands))
+
+    def index_commands(self, command_index, proc):
+        for command_name in proc.commands:
+            command_index.setdefault(command_name, []).append(proc)
+
+    def build_command_index(self, procs):
+        command_index = {}
+        for proc in procs:
+            self.index_commands(command_index, proc)
+        return command_index
+
+    def _sighup(self, signum, frame):
+        reactor.callFromThread(self._reload_from_signal)
+
+    def _reload_from_signal(self):
+        d = self.reload_processors()
+        d.addCallback(lambda result: log.msg("Reloaded processors:", result))
+        d.addErrback(log.err, "Failed to reload processors")
+        return d
+
+    def read_processors_config(self):
+        if self.config_file is None:
+            raise ConfigError("No config_file to reload from.")
+        with open(self.config_file) as f:
+            config = yaml.safe_load(f)
+        return config.get('message_processors', {})
+
+    def reload_processors(self, processors_config=None):
+        """Restart the processors whose config changed.
+
+        `processors_config` defaults to `message_processors` from
+        `config_file`. New and changed processors are set up first, then
+        the dispatch table is swapped in one go. Messages already being
+        processed finish with the processors they started with, and the old
+        processors are torn down once they have. Changed processors are
+        then told about the processor they replaced, so they can pick up
+        anything it stored in the meantime.
+
+        Returns a deferred that fires with a dict listing the processors
+        `started`, `stopped` and `unchanged`.
+        """
+        return self._reload_lock.run(
+            self._reload_processors, processors_config)
+
+    @inlineCallbacks
+    def _reload_processors(self, processors_config):
+        if processors_config is None:
+            processors_config = self.read_processors_config()
+        old = self.processors_by_name
+        # Lazy processors that haven't been loaded yet stay lazy.
+        lazy = [name for name in processors_config
+                if name in self.lazy_processor_commands and name not in old]
+        unchanged = [
+            name for name, proc_config in processors_config.iteritems()
+            if name in old and old[name][1] == proc_config]
+        started = [name for name in processors_config
+                   if name not in unchanged and name not in lazy]
+        stopped = [name for name in old if name not in unchanged]
+        replaced = [name for name in started if name in old]
+
+        for name in replaced:
+            yield maybeDeferred(old[name][0].prepare_for_replacement)
+        new_procs = {}
+        try:
+            for name in started:
+                setup_started = time.time()
+                proc = self.load_processor(name, processors_config[name])
+                yield self.setup_processor(name, proc, setup_started)
+                new_procs[name] = proc
+        except Exception:
+            for proc in new_procs.itervalues():
+                yield proc.teardown_message_processor()
+            raise
+
+        processors_by_name = {}
+        for name, proc_config in processors_config.iteritems():
+            if name in lazy:
+                continue
+            if name in new_procs:
+                processors_by_name[name] = (new_procs[name], proc_config)
+            else:
+                processors_by_name[name] = old[name]
+        procs = [processors_by_name[name][0] for name in processors_config
+                 if name in processors_by_name]
+        retired = [old[name][0] for name in stopped]
+        handovers = [(new_procs[name], old[name][0]) for name in replaced]
+
+        # Swap everything at once, with no yields in between.
+        self.set_lazy_processors(
+            dict((name, processors_config[name]) for name in lazy))
+        self.processors_by_name = processors_by_name
+        self.set_message_processors(procs)
+        self.set_command_index(self.build_command_index(procs))
+
+        d = gatherResults(list(self._processing))
+        d.addCallback(lambda _: self._teardown_processors(retired))
+        d.addCallback(lambda _: self._hand_over(handovers))
+        d.addErrback(log.err, "Failed to tear down old processors")
+        self._retiring.add(d)
+        d.addBoth(lambda _: self._retiring.discard(d))
+
+        returnValue({
+            'started': sorted(started),
+            'stopped': sorted(stopped),
+            'unchanged': sorted(unchanged),
+        })
+
+    @inlineCallbacks
+    def _teardown_processors(self, procs):
+        for proc in procs:
+            yield proc.teardown_message_processor()
+
+    @inlineCallbacks
+    def _hand_over(self, handovers):
+        for new_proc, old_proc in handovers:
+            yield maybeDeferred(new_proc.take_over_from, old_proc)
 
     @inlineCallbacks
     def teardown_application(self):
+        self.profiler.stop()
+        if self.config_file is not None:
+            signal.signal(signal.SIGHUP, self._old_sighup or signal.SIG_DFL)
+        yield gatherResults(list(self._in_flight_ds))
+        yield gatherResults(list(self._retiring))
+        if self.outbound_scheduler is not None:
+            yield self.outbound_scheduler.stop()
         while self.message_processors:
             yield self.message_processors.pop().teardown_message_processor()
+        if self.redis is not None:
+            yield self.redis.close_manager()
+            self.redis = None
+
+    @inlineCallbacks
+    def get_redis(self, sub_prefix, proc=None):
+        """Return a sub-manager of the worker's Redis manager, or of its
+        embedded store if `storage` is `embedded`, connecting the first time
+        any processor asks for one.
+
+        If `proc` is given, Redis commands sent through the sub-manager are
+        counted in that processor's stats.
+        """
+        yield self._redis_lock.run(self._connect_redis)
+        redis = self.redis.sub_manager(sub_prefix)
+        if proc is not None:
+            self.stats.instrument_redis(type(proc).__name__, redis)
+        returnValue(redis)
+
+    @inlineCallbacks
+    def _connect_redis(self):
+        if self.redis is None:
+            config = self.get_static_config()
+            if config.storage == 'embedded':
+                self.redis = EmbeddedStore.from_config(
+                    config.embedded_storage)
+            else:
+                self.redis = yield RedisStore.from_config(
+                    config.redis_manager)
+
+    @property
+    def in_flight_count(self):
+        """Number of messages currently being processed concurrently."""
+        return len(self._in_flight_ds)
+
+    @property
+    def paused(self):
+        """`True` while a message is waiting for a free processing slot.
+
+        The transport consumer waits for each message to be dispatched
+        before it reads the next, so at most one message ever waits here.
+        While one does, the backlog builds up in the broker instead.
+        """
+        return self.in_flight is not None and bool(self.in_flight.waiting)
+
+    def dispatch_user_message(self, message):
+        """Dispatch user messages, bounded by `max_in_flight` if set.
+
+        With a limit, the returned deferred fires as soon as the message has
+        a processing slot, so the transport consumer is only held up while
+        every slot is busy.
+        """
+        if self.in_flight is None:
+            return super(BotWorker, self).dispatch_user_message(message)
+        d = self.in_flight.acquire()
+        return d.addCallback(lambda _: self._start_in_flight(message))
+
+    def _start_in_flight(self, message):
+        d = maybeDeferred(
+            super(BotWorker, self).dispatch_user_message, message)
+        d.addErrback(log.err)
+        self._in_flight_ds.add(d)
+        d.addCallback(self._finish_in_flight, d)
+
+    def _finish_in_flight(self, _result, d):
+        self._in_flight_ds.discard(d)
+        self.in_flight.release()
+
+    def reply_to(self, original_message, content, continue_session=True,
+                 **kws):
+        reply = original_message.reply(content, continue_session, **kws)
+        return self.publish_reply(original_message, reply)
+
+    def reply_to_group(self, original_message, content, continue_session=True,
+                       **kws):
+        reply = original_message.reply_group(content, continue_session, **kws)
+        return self.publish_reply(original_message, reply)
+
+    def reply_to_user(self, original_message, content, continue_session=True,
+                      **kws):
+        """Reply to the sender by private message, even if the original
+        message was sent to a channel.
+        """
+        reply = original_message.reply(content, continue_session, **kws)
+        reply['group'] = None
+        # The IRC transport falls back to this if there's no group.
+        transport_metadata = dict(reply['transport_metadata'])
+        transport_metadata.pop('irc_channel', None)
+        reply['transport_metadata'] = transport_metadata
+        return self.publish_reply(original_message, reply)
+
+    def publish_reply(self, original_message, reply):
+        """Publish a reply, or add it to the outbound batch for the original
+        message if we're still processing it.
+        """
+        endpoint_name = original_message.get_routing_endpoint()
+        batch = self._outbound_batches.get(original_message['message_id'])
+        if batch is None:
+            return self.send_reply(reply, endpoint_name)
+        batch.append((reply, endpoint_name))
+        return succeed(None)
+
+    def send_reply(self, reply, endpoint_name):
+        if self.outbound_scheduler is None:
+            return self._publish_message(reply, endpoint_name=endpoint_name)
+        channel = reply['group'] or reply['to_addr']
+        return self.outbound_scheduler.send(channel, reply, endpoint_name)
+
+    def start_outbound_batch(self, message):
+        self._outbound_batches[message['message_id']] = []
+
+    def flush_outbound_batch(self, message):
+        """Publish all the replies batched for `message` together and return
+        a deferred that fires when they have all been published.
+
+        If outbound rate limiting is enabled, we don't wait for queued
+        replies to be sent, since that would hold up inbound messages too.
+        """
+        batch = self._outbound_batches.pop(message['message_id'], [])
+        if self.merge_replies_max_bytes > 0:
+            batch = self.merge_replies(batch)
+        d = gatherResults([
+            self.send_reply(reply, endpoint_name)
+            for reply, endpoint_name in batch], consumeErrors=True)
+        if self.outbound_scheduler is not None:
+            d.addErrback(log.err)
+            return succeed(None)
+        return d
+
+    def _merge_key(self, reply):
+        return tuple(reply.get(field) for field in [
+            'to_addr', 'group', 'session_event', 'helper_metadata'])
+
+    def _merge_into(self, prev_reply, reply):
+        if prev_reply['content'] is None or reply['content'] is None:
+            return False
+        content = self.merge_replies_separator.join(
+            [prev_reply['content'], reply['content']])
+        if len(content.encode('utf-8')) > self.merge_replies_max_bytes:
+            return False
+        prev_reply['content'] = content
+        return True
+
+    def merge_reply(self, prev_reply, reply):
+        """Merge `reply` into `prev_reply` if they have the same destination
+        and the result fits, returning `True` if we did.
+        """
+        if self._merge_key(prev_reply) != self._merge_key(reply):
+            return False
+        return self._merge_into(prev_reply, reply)
+
+    def merge_replies(self, batch):
+        """Join consecutive replies to the same destination into messages of
+        at most `merge_replies_max_bytes` bytes.
+        """
+        merged = []
+        for reply, endpoint_name in batch:
+            if merged:
+                prev_reply, prev_endpoint_name = merged[-1]
+                if (prev_endpoint_name == endpoint_name and
+                        self.merge_reply(prev_reply, reply)):
+                    continue
+            merged.append((reply, endpoint_name))
+        return merged
+
+    def find_command_processors(self, command_name):
+        return self.command_index.get(command_name, ())
 
     def parse_user_message(self, message):
-        content = message['content']
-        is_command = False
+        content = message['content'] or ''
 
         if content.startswith(self.command_prefix):
-            is_command = True
             content = content[len(self.command_prefix):]
-        elif message['to_addr'] is not None:
-            is_command = True
+        elif message['to_addr'] is None:
+            # Chatter, which we don't need to split up.
+            return ParsedMessage(False, content, '')
 
-        return (is_command, content)
+        routed = self.command_router.route(content)
+        if routed is None:
+            # Not a command anyone handles.
+            return ParsedMessage(True, content, '')
+        command, params = routed
+        return ParsedMessage(True, content, command, params)
 
     def listify_replies(self, replies):
         if not replies:
@@ -119,24 +1404,96 @@ class BotWorker(ApplicationWorker):
         return replies
 
     @inlineCallbacks
-    def consume_user_message(self, message):
-        replies = []
+    def process_message(self, proc, message, parsed, command_procs):
+        """Run a single processor over a message and return its replies.
 
-        for proc in self.message_processors:
+        Errors are logged here so that one misbehaving processor can't stop
+        the others from replying.
+        """
+        replies = []
+        proc_name = type(proc).__name__
+        if proc.wants_all_messages:
+            timer = self.stats.start(proc_name, MESSAGE_COMMAND)
             try:
                 rpl = yield proc.handle_message(message)
                 replies.extend(self.listify_replies(rpl))
             except Exception:
+                self.stats.finish(timer, error=True)
                 log.err()
+            else:
+                self.stats.finish(timer)
+
+        if proc not in command_procs:
+            returnValue(replies)
 
+        timer = self.stats.start(proc_name, parsed.command)
+        try:
+            rpl = yield proc.handle_command(message, parsed)
+            replies.extend(self.listify_replies(rpl))
+        except Exception, e:
+            self.stats.finish(timer, error=True)
+            log.err()
+            replies.append('eep! %s: %s.' % (type(e).__name__, e))
+        else:
+            self.stats.finish(timer)
+        returnValue(replies)
+
+    @inlineCallbacks
+    def consume_user_message(self, message):
+        # Track this message so a reload waits for it before tearing down
+        # the processors it's using.
+        done = Deferred()
+        self._processing.add(done)
+        try:
+            yield self._consume_user_message(message)
+        finally:
+            self._processing.discard(done)
+            done.callback(None)
+
+    @inlineCallbacks
+    def _consume_user_message(self, message):
+        if not self.owns(message['group'], message['from_addr']):
+            log.msg("Dropping message for %s, which shard %d of %d doesn't "
+                    "own. Check the router's shard count." % (
+                        message['group'] or message['from_addr'],
+                        self.shard_index, self.shard_count))
+            return
+        parsed = self.parse_user_message(message)
+        if parsed.is_command and parsed.command in self.lazy_commands:
             try:
-                is_command, content = self.parse_user_message(message)
-                if is_command:
-                    rpl = yield proc.handle_command(message, content)
-                    replies.extend(self.listify_replies(rpl))
-            except Exception, e:
-                log.err()
-                replies.append('eep! %s: %s.' % (type(e).__name__, e))
+                yield self.load_lazy_processor(
+                    self.lazy_commands[parsed.command])
+            except Exception:
+                log.err(None, "Failed to load lazy processor")
+        # Hold on to the current processors, so a reload while we're busy
+        # doesn't give us a mix of old and new ones.
+        procs = self.chatter_processors
+        command_procs = ()
+        if parsed.is_command:
+            command_procs = self.find_command_processors(parsed.command)
+        if command_procs:
+            procs = [proc for proc in self.message_processors
+                     if proc.wants_all_messages or proc in command_procs]
+        if not procs:
+            return
+
+        self.start_outbound_batch(message)
+        if self.concurrent_processors:
+            proc_replies = yield gatherResults([
+                self.process_message(proc, message, parsed, command_procs)
+                for proc in procs])
+        else:
+            proc_replies = []
+            for proc in procs:
+                rpls = yield self.process_message(
+                    proc, message, parsed, command_procs)
+                proc_replies.append(rpls)
+
+        for replies in proc_replies:
+            for reply in replies:
+                self.reply_to(message, reply)
 
-        for reply in replies:
-            self.reply_to(message, reply)
+        try:
+            yield self.flush_outbound_batch(message)
+        except Exception:
+            log.err()
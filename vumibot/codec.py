@@ -0,0 +1,105 @@
+# -*- test-case-name: tests.test_codec -*-
+
+"""Encodings for records stored in Redis lists.
+
+Records are short sequences of text fields, such as `[sender, text]`. We
+started out storing them as JSON, so every codec here can read JSON records
+as well as its own format, and new formats start with a version byte that
+can never begin a JSON list.
+"""
+
+import json
+
+from vumi.errors import ConfigError
+
+
+COMPACT_V1 = '\x01'
+
+
+def encode_varint(value):
+    parts = []
+    while value > 0x7f:
+        parts.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    parts.append(chr(value))
+    return ''.join(parts)
+
+
+def decode_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def decode_compact(data):
+    fields = []
+    pos = 1
+    while pos < len(data):
+        length, pos = decode_varint(data, pos)
+        fields.append(data[pos:pos + length].decode('utf-8'))
+        pos += length
+    return fields
+
+
+def decode_record(data):
+    """Decode a record written by any codec."""
+    if data[:1] == COMPACT_V1:
+        return decode_compact(data)
+    return json.loads(data)
+
+
+class JSONCodec(object):
+    """The original format: a JSON list."""
+
+    name = 'json'
+
+    def encode(self, fields):
+        return json.dumps(list(fields))
+
+    def decode(self, data):
+        return decode_record(data)
+
+    def is_current(self, data):
+        return data[:1] == '['
+
+
+class CompactCodec(object):
+    """A version byte followed by a varint length and UTF-8 bytes for each
+    field. Smaller than JSON and decoded without a parser.
+    """
+
+    name = 'compact'
+
+    def encode(self, fields):
+        parts = [COMPACT_V1]
+        for field in fields:
+            if isinstance(field, unicode):
+                field = field.encode('utf-8')
+            parts.append(encode_varint(len(field)))
+            parts.append(field)
+        return ''.join(parts)
+
+    def decode(self, data):
+        return decode_record(data)
+
+    def is_current(self, data):
+        return data[:1] == COMPACT_V1
+
+
+CODECS = {
+    JSONCodec.name: JSONCodec,
+    CompactCodec.name: CompactCodec,
+}
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise ConfigError("Unknown record codec %r. Choose from: %s." % (
+            name, ', '.join(sorted(CODECS))))
+    return CODECS[name]()
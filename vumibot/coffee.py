@@ -2,22 +2,12 @@
 
 """Track coffee on IRC."""
 
-import json
-
 from twisted.internet.defer import inlineCallbacks, returnValue
-from vumi import log
-from vumi.config import ConfigDict
-from vumi.persist.txredis_manager import TxRedisManager
-
-from vumibot.base import BotMessageProcessor, botcommand
-
 
-class CoffeeMessageProcessorConfig(BotMessageProcessor.CONFIG_CLASS):
-    redis_manager = ConfigDict(
-        "Redis manager config.", static=True, default={})
+from vumibot.base import QueuedDeliveryProcessor, botcommand
 
 
-class CoffeeMessageProcessor(BotMessageProcessor):
+class CoffeeMessageProcessor(QueuedDeliveryProcessor):
     """Track coffee on IRC
 
     Configuration
@@ -26,34 +16,16 @@ class CoffeeMessageProcessor(BotMessageProcessor):
         Name of this worker. Used as part of the Redis key prefix.
     """
 
-    CONFIG_CLASS = CoffeeMessageProcessorConfig
-
-    @inlineCallbacks
-    def setup_message_processor(self):
-        self.base_redis = yield TxRedisManager.from_config(
-            self.config.redis_manager)
-        self.redis = self.base_redis.sub_manager('ircbot:coffee')
-
-    @inlineCallbacks
-    def teardown_message_processor(self):
-        yield self.redis.close_manager()
-        yield self.base_redis.close_manager()
+    redis_prefix = 'ircbot:coffee'
 
     def rkey_violation(self, channel, recipient):
-        return "%s:%s" % (channel, recipient)
+        return self.rkey_queue(channel, recipient)
 
     def store_violation(self, channel, recipient, sender, text):
-        violation_key = self.rkey_violation(channel, recipient)
-        value = json.dumps([sender, text])
-        return self.redis.rpush(violation_key, value)
+        return self.store_record(channel, recipient, [sender, text])
 
-    @inlineCallbacks
     def retrieve_violations(self, channel, recipient, delete=False):
-        violation_key = self.rkey_violation(channel, recipient)
-        violations = yield self.redis.lrange(violation_key, 0, -1)
-        if delete:
-            yield self.redis.delete(violation_key)
-        returnValue([json.loads(value) for value in violations])
+        return self.retrieve_records(channel, recipient, delete=delete)
 
     @botcommand(r'$')
     @inlineCallbacks
@@ -63,14 +35,15 @@ class CoffeeMessageProcessor(BotMessageProcessor):
         channel = message['group']
         nickname = message.user()
 
-        violations = yield self.retrieve_violations(
-            channel, nickname, delete=True)
-        if violations:
-            log.msg("Time to deliver some violations:", violations)
-        returnValue([
-            "%s, %s says you butchered this: %s" % (
-                nickname, violation_sender, violation_text)
-            for violation_sender, violation_text in violations])
+        def deliver((violation_sender, violation_text)):
+            return self.reply_to(
+                message, "%s, %s says you butchered this: %s" % (
+                    nickname, violation_sender, violation_text))
+
+        remaining = yield self.deliver_records(channel, nickname, deliver)
+        if remaining:
+            returnValue("%s more pending, say !mycoffee again." % (
+                remaining,))
 
     @botcommand(r'(?P<target>\S+)\s+(?P<violation_text>.+)$')
     @inlineCallbacks
@@ -79,7 +52,7 @@ class CoffeeMessageProcessor(BotMessageProcessor):
 
         channel = message['group']
 
-        recipient = target.lower()
+        recipient = self.normalize(target)
         sender = message['from_addr']
         yield self.store_violation(channel, recipient, sender, violation_text)
         returnValue("Oh boy!")
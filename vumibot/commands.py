@@ -0,0 +1,32 @@
+# -*- test-case-name: tests.test_commands -*-
+
+"""Routing command text to the processors that handle it."""
+
+
+class CommandRouter(object):
+    """Split command text into a command and its parameters, checking the
+    command against every known command name.
+
+    This is one split and one set lookup. A regex compiled from a prefix
+    trie of the command names is slower, since a regex match costs several
+    times as much as `str.split` in CPython; see
+    `benchmarks/bench_commands.py`. Text that doesn't start with one of
+    `command_names` is rejected before its parameters are stripped.
+    """
+
+    def __init__(self, command_names):
+        self.command_names = frozenset(command_names)
+
+    def route(self, content):
+        """Return `(command, params)` for `content`, or `None` if it isn't a
+        command we know.
+        """
+        if not content:
+            return None
+        parts = content.split(None, 1)
+        if not parts or parts[0] not in self.command_names:
+            return None
+        if len(parts) == 1:
+            return parts[0], ''
+        # The split already dropped the whitespace before the params.
+        return parts[0], parts[1].rstrip()
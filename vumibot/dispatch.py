@@ -0,0 +1,47 @@
+# -*- test-case-name: tests.test_dispatch -*-
+
+"""Dispatch routers for running the bot as several workers."""
+
+from vumi.dispatchers.base import SimpleDispatchRouter
+
+from vumibot.base import IRCNormalizer, shard_for
+
+
+class ChannelHashRouter(SimpleDispatchRouter):
+    """Spread inbound messages over a set of sharded bot workers by channel.
+
+    Each transport in `route_mappings` maps to the exposed names of its
+    shards, in shard order, so the worker attached to the Nth name should
+    have `shard_index: N` and `shard_count` set to the number of names.
+    Messages for a channel always go to the same shard, or for private
+    messages, the shard for the sender's nick. A shard consumes its queue in
+    order, so per-channel ordering is preserved as long as the workers don't
+    set `max_in_flight`.
+
+    Events are sent to every shard, as with `SimpleDispatchRouter`, since
+    they don't say which channel they belong to. Outbound messages are
+    routed as for `SimpleDispatchRouter`.
+
+    Configuration options:
+
+    :param dict route_mappings:
+        A map of *transport_names* to the *exposed_names* of their shards.
+
+    :param str casemapping:
+        IRC casemapping used to normalize channel names and nicks before
+        hashing. This must match the workers' `casemapping`. Defaults to
+        `rfc1459`.
+    """
+
+    def setup_routing(self):
+        self.normalizer = IRCNormalizer(
+            self.config.get('casemapping', 'rfc1459'))
+
+    def shard_name(self, msg):
+        names = self.config['route_mappings'][msg['transport_name']]
+        name = msg['group'] if msg['group'] is not None else msg['from_addr']
+        return names[shard_for(
+            self.normalizer.normalize(name) or '', len(names))]
+
+    def dispatch_inbound_message(self, msg):
+        self.dispatcher.publish_inbound_message(self.shard_name(msg), msg)
@@ -2,22 +2,28 @@
 
 """Demo workers for constructing a simple IRC bot."""
 
-import json
+from functools import partial
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 from vumi import log
-from vumi.config import ConfigDict
-from vumi.persist.txredis_manager import TxRedisManager
+from vumi.config import ConfigBool
+from vumi.errors import ConfigError
 
-from vumibot.base import BotMessageProcessor, botcommand
+from vumibot.base import QueuedDeliveryProcessor, botcommand
 
 
-class MemoMessageProcessorConfig(BotMessageProcessor.CONFIG_CLASS):
-    redis_manager = ConfigDict(
-        "Redis manager config.", static=True, default={})
+class MemoMessageProcessorConfig(QueuedDeliveryProcessor.CONFIG_CLASS):
+    deliver_all_channels = ConfigBool(
+        "Deliver a user's memos from every channel when they speak anywhere, "
+        "instead of only those for the channel they speak in. Memos from "
+        "other channels are sent by private message. Can't be used when "
+        "the bot is sharded.",
+        default=False, static=True)
+    private_delivery = ConfigBool(
+        "Deliver all memos by private message.", default=False, static=True)
 
 
-class MemoMessageProcessor(BotMessageProcessor):
+class MemoMessageProcessor(QueuedDeliveryProcessor):
     """Watches for memos to users and notifies users of memos when users
     appear.
 
@@ -29,45 +35,73 @@ class MemoMessageProcessor(BotMessageProcessor):
 
     CONFIG_CLASS = MemoMessageProcessorConfig
 
-    @inlineCallbacks
-    def setup_message_processor(self):
-        self.base_redis = yield TxRedisManager.from_config(
-            self.config.redis_manager)
-        self.redis = self.base_redis.sub_manager('ircbot:memo')
+    wants_all_messages = True
+
+    redis_prefix = 'ircbot:memo'
 
     @inlineCallbacks
-    def teardown_message_processor(self):
-        yield self.redis.close_manager()
-        yield self.base_redis.close_manager()
+    def setup_message_processor(self):
+        self.skipped_lookups = 0
+        yield super(MemoMessageProcessor, self).setup_message_processor()
+        if self.config.deliver_all_channels and (
+                self._app_worker.shard_count > 1):
+            # Other shards hold the memos for their channels.
+            raise ConfigError(
+                "deliver_all_channels can't be used with shard_count > 1.")
 
     def rkey_memo(self, channel, recipient):
-        return "%s:%s" % (channel, recipient)
+        return self.rkey_queue(channel, recipient)
+
+    def has_pending_memos(self, channel, recipient):
+        return self.has_pending(channel, recipient)
 
     def store_memo(self, channel, recipient, sender, text):
-        memo_key = self.rkey_memo(channel, recipient)
-        value = json.dumps([sender, text])
-        return self.redis.rpush(memo_key, value)
+        return self.store_record(channel, recipient, [sender, text])
 
-    @inlineCallbacks
     def retrieve_memos(self, channel, recipient, delete=False):
-        memo_key = self.rkey_memo(channel, recipient)
-        memos = yield self.redis.lrange(memo_key, 0, -1)
-        if delete:
-            yield self.redis.delete(memo_key)
-        returnValue([json.loads(value) for value in memos])
+        return self.retrieve_records(channel, recipient, delete=delete)
 
     @inlineCallbacks
     def handle_message(self, message):
         nickname = message.user()
         channel = message['group']
 
-        memos = yield self.retrieve_memos(channel, nickname, delete=True)
-        if memos:
-            log.msg("Time to deliver some memos:", memos)
-        for memo_sender, memo_text in memos:
-            yield self.reply_to_group(
+        if self.config.deliver_all_channels:
+            memo_channels = self.get_pending_channels(nickname)
+        elif (yield self.check_pending(channel, nickname)):
+            memo_channels = [self.normalize(channel)]
+        else:
+            memo_channels = []
+        if not memo_channels:
+            self.skipped_lookups += 1
+            return
+
+        log.msg("Time to deliver some memos:", nickname, memo_channels)
+        remaining = 0
+        for memo_channel in memo_channels:
+            count = yield self.deliver_records(
+                memo_channel, nickname,
+                partial(self.deliver_memo, message, memo_channel))
+            remaining += count
+        if remaining:
+            yield self.reply_to(
+                message, "%s more memos waiting. Say something again to get "
+                "them." % (remaining,))
+
+    def deliver_memo(self, message, memo_channel, memo):
+        memo_sender, memo_text = memo
+        nickname = message.user()
+        in_channel = (
+            self.normalize(memo_channel) == self.normalize(message['group']))
+        if in_channel and not self.config.private_delivery:
+            return self.reply_to_group(
                 message, "%s, %s asked me tell you: %s" % (
                     nickname, memo_sender, memo_text))
+        # Memos from other channels always go by private message so we
+        # don't leak them into the channel we're in.
+        return self.reply_to_user(
+            message, "%s, %s asked me tell you (in %s): %s" % (
+                nickname, memo_sender, memo_channel, memo_text))
 
     @botcommand(r'(?P<target>\S+)\s+(?P<memo_text>.+)$')
     @inlineCallbacks
@@ -76,7 +110,7 @@ class MemoMessageProcessor(BotMessageProcessor):
 
         channel = message['group']
 
-        recipient = target.lower()
+        recipient = self.normalize(target)
         sender = message['from_addr']
         yield self.store_memo(channel, recipient, sender, memo_text)
         returnValue("Sure thing, boss.")
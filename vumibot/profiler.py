@@ -0,0 +1,136 @@
+# -*- test-case-name: tests.test_profiler -*-
+
+"""Profiling for running bot workers."""
+
+import cProfile
+import os
+import signal
+import time
+from collections import defaultdict
+
+
+class DeterministicProfiler(object):
+    """Wraps `cProfile` and dumps pstats data."""
+
+    suffix = 'pstats'
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, filename):
+        self.profile.dump_stats(filename)
+
+
+class SamplingProfiler(object):
+    """Samples the Python stack on `SIGPROF` and dumps it in the collapsed
+    stack format read by `flamegraph.pl` and friends.
+
+    This only works in the main thread, which is where the reactor runs.
+    """
+
+    suffix = 'folded'
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self._old_handler = None
+
+    def start(self):
+        self._old_handler = signal.signal(signal.SIGPROF, self._sample)
+        # Python 2 doesn't retry system calls the signal interrupts, so
+        # without this, file and socket calls could fail with EINTR.
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._old_handler or signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s:%s:%s' % (
+                os.path.basename(code.co_filename), code.co_name,
+                code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.stacks.iteritems()):
+                f.write('%s %s\n' % (stack, count))
+
+
+PROFILERS = {
+    'cprofile': DeterministicProfiler,
+    'sample': SamplingProfiler,
+}
+
+
+class ProfilerError(Exception):
+    pass
+
+
+class WorkerProfiler(object):
+    """Runs one profiler at a time for a fixed number of seconds and dumps
+    the result to a file in `output_dir`.
+    """
+
+    def __init__(self, clock, output_dir, max_seconds, name='vumibot'):
+        self.clock = clock
+        self.output_dir = output_dir
+        self.max_seconds = max_seconds
+        self.name = name
+        self.profiler = None
+        self.filename = None
+        self._delayed_call = None
+
+    @property
+    def running(self):
+        return self.profiler is not None
+
+    def start(self, seconds, kind='cprofile'):
+        """Start profiling and return the name of the file the results will
+        be written to after `seconds`.
+        """
+        if self.running:
+            raise ProfilerError(
+                "Already profiling to %s." % (self.filename,))
+        if kind not in PROFILERS:
+            raise ProfilerError("Unknown profiler '%s'. Choose from: %s." % (
+                kind, ', '.join(sorted(PROFILERS))))
+        if not 0 < seconds <= self.max_seconds:
+            raise ProfilerError("Profile for 1 to %s seconds." % (
+                self.max_seconds,))
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        profiler = PROFILERS[kind]()
+        self.filename = os.path.join(self.output_dir, '%s-%s-%s.%s' % (
+            self.name, time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+            profiler.suffix))
+        self.profiler = profiler
+        profiler.start()
+        self._delayed_call = self.clock.callLater(seconds, self.stop)
+        return self.filename
+
+    def stop(self):
+        """Stop profiling and write the results. Returns the filename, or
+        `None` if we weren't profiling.
+        """
+        if not self.running:
+            return None
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+        profiler, filename = self.profiler, self.filename
+        self.profiler = self.filename = None
+        profiler.stop()
+        profiler.dump(filename)
+        return filename
@@ -0,0 +1,213 @@
+# -*- test-case-name: tests.test_ratelimit -*-
+
+"""Outbound rate limiting for IRC bots."""
+
+from collections import deque
+
+from twisted.internet.defer import Deferred, gatherResults, maybeDeferred
+from twisted.python.failure import Failure
+
+
+class TokenBucket(object):
+    """A token bucket that refills at `rate` tokens per second up to `burst`
+    tokens. A `rate` of zero means the bucket never runs out.
+    """
+
+    def __init__(self, rate, burst, clock):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.last_refill = clock.seconds()
+
+    def refill(self):
+        now = self.clock.seconds()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+    def wait_time(self):
+        """Return the number of seconds until a token is available."""
+        if self.rate <= 0:
+            return 0
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def is_full(self):
+        """Return `True` if the bucket is as full as a new one would be."""
+        self.refill()
+        return self.tokens >= self.burst
+
+
+class QueuedReply(object):
+    def __init__(self, reply, endpoint_name, enqueued_at):
+        self.reply = reply
+        self.endpoint_name = endpoint_name
+        self.enqueued_at = enqueued_at
+        self.deferreds = []
+
+
+class OutboundScheduler(object):
+    """Send outbound messages through global and per-channel token buckets.
+
+    Messages waiting for a token are queued per channel and the channels are
+    served round-robin. If `merge` is given, it is called as
+    `merge(queued_reply, reply)` for each new message and should return
+    `True` if it folded `reply` into the already queued one.
+
+    A channel's bucket is dropped once nothing is queued for it and it has
+    refilled, so only recently used channels keep one.
+    """
+
+    def __init__(self, publish, clock, rate=0, burst=1, channel_rate=0,
+                 channel_burst=1, merge=None):
+        self.publish = publish
+        self.clock = clock
+        self.global_bucket = TokenBucket(rate, burst, clock)
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.channel_buckets = {}
+        self.idle_channels = set()
+        self.merge = merge
+        self.queues = {}
+        self.channel_order = deque()
+        self._delayed_call = None
+        self.published = 0
+        self.merged = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def channel_bucket(self, channel):
+        bucket = self.channel_buckets.get(channel)
+        if bucket is None:
+            bucket = TokenBucket(
+                self.channel_rate, self.channel_burst, self.clock)
+            self.channel_buckets[channel] = bucket
+        return bucket
+
+    def prune_buckets(self):
+        """Drop the buckets of idle channels that have refilled."""
+        for channel in list(self.idle_channels):
+            bucket = self.channel_buckets.get(channel)
+            if bucket is None or bucket.is_full():
+                self.channel_buckets.pop(channel, None)
+                self.idle_channels.discard(channel)
+
+    def queue_length(self):
+        return sum(len(queue) for queue in self.queues.itervalues())
+
+    def get_metrics(self):
+        avg_latency = 0.0
+        if self.published:
+            avg_latency = self.total_latency / self.published
+        return {
+            'queued': self.queue_length(),
+            'published': self.published,
+            'merged': self.merged,
+            'avg_latency': avg_latency,
+            'max_latency': self.max_latency,
+        }
+
+    def send(self, channel, reply, endpoint_name):
+        """Queue `reply` for `channel` and return a deferred that fires when
+        it has been published.
+        """
+        d = Deferred()
+        self.prune_buckets()
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = deque()
+            self.channel_order.append(channel)
+            self.idle_channels.discard(channel)
+        if queue and self._merge(queue[-1], reply, endpoint_name):
+            self.merged += 1
+            queue[-1].deferreds.append(d)
+            return d
+        queued = QueuedReply(reply, endpoint_name, self.clock.seconds())
+        queued.deferreds.append(d)
+        queue.append(queued)
+        self._process()
+        return d
+
+    def _merge(self, queued, reply, endpoint_name):
+        if self.merge is None or queued.endpoint_name != endpoint_name:
+            return False
+        return self.merge(queued.reply, reply)
+
+    def _process(self):
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+            self._delayed_call = None
+        while self.channel_order:
+            wait = self.global_bucket.wait_time()
+            if wait > 0:
+                break
+            wait = self._send_next()
+            if wait > 0:
+                break
+        else:
+            return
+        self._delayed_call = self.clock.callLater(wait, self._wake)
+
+    def _wake(self):
+        self._delayed_call = None
+        self._process()
+
+    def _send_next(self):
+        """Send the next message from the first channel with a token
+        available, or return the time until one will be.
+        """
+        min_wait = None
+        for _ in range(len(self.channel_order)):
+            channel = self.channel_order[0]
+            self.channel_order.rotate(-1)
+            bucket = self.channel_bucket(channel)
+            wait = bucket.wait_time()
+            if wait > 0:
+                min_wait = wait if min_wait is None else min(min_wait, wait)
+                continue
+            bucket.consume()
+            self.global_bucket.consume()
+            self._publish(self._pop(channel))
+            return 0
+        return min_wait
+
+    def _pop(self, channel):
+        queue = self.queues[channel]
+        queued = queue.popleft()
+        if not queue:
+            del self.queues[channel]
+            self.channel_order.remove(channel)
+            self.idle_channels.add(channel)
+        return queued
+
+    def _publish(self, queued):
+        latency = self.clock.seconds() - queued.enqueued_at
+        self.published += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        d = maybeDeferred(self.publish, queued.reply, queued.endpoint_name)
+        return d.addBoth(self._fire_deferreds, queued.deferreds)
+
+    def _fire_deferreds(self, result, deferreds):
+        for d in deferreds:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def stop(self):
+        """Stop scheduling and publish everything still queued."""
+        if self._delayed_call is not None:
+            self._delayed_call.cancel()
+            self._delayed_call = None
+        ds = []
+        while self.channel_order:
+            ds.append(self._publish(self._pop(self.channel_order[0])))
+        return gatherResults(ds)
@@ -0,0 +1,121 @@
+# -*- test-case-name: tests.test_stats -*-
+
+"""Hot-path statistics for message processors."""
+
+import random
+import time
+
+
+# Upper bounds (in seconds) of the latency histogram buckets. Anything slower
+# than the last bound goes into an overflow bucket.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+# Name under which calls to handle_message are recorded.
+MESSAGE_COMMAND = '(message)'
+
+
+def format_bucket(bound):
+    if bound is None:
+        return '>%gms' % (LATENCY_BUCKETS[-1] * 1000,)
+    return '<%gms' % (bound * 1000,)
+
+
+class CountingClientProxy(object):
+    """Stands in for a Redis manager's client proxy and counts how often
+    the client is fetched.
+
+    Managers fetch their client once for every command they send, so giving
+    a processor's sub-manager one of these counts that processor's Redis
+    commands.
+    """
+
+    def __init__(self, client_proxy):
+        self._client_proxy = client_proxy
+        self.count = 0
+
+    @property
+    def client(self):
+        self.count += 1
+        return self._client_proxy.client
+
+
+class CommandStats(object):
+    __slots__ = ['calls', 'errors', 'redis_commands', 'histogram']
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.redis_commands = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record_latency(self, latency):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency < bound:
+                self.histogram[i] += 1
+                return
+        self.histogram[-1] += 1
+
+    def format(self):
+        buckets = [
+            '%s:%s' % (format_bucket(bound), count)
+            for bound, count in zip(LATENCY_BUCKETS + (None,), self.histogram)
+            if count]
+        return 'calls=%s errors=%s redis=%s latency=[%s]' % (
+            self.calls, self.errors, self.redis_commands, ' '.join(buckets))
+
+
+class ProcessorStats(object):
+    """Call counts, error counts, Redis command counts and a sampled latency
+    histogram for each processor and command.
+
+    Only one call in every `1 / sample_rate` is timed, so this is cheap
+    enough to leave on. Redis commands are attributed to whichever command
+    was running on that processor when they were sent, which is approximate
+    when messages are processed concurrently.
+    """
+
+    def __init__(self, sample_rate=1.0, clock=time.time, random=random.random):
+        self.sample_rate = sample_rate
+        self.clock = clock
+        self.random = random
+        self.commands = {}
+        self.redis_proxies = {}
+
+    def instrument_redis(self, proc_name, redis):
+        """Count Redis commands sent through `redis` against `proc_name`."""
+        proxy = self.redis_proxies.get(proc_name)
+        if proxy is None:
+            proxy = CountingClientProxy(redis._client_proxy)
+            self.redis_proxies[proc_name] = proxy
+        redis._client_proxy = proxy
+        return redis
+
+    def redis_count(self, proc_name):
+        proxy = self.redis_proxies.get(proc_name)
+        return proxy.count if proxy is not None else 0
+
+    def start(self, proc_name, command):
+        key = (proc_name, command)
+        stats = self.commands.get(key)
+        if stats is None:
+            stats = self.commands[key] = CommandStats()
+        stats.calls += 1
+        started = None
+        if self.random() < self.sample_rate:
+            started = self.clock()
+        return (proc_name, stats, started, self.redis_count(proc_name))
+
+    def finish(self, timer, error=False):
+        proc_name, stats, started, redis_count = timer
+        if error:
+            stats.errors += 1
+        if started is not None:
+            stats.record_latency(self.clock() - started)
+        stats.redis_commands += self.redis_count(proc_name) - redis_count
+
+    def format_lines(self, proc_name=None):
+        return [
+            '%s %s: %s' % (name, command, stats.format())
+            for (name, command), stats in sorted(self.commands.iteritems())
+            if proc_name is None or name.lower() == proc_name.lower()]
+
@@ -0,0 +1,459 @@
+# -*- test-case-name: tests.test_storage -*-
+
+"""Storage backends for message processors.
+
+Processors keep their lists and sets through the handful of Redis commands
+below, via `BotMessageProcessor.get_redis`. The worker's `storage` config
+decides what answers them: a `RedisStore`, or an `EmbeddedStore` that keeps
+everything in this process. The embedded store is for small deployments and
+tests that don't want a Redis server.
+
+Both backends also provide `drain_list`, `pop_list` and `prepend_list`,
+which need to run atomically.
+"""
+
+import fnmatch
+import json
+import os
+from bisect import bisect_left, bisect_right, insort
+
+from twisted.internet.defer import gatherResults, succeed
+from twisted.python import log
+
+from vumi.persist.fake_redis import FakeRedis, maybe_async
+from vumi.persist.txredis_manager import TxRedisManager
+
+
+def _bytes(value):
+    # Redis stores everything as bytes, so we do too.
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _log_field(value):
+    # Latin-1 maps every byte to a code point, so any value survives JSON.
+    return value.decode('latin-1')
+
+
+def _list_slice(start, end):
+    # Redis ranges include `end`, and -1 means the end of the list.
+    if end == -1:
+        return start, None
+    return start, end + 1
+
+
+class RedisStore(TxRedisManager):
+    """A Redis manager with atomic list operations.
+
+    Each operation is sent as a single MULTI/EXEC block, so it costs one
+    round trip and any item pushed concurrently is either included or left
+    in the list.
+    """
+
+    @classmethod
+    def from_config(cls, config):
+        fake_redis = config.get('FAKE_REDIS')
+        if isinstance(fake_redis, TxRedisManager):
+            # Share the fake behind any Redis manager, not only ours.
+            config = dict(config, FAKE_REDIS=fake_redis._client)
+        return super(RedisStore, cls).from_config(config)
+
+    @classmethod
+    def _fake_manager(cls, fake_redis, manager_config):
+        if not issubclass(cls, FakeRedisStore):
+            return FakeRedisStore._fake_manager(fake_redis, manager_config)
+        return super(RedisStore, cls)._fake_manager(
+            fake_redis, manager_config)
+
+    def _transaction(self, *commands):
+        client = self._client
+        ds = [client.multi()]
+        ds.extend(getattr(client, command)(*args)
+                  for command, args in commands)
+        ds.append(client.execute())
+        d = gatherResults(ds, consumeErrors=True)
+        return d.addCallback(lambda replies: replies[-1])
+
+    def drain_list(self, key):
+        """Fetch and delete the list at `key`."""
+        full_key = self._key(key)
+        d = self._transaction(
+            ('lrange', (full_key, 0, -1)),
+            ('delete', (full_key,)))
+        return d.addCallback(lambda replies: replies[0])
+
+    def pop_list(self, key, count):
+        """Remove and return up to `count` items from the front of the list
+        at `key`, along with the number left.
+        """
+        full_key = self._key(key)
+        d = self._transaction(
+            ('lrange', (full_key, 0, count - 1)),
+            ('ltrim', (full_key, count, -1)),
+            ('llen', (full_key,)))
+        return d.addCallback(lambda replies: [replies[0], replies[2]])
+
+    def prepend_list(self, key, values):
+        """Push `values` onto the front of the list at `key`, keeping their
+        order, with a single LPUSH.
+        """
+        if not values:
+            return succeed(0)
+        return self._client.lpush(self._key(key), *reversed(values))
+
+
+@maybe_async
+def _fake_drain_list(fake_redis, key):
+    items = FakeRedis.lrange.sync(fake_redis, key, 0, -1)
+    FakeRedis.delete.sync(fake_redis, key)
+    return items
+
+
+@maybe_async
+def _fake_pop_list(fake_redis, key, count):
+    items = FakeRedis.lrange.sync(fake_redis, key, 0, count - 1)
+    FakeRedis.ltrim.sync(fake_redis, key, count, -1)
+    return [items, FakeRedis.llen.sync(fake_redis, key)]
+
+
+@maybe_async
+def _fake_prepend_list(fake_redis, key, values):
+    for value in reversed(values):
+        FakeRedis.lpush.sync(fake_redis, key, value)
+    return FakeRedis.llen.sync(fake_redis, key)
+
+
+class FakeRedisStore(RedisStore):
+    """`RedisStore` for the `FakeRedis` used in tests, which has no
+    MULTI/EXEC.
+
+    `RedisStore.from_config` returns one of these when given `FAKE_REDIS`.
+    Each operation runs as a single delayed FakeRedis call, so nothing else
+    can run in the middle of it.
+    """
+
+    def drain_list(self, key):
+        return _fake_drain_list(self._client, self._key(key))
+
+    def pop_list(self, key, count):
+        return _fake_pop_list(self._client, self._key(key), count)
+
+    def prepend_list(self, key, values):
+        return _fake_prepend_list(self._client, self._key(key), values)
+
+
+class EmbeddedDatabase(object):
+    """Lists and sets held in memory and logged to an append-only file.
+
+    Every change is appended to the log as a line of JSON and flushed to the
+    OS before the command returns, so it survives the worker crashing. On
+    startup the log is replayed to rebuild the data, and then rewritten with
+    just the current contents so it doesn't grow forever. A crash while
+    appending can leave the last line incomplete, so that is skipped.
+
+    If `path` is `None`, nothing is logged.
+    """
+
+    WRITE_COMMANDS = frozenset([
+        'rpush', 'lpush', 'ltrim', 'lrem', 'delete', 'sadd', 'srem'])
+
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {}
+        self.sorted_keys = []
+        self._log = None
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        if os.path.exists(self.path):
+            torn = None
+            with open(self.path) as f:
+                for number, line in enumerate(f, 1):
+                    if torn is not None:
+                        raise ValueError("Line %d of %s is corrupt." % (
+                            torn, self.path))
+                    if not line.strip():
+                        continue
+                    try:
+                        fields = json.loads(line)
+                    except ValueError:
+                        torn = number
+                        continue
+                    command = [field.encode('latin-1') for field in fields]
+                    self._apply(command[0], command[1], command[2:])
+            if torn is not None:
+                log.msg("Skipped incomplete last line %d of %s." % (
+                    torn, self.path))
+        self._compact()
+        self._log = open(self.path, 'a')
+
+    def _compact(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for key, value in sorted(self.data.iteritems()):
+                command = 'rpush' if isinstance(value, list) else 'sadd'
+                for item in sorted(value) if command == 'sadd' else value:
+                    self._write(f, [command, key, item])
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+    def _write(self, f, command):
+        f.write(json.dumps([_log_field(field) for field in command]) + '\n')
+
+    def close(self):
+        if self._log is not None:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._log.close()
+            self._log = None
+
+    def execute(self, command, key, *args):
+        """Run a command and log it if it changed anything."""
+        key = _bytes(key)
+        args = [_bytes(arg) if isinstance(arg, basestring) else arg
+                for arg in args]
+        result = self._apply(command, key, args)
+        if self._log is not None and command in self.WRITE_COMMANDS:
+            self._write(self._log, [command, key] + [str(a) for a in args])
+            self._log.flush()
+        return result
+
+    def _apply(self, command, key, args):
+        return getattr(self, '_cmd_' + command)(key, *args)
+
+    def _get(self, key, default):
+        value = self.data.get(key)
+        if value is None:
+            return default
+        return value
+
+    def _set(self, key, value):
+        # Like Redis, empty lists and sets don't exist.
+        if not value:
+            self._cmd_delete(key)
+            return
+        if key not in self.data:
+            insort(self.sorted_keys, key)
+        self.data[key] = value
+
+    def scan(self, cursor, prefix, count):
+        """Return up to `count` keys starting with `prefix`, in order, from
+        after the key `cursor`, and the cursor for the next call.
+
+        The cursor is the last key returned, so keys added or removed in
+        the meantime don't make the next call skip or repeat others. The
+        cursor is `None` once there are no more keys.
+        """
+        if cursor is None:
+            start = bisect_left(self.sorted_keys, prefix)
+        else:
+            start = bisect_right(self.sorted_keys, cursor)
+        keys = self.sorted_keys[start:start + count]
+        in_prefix = [key for key in keys if key.startswith(prefix)]
+        if len(in_prefix) < count or start + count >= len(self.sorted_keys):
+            return None, in_prefix
+        return in_prefix[-1], in_prefix
+
+    def _cmd_type(self, key):
+        value = self.data.get(key)
+        if value is None:
+            return 'none'
+        return 'list' if isinstance(value, list) else 'set'
+
+    def _cmd_delete(self, key):
+        if self.data.pop(key, None) is None:
+            return 0
+        del self.sorted_keys[bisect_left(self.sorted_keys, key)]
+        return 1
+
+    def _cmd_rpush(self, key, value):
+        lval = self._get(key, [])
+        lval.append(value)
+        self._set(key, lval)
+        return len(lval)
+
+    def _cmd_lpush(self, key, *values):
+        lval = self._get(key, [])
+        lval[:0] = reversed(values)
+        self._set(key, lval)
+        return len(lval)
+
+    def _cmd_lrange(self, key, start, end):
+        start, end = _list_slice(int(start), int(end))
+        return self._get(key, [])[start:end]
+
+    def _cmd_ltrim(self, key, start, end):
+        start, end = _list_slice(int(start), int(end))
+        self._set(key, self._get(key, [])[start:end])
+        return True
+
+    def _cmd_llen(self, key):
+        return len(self._get(key, []))
+
+    def _cmd_lrem(self, key, value, num=0):
+        num = int(num)
+        lval = self._get(key, [])
+        if num < 0:
+            lval.reverse()
+        kept = []
+        removed = 0
+        for item in lval:
+            if item == value and (num == 0 or removed < abs(num)):
+                removed += 1
+            else:
+                kept.append(item)
+        if num < 0:
+            kept.reverse()
+        self._set(key, kept)
+        return removed
+
+    def _cmd_sadd(self, key, *values):
+        sval = self._get(key, set())
+        size = len(sval)
+        sval.update(values)
+        self._set(key, sval)
+        return len(sval) - size
+
+    def _cmd_srem(self, key, *values):
+        sval = self._get(key, set())
+        size = len(sval)
+        sval.difference_update(values)
+        self._set(key, sval)
+        return size - len(sval)
+
+    def _cmd_sismember(self, key, value):
+        return value in self._get(key, ())
+
+    def _cmd_smembers(self, key):
+        return set(self._get(key, set()))
+
+
+class _EmbeddedClientProxy(object):
+    # Stands in for a Redis manager's client proxy, so the worker's stats
+    # can count commands the same way for both backends.
+
+    def __init__(self, database):
+        self.client = database
+
+
+class EmbeddedStore(object):
+    """The subset of the Redis manager API that processors use, backed by
+    an `EmbeddedDatabase`.
+
+    Commands run straight away and return deferreds that have already
+    fired, so processor code works unchanged against either backend. Keys
+    are prefixed as for Redis sub-managers.
+    """
+
+    def __init__(self, database, key_prefix=None, key_separator=':'):
+        self._database = database
+        self._key_prefix = key_prefix
+        self._key_separator = key_separator
+        self._client_proxy = _EmbeddedClientProxy(database)
+
+    @classmethod
+    def from_config(cls, config):
+        """Open the store at `config['path']`, or an unlogged one."""
+        return cls(
+            EmbeddedDatabase(config.get('path')),
+            key_prefix=config.get('key_prefix'),
+            key_separator=config.get('key_separator', ':'))
+
+    def sub_manager(self, sub_prefix):
+        key_prefix = self._key(sub_prefix)
+        return type(self)(self._database, key_prefix, self._key_separator)
+
+    def close_manager(self):
+        self._database.close()
+        return succeed(None)
+
+    def _key(self, key):
+        if self._key_prefix is None:
+            return key
+        return '%s%s%s' % (self._key_prefix, self._key_separator, key)
+
+    def _unkey(self, key):
+        if self._key_prefix is None:
+            return key
+        return key[len(self._key_prefix) + len(self._key_separator):]
+
+    def _execute(self, command, key, *args):
+        database = self._client_proxy.client
+        return succeed(database.execute(command, self._key(key), *args))
+
+    def type(self, key):
+        return self._execute('type', key)
+
+    def delete(self, key):
+        return self._execute('delete', key)
+
+    def rpush(self, key, value):
+        return self._execute('rpush', key, value)
+
+    def lpush(self, key, value):
+        return self._execute('lpush', key, value)
+
+    def lrange(self, key, start, end):
+        return self._execute('lrange', key, start, end)
+
+    def ltrim(self, key, start, end):
+        return self._execute('ltrim', key, start, end)
+
+    def llen(self, key):
+        return self._execute('llen', key)
+
+    def lrem(self, key, value, num=0):
+        return self._execute('lrem', key, value, num)
+
+    def sadd(self, key, *values):
+        return self._execute('sadd', key, *values)
+
+    def srem(self, key, *values):
+        return self._execute('srem', key, *values)
+
+    def sismember(self, key, value):
+        return self._execute('sismember', key, value)
+
+    def smembers(self, key):
+        return self._execute('smembers', key)
+
+    def scan(self, cursor, match=None, count=None):
+        """Return `[cursor, keys]` like `TxRedisManager.scan`, walking our
+        keys in sorted order.
+        """
+        database = self._client_proxy.client
+        if count is None:
+            count = 10
+        pattern = _bytes(self._key(match or '*'))
+        cursor, keys = database.scan(cursor, _bytes(self._key('')), count)
+        return succeed([cursor, [
+            self._unkey(key) for key in keys
+            if fnmatch.fnmatchcase(key, pattern)]])
+
+    def drain_list(self, key):
+        """Fetch and delete the list at `key`. Nothing else runs between
+        the two, so this is atomic."""
+        database = self._client_proxy.client
+        items = database.execute('lrange', self._key(key), 0, -1)
+        database.execute('delete', self._key(key))
+        return succeed(items)
+
+    def pop_list(self, key, count):
+        """Remove and return up to `count` items from the front of the list
+        at `key`, along with the number left."""
+        database = self._client_proxy.client
+        full_key = self._key(key)
+        items = database.execute('lrange', full_key, 0, count - 1)
+        database.execute('ltrim', full_key, count, -1)
+        remaining = database.execute('llen', full_key)
+        return succeed([items, remaining])
+
+    def prepend_list(self, key, values):
+        """Push `values` onto the front of the list at `key`, keeping their
+        order. They are logged together, so a crash keeps all or none."""
+        if not values:
+            return succeed(0)
+        return self._execute('lpush', key, *reversed(values))